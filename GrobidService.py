@@ -5,139 +5,841 @@ import os
 from datetime import datetime
 import time
 import json
+import csv
 import collections
+import concurrent.futures
+import functools
+import threading
+import contextlib
+import hashlib
+import heapq
+import operator
+import itertools
+import signal
+import multiprocessing
 import logging
-from bs4 import BeautifulSoup
 #
 import argparse
-import progressbar as pb
 #
 import settings
 import grobidAPI
 import tei2dict
-import csv
+import records
+import teicache
+import checkpoint
+import teiarchive
+import pdftrim
+import pdfwatch
+import metrics
+import sinks
+import refindex
+import scholar
 import utils
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def processHeaderDocument():
-    pdfs = utils.get_path_of_pdfs();
-    with open(settings.OUTPUT_FILE, 'w', encoding='UTF-8', newline='') as output_file:
-        wr = csv.writer(output_file, quoting=csv.QUOTE_ALL)
+# Archived documents sent to a reparse process at once
+REPARSE_CHUNK_SIZE = 16
+
+# Names and columns of outputs, columns are followed by authors
+HEADERS_OUTPUT = 'headers'
+REFERENCES_OUTPUT = 'references'
+WORKS_OUTPUT = 'works'
+SCHOLAR_OUTPUT = 'scholar'
+HEADER_COLUMNS = records.HEADER_COLUMNS
+REFERENCE_COLUMNS = records.REFERENCE_COLUMNS
+# With --dedup references output has a row per citation, every cited work is once in works output
+CITATION_COLUMNS = (("file", str), ("ref_id", int))
+WORK_COLUMNS = (("ref_id", int),) + REFERENCE_COLUMNS[1:]
+# With --scholar counts looked up after their references were written, to be joined on title
+SCHOLAR_COLUMNS = (("title", str), ("scholar_count", int))
+# With --shard outputs start with key of the document in --order, merge command merges shards by it and drops it
+ORDER_COLUMN = ("_order", str)
+# Zero-padded sizes of order keys compare as numbers
+MAX_ORDER_SIZE = 10 ** 20 - 1
+TITLE_COLUMN = [name for name, kind in REFERENCE_COLUMNS].index("title")
+SCHOLAR_COUNT_COLUMN = [name for name, kind in REFERENCE_COLUMNS].index("scholar_count")
+
+def get_header_rows(pdf, header):
+    """ Build output rows for the header (records.Header) of one document """
+    row = header.to_row(os.path.split(pdf)[1])
+    msg = "RESULT: has title:{:^3}has date:{:^3}has DOI:{:^3}has abstract:{:^3}authors:{:^4}has start page:{:^3}has end page:{:^3}has publisher:{:^3}".format(
+        header.title is not None,
+        header.pubdate is not None,
+        header.doi is not None,
+        header.abstract is not None,
+        len(row) - len(HEADER_COLUMNS),
+        header.start_page is not None,
+        header.end_page is not None,
+        header.publisher is not None
+        )
+    settings.print_progress(msg, 2)
+    logger.debug(msg)
+    return [row]
+
+
+def get_references_rows(pdf, header, with_keys = False):
+    """ Build output rows for the references of one document """
+    return list(iterate_references_rows(pdf, header.references, len(header.references), with_keys))
+
+
+def get_fulltext_rows(pdf, header, with_keys = False):
+    """ Build output rows for the header and for the references of one document """
+    return get_header_rows(pdf, header), list(iterate_references_rows(pdf, header.references, len(header.references), with_keys))
+
+
+def iterate_references_rows(pdf, references, total, with_keys = False):
+    """ Yield output rows for references (records.Reference) of one document, with_keys adds work key of refindex after file """
+    pdf_name = os.path.split(pdf)[1]
+    for i, reference in enumerate(references):
+        try:
+            if not reference.has_title():
+                settings.print_progress("Ref #{} (total {}) has not title, skip".format(i, total))
+                logger.debug("Ref #{} (total {}) has not title, skip".format(i, total))
+                metrics.increment('skipped_references')
+                continue
+            # Looked up on Scholar later with --scholar, see enrich_documents
+            count_publications_on_scholar = 0
+            row = reference.to_row(pdf_name, count_publications_on_scholar)
+            pubnote = reference.pubnote
+            msg = "Ref #{} (total {}): has title:{:^3}has date:{:^3}Has DOI:{:^3}authors:{:^4}has start page:{:^3}has end page:{:^3}has publisher:{:^3}publications on scholar:{}".format(
+                i,
+                total,
+                reference.title != None or pubnote.journal_title is not None,
+                pubnote.year is not None,
+                pubnote.doi is not None,
+                len(row) - len(REFERENCE_COLUMNS),
+                pubnote.start_page is not None,
+                pubnote.end_page is not None,
+                pubnote.journal_title is not None,
+                count_publications_on_scholar
+                )
+            settings.print_progress(msg, 2)
+            logger.debug(msg)
+            if with_keys:
+                # Journal title shown for references without own title would merge all papers of a journal
+                first_author = reference.authors[0] if reference.authors else None
+                row.insert(1, refindex.make_key(pubnote.doi, reference.title, pubnote.year, first_author.surname or first_author.name if first_author else None))
+            yield row
+        except:
+            metrics.increment('reference_errors')
+            settings.print_message(traceback.format_exc())
+            logger.error(traceback.format_exc())
+
+
+def check_data(data):
+    settings.print_progress("Check data", 2)
+    logger.debug("Check data")
+    if not data:
+        metrics.increment('empty_responses')
+        raise Exception("Empty data")
+
+
+def process_data(get_rows, pdf, data):
+    """ Convert TEI returned by grobid to records and return output rows """
+    check_data(data)
+    settings.print_progress("Processing TEI data", 2)
+    logger.debug("Convert tei to dictionary")
+    if isinstance(data, tei2dict.ParsedTEI):
+        # Parsed when it was checked for header
+        header = data.record
+    else:
+        with metrics.timer('parse'):
+            header = tei2dict.tei_to_record(data)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Convert completed: {}".format(json.dumps(header.to_dict())))
+    with metrics.timer('to_rows'):
+        return get_rows(pdf, header)
+
+
+def process_stream(pdf, data, with_keys = False):
+    """ Return generator of reference rows, TEI is parsed while rows are written """
+    check_data(data)
+    settings.print_progress("Processing TEI data as stream", 2)
+    logger.debug("Convert tei to references stream")
+    return iterate_references_rows(pdf, tei2dict.iter_reference_records(data), "?", with_keys)
+
+
+def print_document(pdf, number, total):
+    logger.debug("Process file #{} (total {}): '{}'".format(number, total, os.path.split(pdf)[1]))
+    settings.print_progress("Process file #{} (total {}): '{}'".format(number, total, os.path.split(pdf)[1]))
+    settings.print_progress("Send to grobid service..", 2)
+
+
+def get_trim_pages(command):
+    """ Number of first PDF pages sent for command, 0 to send whole PDF """
+    return settings.HEADER_PAGES if command == settings.GROBID_PROCESSED_HEADER_COMMAND else 0
+
+
+def fetch_document(command, pdf):
+    """ Send one PDF to grobid and return TEI, only the first pages are sent for header if they are enough """
+    pages = get_trim_pages(command)
+    trimmed = metrics.timed('read', pdftrim.trim_pdf, pdf, pages) if pages else None
+    if trimmed is not None:
+        data = pdftrim.parse_header(grobidAPI.get_data_from_grobid(command, (os.path.split(pdf)[1], trimmed), settings.USING_TOR_BROWSER, True))
+        if data is not None:
+            return data
+        logger.debug("No title or authors in first {} pages of '{}', send whole file".format(pages, os.path.split(pdf)[1]))
+    # Whole PDF is memory-mapped into the upload, TEI stays bytes up to the parser
+    return grobidAPI.get_data_from_grobid(command, (os.path.split(pdf)[1], pdf), settings.USING_TOR_BROWSER, True)
+
+
+def copy_future(source, target):
+    """ Set result or exception of source future in target once source is done """
+    def copy_result(inner):
+        if inner.exception() is not None:
+            target.set_exception(inner.exception())
+        else:
+            target.set_result(inner.result())
+    source.add_done_callback(copy_result)
+
+
+def chain_future(future, executor, fn, *args):
+    """ Run fn(*args, future.result()) in executor once future is done, returns future of fn result """
+    result = concurrent.futures.Future()
+    def submit(outer):
+        if outer.exception() is not None:
+            result.set_exception(outer.exception())
+        else:
+            copy_future(executor.submit(fn, *args, outer.result()), result)
+    future.add_done_callback(submit)
+    return result
+
+
+def done_future(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def open_cache(command):
+    """ Open TEI cache, returns (cache, key function of PDF sha256) or (None, None) if cache is disabled """
+    if not settings.CACHE_PATH:
+        return None, None
+    version = grobidAPI.get_grobid_version()
+    if version is None:
+        # TEI of an unknown release could be served as TEI of another one
+        settings.print_message("TEI cache is disabled: grobid version is unknown or differs between servers")
+        logger.warning("TEI cache is disabled: grobid version is unknown or differs between servers")
+        return None, None
+    cache = teicache.TEICache(settings.CACHE_PATH, settings.CACHE_SIZE)
+    settings.print_message("TEI cache: {} entries, grobid version {}".format(len(cache), version))
+    return cache, lambda sha256: teicache.make_key(sha256, command, version, get_trim_pages(command))
+
+
+def open_engine(command):
+    """ Open TEI cache and grobid client of settings.ENGINE, returns (cache, key function, client, fetch).
+        fetch(pdf) returns future of TEI, client is closed to stop uploads. Client is None if PDFs are sent one by one """
+    cache, get_key = open_cache(command)
+    if settings.WORKERS == 1 and settings.ENGINE == settings.THREADS_ENGINE:
+        return cache, get_key, None, None
+    if settings.ENGINE == settings.ASYNC_ENGINE:
+        # aiohttp is only needed by the async engine
+        import grobidAsyncAPI
+        client = grobidAsyncAPI.AsyncGrobidClient(settings.WORKERS)
+        return cache, get_key, client, lambda pdf: client.submit(command, pdf, True, get_trim_pages(command))
+    client = concurrent.futures.ThreadPoolExecutor(max_workers=settings.WORKERS)
+    return cache, get_key, client, functools.partial(client.submit, fetch_document, command)
+
+
+def iterate_documents(pdfs, command, process, engine = None):
+    """ Process PDFs (list or iterable still being discovered) with settings.WORKERS concurrent uploads and yield
+        (pdf, future of checkpoint.get_fingerprint, future of rows) in the order of pdfs, process(pdf, data) converts grobid data
+        to output rows. The fingerprint is taken once per PDF for both TEI cache key and journal.
+        engine of open_engine is kept open, otherwise one is opened for these PDFs """
+    total = len(pdfs) if hasattr(pdfs, '__len__') else "?"
+    cache, get_key, client, fetch = engine or open_engine(command)
+    if client is None:
         for i, pdf in enumerate(pdfs):
+            future = concurrent.futures.Future()
+            print_document(pdf, i + 1, total)
+            fingerprint = checkpoint.get_fingerprint(pdf)
             try:
-                logger.debug("Process file #{} (total {}): '{}'".format(i + 1, len(pdfs), os.path.split(pdf)[1]))
-                settings.print_message("Process file #{} (total {}): '{}'".format(i + 1, len(pdfs), os.path.split(pdf)[1]))
-                settings.print_message("Send to grobid service..", 2)
-                data = grobidAPI.get_data_from_grobid(settings.GROBID_PROCESSED_HEADER_COMMAND, open(pdf, 'rb'), settings.USING_TOR_BROWSER)
-                settings.print_message("Check data", 2)
-                logger.debug("Check data")
-                if not data: raise Exception("Empty data")
-                settings.print_message("Processing TEI data", 2)
-                logger.debug("Convert tei to dictionary")
-                dictData = tei2dict.tei_to_dict(data)
-                logger.debug("Convert completed: {}".format(json.dumps(dictData)))
-                authors = set(dictData["authors"]) if "authors" in dictData else []
-                msg = "RESULT: has title:{:^3}has date:{:^3}has DOI:{:^3}has abstract:{:^3}authors:{:^4}has start page:{:^3}has end page:{:^3}has publisher:{:^3}".format(
-                    "title" in dictData,
-                    "pubdate" in dictData,
-                    "DOI" in dictData,
-                    "abstract" in dictData,
-                    len(authors),
-                    "start_page" in dictData,
-                    "end_page" in dictData,
-                    "publisher" in dictData
-                    )
-                settings.print_message(msg, 2)
-                logger.debug(msg)
-                row = list()
-                row.append(os.path.split(pdf)[1])
-                row.append(dictData["title"] if "title" in dictData else "")
-                row.append(dictData["pubdate"] if "pubdate" in dictData else "")
-                row.append(dictData["DOI"] if "DOI" in dictData else "")
-                row.append(dictData["abstract"].strip() if "abstract" in dictData else "")
-                for author in authors: row.append(author)
-                logger.debug("Write in file {}".format(json.dumps(row)))
-                wr.writerow(row)
-            except:
-                settings.print_message(traceback.format_exc())
-                logger.error(traceback.format_exc())
+                key = get_key(fingerprint["sha256"]) if cache is not None and fingerprint["sha256"] is not None else None
+                data = cache.get(key, True) if key is not None else None
+                if data is not None:
+                    logger.debug("'{}' found in TEI cache".format(os.path.split(pdf)[1]))
+                    metrics.increment('cache_hits')
+                else:
+                    data = fetch_document(command, pdf)
+                    if data and key is not None: cache.put(key, data)
+                future.set_result(process(pdf, data))
+            except Exception as error:
+                future.set_exception(error)
+            yield pdf, done_future(fingerprint), future
+        return
+    # TEI parsing holds the GIL most of the time, more threads than cores don't help
+    parser = concurrent.futures.ThreadPoolExecutor(max_workers=min(settings.WORKERS, (os.cpu_count() or 1) + 4))
+    # Cache key -> future of TEI being fetched, so duplicate PDFs in the batch are sent once
+    in_flight = dict()
+    lock = threading.Lock()
+    def store(key, future):
+        try:
+            if future.exception() is None and future.result():
+                cache.put(key, future.result())
+        except:
+            logger.error(traceback.format_exc())
+        finally:
+            with lock:
+                in_flight.pop(key, None)
+    def lookup(pdf, data_future, fingerprint):
+        """ Runs in parser thread once PDF is hashed: data_future gets TEI from cache, document in progress or grobid """
+        try:
+            if fingerprint.result()["sha256"] is None:
+                # File can't be read, the upload reports the error
+                copy_future(fetch(pdf), data_future)
+                return
+            key = get_key(fingerprint.result()["sha256"])
+            with lock:
+                duplicate = in_flight.setdefault(key, data_future)
+            if duplicate is not data_future:
+                logger.debug("'{}' is a duplicate of a document in progress".format(os.path.split(pdf)[1]))
+                copy_future(duplicate, data_future)
+                return
+            data = cache.get(key, True)
+            if data is not None:
+                logger.debug("'{}' found in TEI cache".format(os.path.split(pdf)[1]))
+                metrics.increment('cache_hits')
+                with lock:
+                    in_flight.pop(key, None)
+                data_future.set_result(data)
+            else:
+                fetched = fetch(pdf)
+                fetched.add_done_callback(functools.partial(store, key))
+                copy_future(fetched, data_future)
+        except Exception as error:
+            data_future.set_exception(error)
+    def submit(pdf, number):
+        print_document(pdf, number, total)
+        # Hashing runs in parser threads, not in the writer
+        fingerprint = parser.submit(checkpoint.get_fingerprint, pdf)
+        if cache is None:
+            return pdf, fingerprint, chain_future(fetch(pdf), parser, process, pdf)
+        data_future = concurrent.futures.Future()
+        fingerprint.add_done_callback(functools.partial(lookup, pdf, data_future))
+        return pdf, fingerprint, chain_future(data_future, parser, process, pdf)
+    # Keep at most two PDFs per worker in flight, so results of slow documents don't pile up in memory
+    window = 2 * settings.WORKERS
+    # Yielded documents may be not done yet when the consumer reads ahead, executors are shut down once they are
+    outstanding = set()
+    def track(document):
+        outstanding.add(document[2])
+        document[2].add_done_callback(outstanding.discard)
+        return document
+    with client if engine is None else contextlib.nullcontext(), parser:
+        pending = collections.deque()
+        for i, pdf in enumerate(pdfs):
+            pending.append(submit(pdf, i + 1))
+            if len(pending) >= window:
+                yield track(pending.popleft())
+        while pending:
+            yield track(pending.popleft())
+        concurrent.futures.wait(list(outstanding))
 
 
-def processReferencesDocument():
-    pdfs = utils.get_path_of_pdfs();
-    with open(settings.OUTPUT_FILE, 'w', encoding='UTF-8', newline='') as output_file:
-        wr = csv.writer(output_file, quoting=csv.QUOTE_ALL)
-        for i, pdf in enumerate(pdfs):
+def enrich_future(future, enricher, output, title_column, count_column):
+    """ Returns future of document results with Scholar counts in reference rows, output is their index in results (None: results are rows) """
+    result = concurrent.futures.Future()
+    def enrich(outer):
+        if outer.exception() is not None:
+            result.set_exception(outer.exception())
+            return
+        try:
+            # Streamed rows are parsed here
+            if output is None:
+                results = rows = list(outer.result())
+            else:
+                results = list(outer.result())
+                rows = results[output] = list(results[output])
+            enricher.enrich(rows, title_column, count_column)
+            result.set_result(results)
+        except Exception as error:
+            result.set_exception(error)
+    future.add_done_callback(enrich)
+    return result
+
+
+def get_scholar_path(path):
+    return "{0}_scholar{1}".format(*os.path.splitext(path))
+
+
+def write_late_counts(enricher, counts):
+    """ Write Scholar counts that came after their references in counts sink, failed lookups have no count to write """
+    for title, count in enricher.drain():
+        if count is not scholar.FAILED_COUNT:
+            counts.write([title, count])
+    if counts.commit():
+        counts.flush()
+
+
+def is_enriched(outputs):
+    """ Scholar counts are looked up with --scholar if references are written """
+    return settings.SCHOLAR and REFERENCES_OUTPUT in [name for path, name, columns in outputs]
+
+
+def create_enricher():
+    return scholar.Enricher(settings.SCHOLAR_CACHE, settings.SCHOLAR_TTL, settings.SCHOLAR_RATE, settings.USING_TOR_BROWSER)
+
+
+def get_references_path(outputs):
+    return [path for path, name, columns in outputs if name == REFERENCES_OUTPUT][0]
+
+
+def open_counts(stack, enricher, outputs, resume = False):
+    """ Open sink of Scholar counts that come after their references were written, next to the references output.
+        Counts that came until stack is closed are written before the sink is closed """
+    path = get_scholar_path(get_references_path(outputs))
+    counts = stack.enter_context(sinks.open_sink(settings.OUTPUT_FORMAT, path, SCHOLAR_OUTPUT, SCHOLAR_COLUMNS, resume))
+    stack.callback(write_late_counts, enricher, counts)
+    return counts
+
+
+def open_enricher(stack, outputs, resume = False):
+    """ With --scholar returns (enricher, sink of counts that came after their references were written), otherwise None.
+        The run waits for lookups in progress when stack is closed, their counts are written before the sink is closed """
+    if not is_enriched(outputs):
+        return None
+    enricher = create_enricher()
+    counts = open_counts(stack, enricher, outputs, resume)
+    stack.enter_context(enricher)
+    settings.print_message("Scholar counts that come after their references are written: {}".format(get_scholar_path(get_references_path(outputs))))
+    return enricher, counts
+
+
+def enrich_documents(scholar_output, documents, outputs):
+    """ With scholar_output of open_enricher yield (pdf, fingerprint, future) of documents with Scholar counts of references.
+        Lookups run in background and rows don't wait for them: scholar_count is None until the count is known,
+        then it is written in the counts sink """
+    if scholar_output is None:
+        yield from documents
+        return
+    enricher, counts = scholar_output
+    names = [name for path, name, columns in outputs]
+    output = names.index(REFERENCES_OUTPUT) if len(names) > 1 else None
+    # Rows for refindex have work key after file
+    offset = 1 if settings.DEDUP else 0
+    for pdf, fingerprint, future in documents:
+        yield pdf, fingerprint, enrich_future(future, enricher, output, TITLE_COLUMN + offset, SCHOLAR_COUNT_COLUMN + offset)
+        write_late_counts(enricher, counts)
+
+
+def write_rows(output_sinks, documents, journal = None, archive = None, order = False):
+    """ Write rows of documents ((pdf, fingerprint, future) in order) in output_sinks, every finished PDF is saved in the journal
+        once its rows are flushed and its TEI is committed in archive. With several sinks future result has rows for every sink.
+        With order rows start with get_order_key of their document """
+    # (pdf, fingerprint, status) of documents in the sink buffers
+    pending = list()
+    def flush():
+        with metrics.timer('flush'):
+            positions = [sink.flush() for sink in output_sinks]
+            if archive is not None:
+                archive.commit()
+        if journal is not None:
+            for pdf, fingerprint, status in pending:
+                journal.record(pdf, status, positions, fingerprint.result() if fingerprint is not None else None)
+        del pending[:]
+    try:
+        for pdf, fingerprint, future in documents:
+            debug = logger.isEnabledFor(logging.DEBUG)
             try:
-                logger.debug("Process file #{} (total {}): '{}'".format(i + 1, len(pdfs), os.path.split(pdf)[1]))
-                settings.print_message("Process file #{} (total {}): '{}'".format(i + 1, len(pdfs), os.path.split(pdf)[1]))
-                settings.print_message("Send to grobid service..", 2)
-                data = grobidAPI.get_data_from_grobid(settings.GROBID_PROCESSED_REFERENCES_COMMAND, open(pdf, 'rb'), settings.USING_TOR_BROWSER)
-                settings.print_message("Check data", 2)
-                logger.debug("Check data")
-                if not data: raise Exception("Empty data")
-                settings.print_message("Processing TEI data", 2)
-                logger.debug("Convert tei to dictionary")
-                dictData = tei2dict.tei_to_dict(data)
-                logger.debug("Convert completed: {}".format(json.dumps(dictData)))
-                for i, reference in enumerate(dictData["references"]):
-                    try:
-                        if not reference["ref_title"] and not "journal_title" in reference["journal_pubnote"]:
-                            settings.print_message("Ref #{} (total {}) has not title, skip".format(i, len(dictData["references"])))
-                            logger.debug("Ref #{} (total {}) has not title, skip".format(i, len(dictData["references"])))
-                            continue
-                        authors = set(reference["authors"]) if "authors" in reference else []
-                        count_publications_on_scholar = 0 #utils.get_count_from_scholar(reference["ref_title"].strip() if reference["ref_title"] else 
-                                   #reference["journal_pubnote"]["journal_title"].strip() if "journal_title" in reference["journal_pubnote"] else "", settings.USING_TOR_BROWSER)
-                        msg = "Ref #{} (total {}): has title:{:^3}has date:{:^3}Has DOI:{:^3}authors:{:^4}has start page:{:^3}has end page:{:^3}has publisher:{:^3}publications on scholar:{}".format(
-                            i,
-                            len(dictData["references"]),
-                            reference["ref_title"] != None or "journal_title" in reference["journal_pubnote"],
-                            "year" in reference["journal_pubnote"],
-                            "doi" in reference["journal_pubnote"],
-                            len(authors),
-                            "start_page" in reference["journal_pubnote"],
-                            "end_page" in reference["journal_pubnote"],
-                            "journal_title" in reference["journal_pubnote"],
-                            count_publications_on_scholar
-                            )
-                        settings.print_message(msg, 2)
-                        logger.debug(msg)
-                        row = list()
-                        row.append(os.path.split(pdf)[1])
-                        row.append(reference["ref_title"] if reference["ref_title"] else 
-                                   reference["journal_pubnote"]["journal_title"] if "journal_title" in reference["journal_pubnote"] else "")
-                        row.append(reference["journal_pubnote"]["year"] if "year" in reference["journal_pubnote"] else "")
-                        row.append(reference["journal_pubnote"]["doi"] if "doi" in reference["journal_pubnote"] else "")
-                        row.append(reference["journal_pubnote"]["start_page"] if "start_page" in reference["journal_pubnote"] else "")
-                        row.append(reference["journal_pubnote"]["end_page"] if "end_page" in reference["journal_pubnote"] else "")
-                        row.append(count_publications_on_scholar)
-                        for author in authors: row.append(author)
-                        logger.debug("Write in file {}".format(json.dumps(row)))
-                        wr.writerow(row)
-                    except:
-                        settings.print_message(traceback.format_exc())
-                        logger.error(traceback.format_exc())
+                results = future.result()
+                key = [get_order_key(pdf, fingerprint.result()["size"] if fingerprint is not None else None)] if order else []
+                with metrics.timer('write'):
+                    for sink, rows in zip(output_sinks, results if len(output_sinks) > 1 else [results]):
+                        for row in rows:
+                            if debug: logger.debug("Write in file {}".format(json.dumps(row)))
+                            sink.write(key + row if order else row)
+                status = checkpoint.DONE
+                metrics.increment('documents')
             except:
+                settings.print_message("Error in file '{}'".format(os.path.split(pdf)[1]))
                 settings.print_message(traceback.format_exc())
                 logger.error(traceback.format_exc())
+                status = checkpoint.FAILED
+                metrics.increment('failed_documents')
+                # Rows of a document are written completely or not at all
+                for sink in output_sinks:
+                    sink.rollback()
+            pending.append((pdf, fingerprint, status))
+            if any([sink.commit() for sink in output_sinks]):
+                flush()
+    finally:
+        flush()
+
+
+def open_output(path, name, columns, resume = False):
+    """ Open sink in settings.OUTPUT_FORMAT, with --dedup references output is split in citations and works """
+    if name != REFERENCES_OUTPUT or not settings.DEDUP:
+        return sinks.open_sink(settings.OUTPUT_FORMAT, path, name, columns, resume)
+    # Index of this run only is kept for resume
+    index = refindex.ReferenceIndex(settings.REFERENCE_INDEX or get_works_path(path) + ".index", reset=not resume and not settings.REFERENCE_INDEX)
+    citations = sinks.open_sink(settings.OUTPUT_FORMAT, path, name, CITATION_COLUMNS, resume)
+    works = sinks.open_sink(settings.OUTPUT_FORMAT, get_works_path(path), WORKS_OUTPUT, WORK_COLUMNS, resume)
+    return refindex.DedupSink(index, citations, works)
+
+
+def get_works_path(path):
+    return "{0}_works{1}".format(*os.path.splitext(path))
+
+
+def open_sinks(stack, outputs, resume = False):
+    """ Open sink for every (path, name, columns) of outputs, with ORDER_COLUMN before columns if is_ordered() """
+    return [stack.enter_context(open_output(path, name, columns, resume)) for path, name, columns in get_output_columns(outputs)]
+
+
+def archive_data(archive, command, process, pdf, data):
+    """ Save TEI in archive before processing it """
+    if data: archive.add(pdf, command, data)
+    return process(pdf, data)
+
+
+def discover_pdfs():
+    """ Yield PDFs of settings.PDFS_PATH in settings.ORDER, in path order while the dir is still walked.
+        Files failing utils.check_pdf are reported and saved in settings.REJECTED_FILE instead of being sent to grobid """
+    if settings.ORDER != settings.PATH_ORDER:
+        sized = sorted(sized_pdfs(), key=lambda pdf: get_order_key(*pdf))
+        settings.print_message("{} PDFs ordered by size, {} first".format(len(sized), settings.ORDER))
+        for pdf, size in sized:
+            yield pdf
+        return
+    for pdf, size in sized_pdfs():
+        yield pdf
+
+
+def sized_pdfs():
+    """ Yield (path, size) of PDFs of settings.PDFS_PATH, files failing utils.check_pdf are reported
+        and saved in settings.REJECTED_FILE """
+    return check_pdfs(shard_pdfs(utils.iterate_pdfs(settings.PDFS_PATH)))
+
+
+def get_document_id(pdf):
+    """ Stable id of PDF: its path in settings.PDFS_PATH with / separators, the same on every node """
+    return os.path.relpath(pdf, settings.PDFS_PATH).replace(os.sep, '/')
+
+
+def get_order_key(pdf, size):
+    """ Sort key of PDF in settings.ORDER, the same on every node. Path is the last part, so files of the same size keep their order """
+    if settings.ORDER == settings.PATH_ORDER:
+        return get_document_id(pdf)
+    size = size or 0
+    return "{:020d}/{}".format(MAX_ORDER_SIZE - size if settings.ORDER == settings.LARGEST_FIRST_ORDER else size, get_document_id(pdf))
+
+
+def is_ordered():
+    """ Check that outputs start with ORDER_COLUMN: shards without --dedup, which can be merged """
+    return bool(settings.SHARD) and not settings.DEDUP
+
+
+def get_output_columns(outputs):
+    """ outputs ((path, name, columns), ...) with ORDER_COLUMN if is_ordered() """
+    return [(path, name, (ORDER_COLUMN,) + columns) for path, name, columns in outputs] if is_ordered() else outputs
+
+
+def in_shard(pdf):
+    """ Check that pdf belongs to settings.SHARD, by hash of its id (hash() differs between processes) """
+    number, count = settings.SHARD
+    digest = hashlib.sha1(get_document_id(pdf).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1 == number
+
+
+def shard_pdfs(sized):
+    """ Yield (path, size) of sized PDFs that belong to settings.SHARD, all of them without --shard """
+    return sized if not settings.SHARD else (pdf for pdf in sized if in_shard(pdf[0]))
+
+
+def check_pdfs(sized, append = False):
+    """ Yield (path, size) of sized PDFs passing utils.check_pdf, others are reported and saved in settings.REJECTED_FILE """
+    rejected = 0
+    with open(settings.REJECTED_FILE, 'a' if append else 'w', encoding=settings.OUTPUT_ENCODING, newline='') as rejected_file:
+        report = csv.writer(rejected_file, quoting=csv.QUOTE_ALL)
+        for pdf, size in sized:
+            reason = utils.check_pdf(pdf, size)
+            if reason is None:
+                yield pdf, size
+                continue
+            rejected += 1
+            metrics.increment('rejected_files')
+            settings.print_message("Skip '{}': {}".format(pdf, reason), 2)
+            logger.warning("Skip '{}': {}".format(pdf, reason))
+            report.writerow([pdf, reason])
+            rejected_file.flush()
+    if rejected:
+        settings.print_message("{} files are rejected without sending, see '{}'".format(rejected, settings.REJECTED_FILE))
+
+
+def skip_done(journal, pdfs):
+    """ Yield PDFs not saved in the journal as done """
+    done = 0
+    for pdf in pdfs:
+        if journal.is_done(pdf):
+            done += 1
+        else:
+            yield pdf
+    settings.print_message("Resume: {} files were already processed".format(done))
+    logger.info("Resume: {} files were already processed".format(done))
+
+
+def write_documents(pdfs, command, process, outputs):
+    """ Process PDFs and write their rows in outputs ((path, name, columns), ...), every finished PDF is saved in the journal """
+    if settings.WATCH:
+        watch_documents(pdfs, command, process, outputs)
+        return
+    with contextlib.ExitStack() as stack:
+        journal = stack.enter_context(checkpoint.Journal(settings.JOURNAL_FILE, settings.RESUME))
+        archive = None
+        if settings.ARCHIVE_FILE:
+            archive = stack.enter_context(teiarchive.TEIArchive(settings.ARCHIVE_FILE))
+            process = functools.partial(archive_data, archive, command, process)
+        if settings.RESUME:
+            pdfs = skip_done(journal, pdfs)
+        output_sinks = open_sinks(stack, outputs, settings.RESUME)
+        if settings.RESUME:
+            # Drop rows written after the last journaled document, they will be written again
+            for sink, position in zip(output_sinks, journal.output_sizes or [0] * len(output_sinks)):
+                sink.truncate(position)
+        scholar_output = open_enricher(stack, outputs, settings.RESUME)
+        write_rows(output_sinks, enrich_documents(scholar_output, iterate_documents(pdfs, command, process), outputs), journal, archive, is_ordered())
+
+
+def get_rotated_path(path, opened):
+    """ Output path with the time it was opened in --watch mode: out.csv -> out-20240131-235959.csv """
+    return "{0}-{2}{1}".format(*os.path.splitext(path), time.strftime("%Y%m%d-%H%M%S", time.localtime(opened)))
+
+
+def stop_watch(signum, frame):
+    raise KeyboardInterrupt("signal {}".format(signum))
+
+
+def watch_documents(pdfs, command, process, outputs):
+    """ Process PDFs, then new PDFs of settings.PDFS_PATH in batches as they come, until the process is stopped.
+        Grobid client and TEI cache stay open between batches, output files are replaced by new ones every
+        settings.WATCH_ROTATE seconds. PDFs saved in the journal are skipped, so restart goes on where it stopped """
+    # Service managers stop daemons with SIGTERM, outputs are flushed like on Ctrl+C
+    signal.signal(signal.SIGTERM, stop_watch)
+    with contextlib.ExitStack() as stack:
+        # Watched before PDFs are listed, so files coming in between are not missed
+        watcher = stack.enter_context(pdfwatch.open_watcher(settings.PDFS_PATH, settings.WATCH_POLL_INTERVAL))
+        settings.print_message("Watch '{}' with {}".format(settings.PDFS_PATH, "inotify" if isinstance(watcher, pdfwatch.InotifyWatcher) else "listing every {} seconds".format(watcher.interval)))
+        journal = stack.enter_context(checkpoint.Journal(settings.JOURNAL_FILE, resume=True))
+        archive = None
+        if settings.ARCHIVE_FILE:
+            archive = stack.enter_context(teiarchive.TEIArchive(settings.ARCHIVE_FILE))
+            process = functools.partial(archive_data, archive, command, process)
+        engine = open_engine(command)
+        client = engine[2]
+        if client is not None:
+            stack.enter_context(client)
+        # Enricher stays open between batches, its counts sink is rotated with the outputs
+        enricher = stack.enter_context(create_enricher()) if is_enriched(outputs) else None
+        scholar_output = None
+        batches = pdfwatch.iterate_batches(watcher, settings.WATCH_BATCH_DELAY, settings.WATCH_BATCH_SIZE)
+        output_stack = output_sinks = None
+        rotate_time = 0
+        try:
+            # PDFs already in the dir are the first batch
+            for number, batch in enumerate(itertools.chain([skip_done(journal, pdfs)], batches)):
+                if number:
+                    # Files written again come again, unchanged ones are skipped by the journal
+                    batch = [pdf for pdf, size in check_pdfs(shard_pdfs(batch), append=True) if not journal.is_done(pdf)]
+                    if not batch:
+                        continue
+                    metrics.increment('batches')
+                    settings.print_message("Batch #{}: {} new PDFs".format(number, len(batch)))
+                    logger.info("Batch #{}: {} new PDFs".format(number, len(batch)))
+                if output_sinks is None or settings.WATCH_ROTATE and time.time() >= rotate_time:
+                    if output_stack is not None:
+                        output_stack.close()
+                    opened = time.time()
+                    rotated = [(get_rotated_path(path, opened), name, columns) for path, name, columns in outputs]
+                    output_stack = stack.enter_context(contextlib.ExitStack())
+                    output_sinks = open_sinks(output_stack, rotated)
+                    paths = [path for path, name, columns in rotated]
+                    if enricher is not None:
+                        scholar_output = enricher, open_counts(output_stack, enricher, rotated)
+                        paths.append(get_scholar_path(get_references_path(rotated)))
+                    rotate_time = opened + settings.WATCH_ROTATE
+                    settings.print_message("Output files: {}".format(", ".join(paths)))
+                write_rows(output_sinks, enrich_documents(scholar_output, iterate_documents(batch, command, process, engine), outputs), journal, archive, is_ordered())
+        except KeyboardInterrupt:
+            settings.print_message("Watch is stopped")
+            logger.info("Watch is stopped")
+            if enricher is not None:
+                # Counts of lookups in progress are written in the last counts file
+                enricher.stop(wait=True)
+
+
+def reparse_document(task):
+    """ Process pool task: convert archived TEI to output rows, returns (pdf, rows, error, metrics of the task) """
+    get_rows, pdf, blob = task
+    try:
+        rows, error = process_data(get_rows, pdf, teiarchive.decompress(blob)), None
+    except:
+        rows, error = None, traceback.format_exc()
+    return pdf, rows, error, metrics.METRICS.take()
+
+
+def iterate_archive(archive, command, get_rows):
+    """ Convert TEI from archive to rows in a process pool and yield (pdf, None, future) in the order of archive """
+    processes = settings.WORKERS if settings.WORKERS > 1 else os.cpu_count()
+    with multiprocessing.Pool(processes, initializer=metrics.reset) as pool:
+        tasks = ((get_rows, pdf, blob) for pdf, blob in archive.iterate(command))
+        for pdf, rows, error, task_metrics in pool.imap(reparse_document, tasks, chunksize=REPARSE_CHUNK_SIZE):
+            metrics.METRICS.add(task_metrics)
+            future = concurrent.futures.Future()
+            if error is None:
+                future.set_result(rows)
+            else:
+                future.set_exception(Exception(error))
+            yield pdf, None, future
+
+
+def reparse_documents(command, get_rows, outputs):
+    """ Rebuild output files from TEI archive without sending anything to grobid """
+    with contextlib.ExitStack() as stack:
+        archive = stack.enter_context(teiarchive.TEIArchive(settings.REPARSE_FILE))
+        settings.print_message("Reparse {} documents from '{}'".format(archive.count(command), settings.REPARSE_FILE))
+        output_sinks = open_sinks(stack, outputs)
+        write_rows(output_sinks, enrich_documents(open_enricher(stack, outputs), iterate_archive(archive, command, get_rows), outputs), order=is_ordered())
+
+
+def processHeaderDocument():
+    outputs = [(settings.OUTPUT_FILE, HEADERS_OUTPUT, HEADER_COLUMNS)]
+    if settings.REPARSE_FILE:
+        reparse_documents(settings.GROBID_PROCESSED_HEADER_COMMAND, get_header_rows, outputs)
+        return
+    pdfs = discover_pdfs()
+    write_documents(pdfs, settings.GROBID_PROCESSED_HEADER_COMMAND, functools.partial(process_data, get_header_rows), outputs)
+
+
+def processReferencesDocument():
+    outputs = [(settings.OUTPUT_FILE, REFERENCES_OUTPUT, REFERENCE_COLUMNS)]
+    if settings.REPARSE_FILE:
+        reparse_documents(settings.GROBID_PROCESSED_REFERENCES_COMMAND, functools.partial(get_references_rows, with_keys=settings.DEDUP), outputs)
+        return
+    pdfs = discover_pdfs()
+    if settings.STREAMING:
+        process = functools.partial(process_stream, with_keys=settings.DEDUP)
+    else:
+        process = functools.partial(process_data, functools.partial(get_references_rows, with_keys=settings.DEDUP))
+    write_documents(pdfs, settings.GROBID_PROCESSED_REFERENCES_COMMAND, process, outputs)
+
+
+def processFulltextDocument():
+    """ Headers in settings.OUTPUT_FILE and references in settings.REFERENCES_OUTPUT_FILE from one grobid call per PDF """
+    outputs = [(settings.OUTPUT_FILE, HEADERS_OUTPUT, HEADER_COLUMNS), (settings.REFERENCES_OUTPUT_FILE, REFERENCES_OUTPUT, REFERENCE_COLUMNS)]
+    if settings.REPARSE_FILE:
+        reparse_documents(settings.GROBID_PROCESSED_FULLTEXT_COMMAND, functools.partial(get_fulltext_rows, with_keys=settings.DEDUP), outputs)
+        return
+    pdfs = discover_pdfs()
+    write_documents(pdfs, settings.GROBID_PROCESSED_FULLTEXT_COMMAND, functools.partial(process_data, functools.partial(get_fulltext_rows, with_keys=settings.DEDUP)), outputs)
+
+
+def merge_shards(path, name, columns):
+    """ Join outputs of settings.MERGE_SHARDS shard runs in path, reading all of them at once row by row. Rows are merged
+        by ORDER_COLUMN of shards, which is dropped, so the output is in the order of one run with the same --order """
+    paths = get_shard_paths(path)
+    rows = heapq.merge(*[sinks.read_rows(settings.OUTPUT_FORMAT, shard, name, (ORDER_COLUMN,) + columns) for shard in paths], key=operator.itemgetter(0))
+    count = 0
+    with sinks.open_sink(settings.OUTPUT_FORMAT, path, name, columns) as sink:
+        for row in rows:
+            sink.write(row[1:])
+            count += 1
+            if sink.commit():
+                sink.flush()
+    settings.print_message("{} rows of {} shards are merged in '{}'".format(count, len(paths), path))
+    logger.info("{} rows of {} shards are merged in '{}'".format(count, len(paths), path))
+
+
+def get_shard_paths(path):
+    return [settings.get_shard_path(path, number, settings.MERGE_SHARDS) for number in range(1, settings.MERGE_SHARDS + 1)]
+
+
+def mergeShards():
+    """ merge command: outputs of --shard runs in settings.OUTPUT_FILE (and settings.REFERENCES_OUTPUT_FILE for -a) """
+    settings.print_message("Command: merge {} shards of {}".format(settings.MERGE_SHARDS, {settings.PROCESS_HEADER_MODE: "headers", settings.PROCESS_REFERENCES_MODE: "references", settings.PROCESS_FULLTEXT_MODE: "headers and references"}[settings.MODE]))
+    settings.print_message("Output format: {}".format(settings.OUTPUT_FORMAT))
+    if settings.DEDUP:
+        settings.print_message("ref_id of --dedup shards are not the same, their outputs can't be merged, exit.")
+        return
+    if not sinks.is_available(settings.OUTPUT_FORMAT):
+        settings.print_message("pyarrow is needed for {} output, exit.".format(settings.OUTPUT_FORMAT))
+        return
+    if settings.MODE == settings.PROCESS_HEADER_MODE:
+        outputs = [(settings.OUTPUT_FILE, HEADERS_OUTPUT, HEADER_COLUMNS)]
+    elif settings.MODE == settings.PROCESS_FULLTEXT_MODE:
+        outputs = [(settings.OUTPUT_FILE, HEADERS_OUTPUT, HEADER_COLUMNS), (settings.REFERENCES_OUTPUT_FILE, REFERENCES_OUTPUT, REFERENCE_COLUMNS)]
+    else:
+        outputs = [(settings.OUTPUT_FILE, REFERENCES_OUTPUT, REFERENCE_COLUMNS)]
+    missing = [shard for path, name, columns in outputs for shard in get_shard_paths(path) if not os.path.exists(shard)]
+    if missing:
+        settings.print_message("No shard outputs {}, exit.".format(", ".join(missing)))
+        return
+    for path, name, columns in outputs:
+        merge_shards(path, name, columns)
+
 
 def main():
-    settings.print_message("Command: process headers" if settings.MODE == settings.PROCESS_HEADER_MODE else "Command: process references")
-    settings.print_message("PDFs dir: {}".format(settings.PDFS_PATH))
+    if settings.MERGE_SHARDS:
+        mergeShards()
+        return
+    settings.print_message("Command: process {}".format({settings.PROCESS_HEADER_MODE: "headers", settings.PROCESS_REFERENCES_MODE: "references", settings.PROCESS_FULLTEXT_MODE: "headers and references"}[settings.MODE]))
+    settings.print_message("PDFs dir: {}".format(settings.PDFS_PATH) if not settings.REPARSE_FILE else "Reparse TEI archive: {}".format(settings.REPARSE_FILE))
     settings.print_message("Output file: {}".format(settings.OUTPUT_FILE))
+    if settings.SHARD:
+        settings.print_message("Shard: {} of {}".format(*settings.SHARD))
+    settings.print_message("Output format: {}".format(settings.OUTPUT_FORMAT))
+    if settings.MODE == settings.PROCESS_FULLTEXT_MODE:
+        settings.print_message("References output file: {}".format(settings.REFERENCES_OUTPUT_FILE))
+    if settings.DEDUP:
+        settings.print_message("Cited works: {}, index: {}".format(get_works_path(settings.REFERENCES_OUTPUT_FILE if settings.MODE == settings.PROCESS_FULLTEXT_MODE else settings.OUTPUT_FILE),
+            settings.REFERENCE_INDEX or "this run"))
+    if settings.SCHOLAR and settings.MODE != settings.PROCESS_HEADER_MODE:
+        settings.print_message("Scholar counts: at most {} requests per minute, cache {} ({} days)".format(settings.SCHOLAR_RATE * 60, settings.SCHOLAR_CACHE, settings.SCHOLAR_TTL / 86400))
+    settings.print_message("Grobid servers: {}".format(", ".join(settings.GROBID_SERVERS)))
     settings.print_message("Using TOR: {}".format(settings.USING_TOR_BROWSER))
-    start_time = datetime.now()
+    if settings.USING_TOR_BROWSER:
+        settings.print_message("TOR circuits: {}, reset identity every {} requests".format(settings.TOR_CIRCUITS, settings.TOR_ROTATE_EVERY or "-"))
+    settings.print_message("Engine: {}".format(settings.ENGINE))
+    settings.print_message("Workers: {}".format(settings.WORKERS))
+    if not settings.REPARSE_FILE:
+        settings.print_message("Order: {}".format(settings.ORDER))
+        settings.print_message("Watch: {}".format("new output files every {:g} minutes".format(settings.WATCH_ROTATE / 60) if settings.WATCH and settings.WATCH_ROTATE else settings.WATCH))
+    settings.print_message("TEI cache: {}".format(settings.CACHE_PATH))
+    settings.print_message("Resume: {}".format(settings.RESUME))
     if settings.MODE == settings.PROCESS_HEADER_MODE:
-        processHeaderDocument()
-    else:
-        processReferencesDocument()
+        settings.print_message("Header pages: {}".format(settings.HEADER_PAGES or "all"))
+        if settings.HEADER_PAGES and not pdftrim.is_available():
+            settings.print_message("pypdf is not installed, whole PDFs are sent", 2)
+    settings.print_message("TEI archive: {}".format(settings.ARCHIVE_FILE))
+    if settings.MODE == settings.PROCESS_REFERENCES_MODE:
+        settings.print_message("Streaming: {}".format(settings.STREAMING))
+    if settings.METRICS_PORT:
+        settings.print_message("Metrics: http://{}:{}/metrics".format(settings.METRICS_HOST, settings.METRICS_PORT))
+    if settings.METRICS_FILE:
+        settings.print_message("Metrics file: {}, updated every {} seconds".format(settings.METRICS_FILE, settings.METRICS_INTERVAL))
+    if not sinks.is_available(settings.OUTPUT_FORMAT):
+        settings.print_message("pyarrow is needed for {} output, exit.".format(settings.OUTPUT_FORMAT))
+        return
+    metrics.start_exporters(settings.METRICS_PORT, settings.METRICS_FILE, settings.METRICS_INTERVAL, settings.METRICS_HOST)
+    start_time = datetime.now()
+    try:
+        if settings.MODE == settings.PROCESS_HEADER_MODE:
+            processHeaderDocument()
+        elif settings.MODE == settings.PROCESS_FULLTEXT_MODE:
+            processFulltextDocument()
+        else:
+            processReferencesDocument()
+    finally:
+        utils.close_tor_pool()
+        metrics.stop_exporters()
     end_time = datetime.now()
     settings.print_message("Run began on {0}".format(start_time))
     settings.print_message("Run ended on {0}".format(end_time))
     settings.print_message("Elapsed time was: {0}".format(end_time - start_time))
+    stages = metrics.METRICS.snapshot()["stages"]
+    settings.print_message("Time in stages: {}".format(", ".join("{} {:.2f}s".format(stage, stages[stage]["sum"]) for stage in metrics.STAGES)))
 
 if __name__ == "__main__":
+    settings.configure()
     main()
\ No newline at end of file
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+import time
+import random
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Limit is multiplied by this factor when server is overloaded
+DECREASE_FACTOR = 0.5
+# Recent latency above this number of long-term latencies is treated as overload, latencies are per MB of request body
+LATENCY_TOLERANCE = 2.0
+# Min seconds between decreases of callers that don't report generation, until latency is known
+MIN_DECREASE_INTERVAL = 1.0
+# Weight of the last request in recent and long-term latency, documents differ in size so both are averaged
+LATENCY_SMOOTHING = 0.1
+BASELINE_SMOOTHING = 0.01
+# Weights of the last request in seconds per MB and in its deviation, timeout is their sum with deviation
+# taken TIMEOUT_DEVIATION_FACTOR times, like TCP retransmission timeout
+RATE_SMOOTHING = 0.125
+DEVIATION_SMOOTHING = 0.25
+TIMEOUT_DEVIATION_FACTOR = 4
+# Fixed cost of a request in MB, so small files don't get tiny timeouts
+REQUEST_OVERHEAD_MB = 1.0
+MB = 1024 * 1024
+
+
+def get_backoff(attempt, base, cap):
+    """ Exponential backoff with full jitter for retry number attempt (from 0) """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AIMDLimiter(object):
+    """ Concurrency limit with additive increase / multiplicative decrease by server overload and latency """
+    def __init__(self, max_limit, min_limit = 1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.latency = None
+        self.baseline_latency = None
+        self._last_decrease = 0
+        # Number of decreases, requests sent before the last one don't decrease the limit again
+        self.generation = 0
+        self._cond = threading.Condition()
+
+
+    def _update(self, overloaded, latency, generation = None, size = None):
+        """ Adjust limit after request sent in generation, called under lock """
+        if latency is None and not overloaded:
+            # Request failed without answer, it tells nothing about load
+            return
+        if latency is not None and not overloaded:
+            if size is not None:
+                # Large PDFs take longer without any overload
+                latency = latency / (REQUEST_OVERHEAD_MB + size / MB)
+            if self.latency is None:
+                self.latency = self.baseline_latency = latency
+            self.latency = (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+            self.baseline_latency = (1 - BASELINE_SMOOTHING) * self.baseline_latency + BASELINE_SMOOTHING * latency
+            overloaded = self.latency > LATENCY_TOLERANCE * self.baseline_latency
+        if overloaded:
+            # Requests sent before the last decrease report the same overload
+            now = time.time()
+            if generation is not None:
+                if generation < self.generation:
+                    return
+            elif now - self._last_decrease < (self.latency if self.latency is not None else MIN_DECREASE_INTERVAL):
+                return
+            self._last_decrease = now
+            self.generation += 1
+            old_limit = self.limit
+            self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+            if self.latency is not None:
+                # Give the smaller limit time to bring latency down
+                self.latency = self.baseline_latency
+            logger.debug("Server overloaded, concurrency limit {:.1f} -> {:.1f}".format(old_limit, self.limit))
+        else:
+            # One more request in flight per limit successful requests
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+
+    def acquire(self):
+        """ Wait for a free slot, returns generation of the request for release() """
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            return self.generation
+
+
+    def release(self, overloaded = False, latency = None, generation = None, size = None):
+        """ Report result of request: overloaded if server refused it or timed out, latency in seconds if server answered
+            (None if request failed), generation returned by acquire(), size of request body in bytes to compare latency per MB """
+        with self._cond:
+            self.in_flight -= 1
+            self._update(overloaded, latency, generation, size)
+            self._cond.notify_all()
+
+
+class AsyncAIMDLimiter(AIMDLimiter):
+    """ AIMDLimiter for coroutines of one event loop """
+    def __init__(self, max_limit, min_limit = 1):
+        super(AsyncAIMDLimiter, self).__init__(max_limit, min_limit)
+        self._async_cond = asyncio.Condition()
+
+
+    async def acquire(self):
+        async with self._async_cond:
+            while self.in_flight >= int(self.limit):
+                await self._async_cond.wait()
+            self.in_flight += 1
+            return self.generation
+
+
+    async def release(self, overloaded = False, latency = None, generation = None, size = None):
+        async with self._async_cond:
+            self.in_flight -= 1
+            self._update(overloaded, latency, generation, size)
+            self._async_cond.notify_all()
+
+
+class TokenBucket(object):
+    """ Rate limit of rate requests per second on average with bursts of up to capacity requests """
+    def __init__(self, rate, capacity = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+
+    def acquire(self, cancel = None):
+        """ Wait for a token, returns False if cancel (threading.Event) was set before """
+        while cancel is None or not cancel.is_set():
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._time) * self.rate)
+                self._time = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if cancel is None:
+                time.sleep(wait)
+            else:
+                cancel.wait(wait)
+        return False
+
+
+    def pause(self, seconds):
+        """ Give no tokens for at least seconds """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._time) * self.rate, 1 - seconds * self.rate)
+            self._time = now
+
+
+class TimeoutEstimator(object):
+    """ Request timeout for body size from seconds per MB seen in successful requests """
+    def __init__(self, initial, initial_seconds_per_mb, min_timeout, max_timeout):
+        self.initial = initial
+        self.initial_seconds_per_mb = initial_seconds_per_mb
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.seconds_per_mb = None
+        self.deviation = None
+        self._lock = threading.Lock()
+
+
+    def timeout(self, size, timeouts = 0):
+        """ Timeout of request with size bytes, doubled for every time the request already timed out """
+        with self._lock:
+            if self.seconds_per_mb is None:
+                timeout = self.initial + self.initial_seconds_per_mb * size / MB
+            else:
+                timeout = (self.seconds_per_mb + TIMEOUT_DEVIATION_FACTOR * self.deviation) * (REQUEST_OVERHEAD_MB + size / MB)
+        return min(self.max_timeout, max(self.min_timeout, timeout * 2 ** timeouts))
+
+
+    def observe(self, size, latency):
+        """ Report latency of successful request with size bytes """
+        seconds_per_mb = latency / (REQUEST_OVERHEAD_MB + size / MB)
+        with self._lock:
+            if self.seconds_per_mb is None:
+                self.seconds_per_mb = seconds_per_mb
+                self.deviation = seconds_per_mb / 2
+            else:
+                self.deviation = (1 - DEVIATION_SMOOTHING) * self.deviation + DEVIATION_SMOOTHING * abs(seconds_per_mb - self.seconds_per_mb)
+                self.seconds_per_mb = (1 - RATE_SMOOTHING) * self.seconds_per_mb + RATE_SMOOTHING * seconds_per_mb
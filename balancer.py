@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import contextlib
+import logging
+#
+import requests
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def parse_server(server):
+    """ Split 'URL[@weight]' to (url, weight), url always ends with '/' """
+    url, weight = server, 1.0
+    if '@' in server.rsplit('/', 1)[-1]:
+        url, weight = server.rsplit('@', 1)
+        weight = float(weight)
+    return url if url.endswith('/') else url + '/', weight
+
+
+class Endpoint(object):
+    """ One grobid server with own concurrency limiter and circuit breaker """
+    def __init__(self, url, weight, limiter):
+        self.url = url
+        self.weight = weight
+        self.limiter = limiter
+        self.outstanding = 0
+        self.failures = 0
+        # Circuit breaker is open (endpoint out of rotation) until this time
+        self.open_until = 0
+
+
+    def is_available(self, now):
+        return self.open_until <= now
+
+
+class Balancer(object):
+    """ Routes requests to the endpoint with least outstanding requests per weight,
+        endpoints failing failure_threshold times in a row are out of rotation for open_time seconds """
+    def __init__(self, servers, make_limiter, failure_threshold, open_time):
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        self.endpoints = list()
+        for server in servers:
+            url, weight = parse_server(server)
+            self.endpoints.append(Endpoint(url, weight, make_limiter()))
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._probe_thread = None
+
+
+    def _choose(self):
+        now = time.time()
+        with self._lock:
+            available = [endpoint for endpoint in self.endpoints if endpoint.is_available(now)]
+            if available:
+                endpoint = min(available, key=lambda endpoint: (endpoint.outstanding + 1) / endpoint.weight)
+            else:
+                # Everything is down, try the endpoint that comes back first
+                endpoint = min(self.endpoints, key=lambda endpoint: endpoint.open_until)
+            endpoint.outstanding += 1
+            return endpoint
+
+
+    def _release(self, endpoint):
+        with self._lock:
+            endpoint.outstanding -= 1
+
+
+    @contextlib.contextmanager
+    def endpoint(self):
+        """ Choose endpoint for one request """
+        endpoint = self._choose()
+        try:
+            yield endpoint
+        finally:
+            self._release(endpoint)
+
+
+    def report(self, endpoint, ok):
+        """ Save result of request to endpoint: ok if server answered """
+        with self._lock:
+            if ok:
+                endpoint.failures = 0
+                endpoint.open_until = 0
+                return
+            endpoint.failures += 1
+            # Endpoint back after open_time needs only one more failure to go out again
+            if endpoint.failures >= self.failure_threshold:
+                endpoint.open_until = time.time() + self.open_time
+                logger.warning("Grobid server '{}' is out of rotation for {} seconds".format(endpoint.url, self.open_time))
+
+
+    def probe(self, isalive_command, timeout):
+        """ Check every endpoint with grobid isalive request """
+        for endpoint in self.endpoints:
+            try:
+                response = requests.get("{}{}".format(endpoint.url, isalive_command), timeout=timeout)
+                ok = response.status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            logger.debug("Grobid server '{}' is alive: {}".format(endpoint.url, ok))
+            if ok:
+                self.report(endpoint, True)
+            else:
+                with self._lock:
+                    endpoint.failures = max(endpoint.failures + 1, self.failure_threshold)
+                    endpoint.open_until = time.time() + self.open_time
+
+
+    def start_probes(self, isalive_command, interval, timeout):
+        """ Probe endpoints every interval seconds in background thread """
+        def run():
+            while not self._stop.wait(interval):
+                self.probe(isalive_command, timeout)
+        self._probe_thread = threading.Thread(target=run, name="grobid-health-probe", daemon=True)
+        self._probe_thread.start()
+
+
+    def close(self):
+        self._stop.set()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+""" Throughput benchmark of GrobidService.py against a local stand-in of grobid serving recorded TEI.
+
+    python benchmark.py -i .\\PDFs --fixtures cache_dir --latency 0.5 --config="-s -w 1" --config="-s -w 8 -e async"
+
+    Every --config is a separate GrobidService.py run over the same PDFs, results are printed as JSON.
+    "{tmpdir}" in a config is replaced by a temporary dir shared by all configs (e.g. for a warm TEI cache). """
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import zlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+_main_dir = os.path.dirname(os.path.abspath(__file__))
+
+SYNTHETIC_TEI = '''<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><fileDesc>
+<titleStmt><title level="a" type="main">Benchmark document</title></titleStmt>
+<publicationStmt><date type="published" when="2017"/></publicationStmt>
+<sourceDesc><biblStruct><analytic><author><persName><forename type="first">Jane</forename><surname>Doe</surname></persName></author></analytic>
+<monogr><imprint/></monogr><idno type="DOI">10.0000/benchmark</idno></biblStruct></sourceDesc></fileDesc>
+<profileDesc><abstract><p>Abstract</p></abstract></profileDesc></teiHeader>
+<text><back><div><listBibl>{}</listBibl></div></back></text></TEI>'''
+
+SYNTHETIC_REFERENCE = '''<biblStruct><analytic><title level="a" type="main">Reference {0}</title>
+<author><persName><forename type="first">John</forename><surname>Smith{0}</surname></persName></author></analytic>
+<monogr><title level="j">Journal</title><imprint><biblScope unit="page" from="1" to="10"/><date type="published" when="2001"/></imprint></monogr></biblStruct>'''
+
+
+def load_fixtures(path, references):
+    """ Load TEI from dir of *.tei/*.xml files (e.g. TEI cache) or from a TEI archive, synthetic TEI if path is None """
+    if not path:
+        return [SYNTHETIC_TEI.format("".join(SYNTHETIC_REFERENCE.format(i) for i in range(references))).encode('utf-8')]
+    if os.path.isfile(path):
+        connection = sqlite3.connect(path)
+        try:
+            return [zlib.decompress(blob) for blob, in connection.execute("SELECT data FROM tei")]
+        finally:
+            connection.close()
+    fixtures = list()
+    for root, dirnames, filenames in os.walk(path):
+        for filename in sorted(filenames):
+            if filename.endswith(('.tei', '.xml')):
+                with open(os.path.join(root, filename), 'rb') as tei_file:
+                    fixtures.append(tei_file.read())
+    return fixtures
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class StubGrobid(object):
+    """ Local HTTP stand-in of grobid API with configurable latency, 503 rate and capacity """
+    def __init__(self, fixtures, latency, jitter, error_rate, capacity):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.reset()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body = b''):
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._send(200, b'benchmark' if self.path.endswith('version') else b'true')
+
+            def do_POST(self):
+                start_time = time.time()
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                status, body = stub.handle()
+                self._send(status, body)
+                stub.record(status, time.time() - start_time, len(body))
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}/api/'.format(self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+
+    def reset(self):
+        with self.lock:
+            self.in_flight = 0
+            self.latencies = list()
+            self.overloaded = 0
+
+
+    def handle(self):
+        with self.lock:
+            busy = (self.capacity and self.in_flight >= self.capacity) or random.random() < self.error_rate
+            if busy:
+                return 503, b''
+            self.in_flight += 1
+            fixture = random.randrange(len(self.fixtures))
+        try:
+            time.sleep(max(0, random.gauss(self.latency, self.jitter)))
+            return 200, self.fixtures[fixture]
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+    def record(self, status, latency, size):
+        with self.lock:
+            if status == 200:
+                self.latencies.append(latency)
+            else:
+                self.overloaded += 1
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def load_metrics(path):
+    """ Metrics file written by GrobidService.py at exit """
+    if not os.path.exists(path):
+        return {"counters": {}, "stages": {}}
+    with open(path, 'r', encoding='utf-8') as metrics_file:
+        return json.load(metrics_file)
+
+
+def run_process(args, stderr_file):
+    """ Run process, returns exit code and its peak RSS in kB (None if not available) """
+    process = subprocess.Popen(args, cwd=_main_dir, stdout=subprocess.DEVNULL, stderr=stderr_file)
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    pid, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in bytes on macOS
+    return process.returncode, usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def run_config(stub, config, pdfs_path, tmpdir, number):
+    """ Run GrobidService.py with config args, returns result dict """
+    stub.reset()
+    metrics_file = os.path.join(tmpdir, "run{}.metrics.json".format(number))
+    args = [sys.executable, os.path.join(_main_dir, "GrobidService.py"), "-l", os.path.join(tmpdir, "run{}.log".format(number)),
+            "-i", pdfs_path, "-o", os.path.join(tmpdir, "run{}.csv".format(number)), "--server", stub.url,
+            "--metrics-file", metrics_file] + config.replace("{tmpdir}", tmpdir).split()
+    with tempfile.TemporaryFile() as stderr_file:
+        start_time = time.time()
+        exit_code, peak_rss = run_process(args, stderr_file)
+        elapsed = time.time() - start_time
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode('utf-8', 'replace')[-2000:] if exit_code else ""
+    run_metrics = load_metrics(metrics_file)
+    done = run_metrics["counters"].get("documents", 0)
+    with stub.lock:
+        latencies = list(stub.latencies)
+        overloaded = stub.overloaded
+    return {
+        "config": config,
+        "exit_code": exit_code,
+        "stderr": stderr,
+        "elapsed_seconds": elapsed,
+        "documents": done,
+        "failed_documents": run_metrics["counters"].get("failed_documents", 0),
+        "docs_per_second": done / elapsed if elapsed else None,
+        "requests": len(latencies),
+        "overloaded_requests": overloaded,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "peak_rss_kb": peak_rss,
+        "tei_to_dict_seconds": run_metrics["stages"].get("parse", {}).get("sum"),
+        "stages": run_metrics["stages"],
+        "counters": run_metrics["counters"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark GrobidService.py against a local grobid stand-in")
+    parser.add_argument("-i", "--inputdir", dest="INPUT_DIR", help="Dir with PDF's", default=os.path.join(_main_dir, "PDFs"))
+    parser.add_argument("--fixtures", dest="FIXTURES", help="Dir with recorded TEI (*.tei, *.xml, e.g. TEI cache) or TEI archive, synthetic TEI if not set", default=None)
+    parser.add_argument("--references", dest="REFERENCES", help="Number of references in synthetic TEI", type=int, default=50)
+    parser.add_argument("--latency", dest="LATENCY", help="Mean grobid latency in seconds", type=float, default=0.5)
+    parser.add_argument("--jitter", dest="JITTER", help="Standard deviation of grobid latency in seconds", type=float, default=0.1)
+    parser.add_argument("--error-rate", dest="ERROR_RATE", help="Share of requests answered with HTTP 503", type=float, default=0.0)
+    parser.add_argument("--capacity", dest="CAPACITY", help="Requests processed at once, others get HTTP 503 (0: no limit)", type=int, default=0)
+    parser.add_argument("--config", dest="CONFIGS", help="GrobidService.py args of one run, repeat to compare", action="append", default=None)
+    parser.add_argument("-o", "--output", dest="OUTPUT_FILE", help="JSON results file (default: stdout)", default=None)
+    args = parser.parse_args()
+    fixtures = load_fixtures(args.FIXTURES, args.REFERENCES)
+    if not fixtures:
+        parser.error("no TEI fixtures in '{}'".format(args.FIXTURES))
+    stub = StubGrobid(fixtures, args.LATENCY, args.JITTER, args.ERROR_RATE, args.CAPACITY)
+    results = {
+        "pdfs": os.path.abspath(args.INPUT_DIR),
+        "fixtures": len(fixtures),
+        "fixture_bytes": sum(len(fixture) for fixture in fixtures),
+        "latency": args.LATENCY,
+        "jitter": args.JITTER,
+        "error_rate": args.ERROR_RATE,
+        "capacity": args.CAPACITY,
+        "runs": list(),
+    }
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for number, config in enumerate(args.CONFIGS or ["-s"]):
+                results["runs"].append(run_config(stub, config, os.path.abspath(args.INPUT_DIR), tmpdir, number))
+    finally:
+        stub.close()
+    output = json.dumps(results, indent=2)
+    if args.OUTPUT_FILE:
+        with open(args.OUTPUT_FILE, 'w', encoding='utf-8') as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
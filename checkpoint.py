@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import logging
+#
+import utils
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+def get_fingerprint(pdf):
+    """ {"sha256", "size", "mtime"} of pdf for the journal, values that can't be read (file is removed) are None """
+    fingerprint = dict.fromkeys(("sha256", "size", "mtime"))
+    try:
+        stat = os.stat(pdf)
+        fingerprint["size"], fingerprint["mtime"] = stat.st_size, stat.st_mtime
+        fingerprint["sha256"] = utils.get_sha256(pdf)
+    except OSError as error:
+        logger.warning("Can't read '{}': {}".format(pdf, error))
+    return fingerprint
+
+
+class Journal(object):
+    """ Append-only journal of processed PDFs, lets an interrupted run resume where it stopped """
+    def __init__(self, path, resume = False):
+        self.path = path
+        # PDF path -> last journal record
+        self.entries = dict()
+        # Positions of outputs (sinks.Sink.tell: file size or rows) after the last journaled document
+        self.output_sizes = None
+        if resume and os.path.exists(self.path):
+            self._load()
+        self._file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+
+
+    def _load(self):
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Last line of a crashed run may be cut off
+                    logger.debug("Skip broken journal line: '{}'".format(line.strip()))
+                    continue
+                self.entries[record["path"]] = record
+                self.output_sizes = record["output_sizes"]
+        logger.debug("Journal '{}': {} records, output sizes {}".format(self.path, len(self.entries), self.output_sizes))
+
+
+    def is_done(self, pdf):
+        """ Check that pdf was processed and didn't change since """
+        record = self.entries.get(pdf)
+        if not record or record["status"] != DONE:
+            return False
+        try:
+            stat = os.stat(pdf)
+        except OSError:
+            return False
+        if stat.st_size != record["size"]:
+            return False
+        if stat.st_mtime == record["mtime"]:
+            return True
+        # Touched but maybe not changed, compare content
+        try:
+            return utils.get_sha256(pdf) == record["sha256"]
+        except OSError:
+            return False
+
+
+    def record(self, pdf, status, output_sizes, fingerprint = None):
+        """ Save status of pdf, output_sizes are the positions of flushed outputs after it.
+            fingerprint of get_fingerprint is taken when pdf was sent, otherwise the file is read now """
+        if fingerprint is None:
+            fingerprint = get_fingerprint(pdf)
+        record = {"path": pdf, "status": status, "sha256": fingerprint["sha256"], "size": fingerprint["size"], "mtime": fingerprint["mtime"], "output_sizes": output_sizes}
+        self.entries[pdf] = record
+        self.output_sizes = output_sizes
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+
+    def close(self):
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
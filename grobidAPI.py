@@ -5,9 +5,13 @@ import codecs
 import logging
 from datetime import datetime
 import time
+import json
+import threading
 #
 import settings
 import utils
+import aimd
+import balancer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -16,6 +20,51 @@ class GrobidError(Exception): pass
 
 class ConnectionError(Exception): pass
 
-def get_data_from_grobid(command, pdf_file, using_TOR = False):
+BALANCER = None
+_BALANCER_LOCK = threading.Lock()
+
+def create_balancer(make_limiter):
+    """ Balancer over settings.GROBID_SERVERS with health probes, make_limiter() creates limiter of one server """
+    servers = balancer.Balancer(settings.GROBID_SERVERS, make_limiter, settings.BREAKER_FAILURES, settings.BREAKER_OPEN_TIME)
+    servers.start_probes(settings.GROBID_ISALIVE_COMMAND, settings.HEALTH_CHECK_INTERVAL, settings.DEFAULT_TIMEOUT)
+    return servers
+
+def get_balancer():
+    """ Return balancer shared by all grobid requests """
+    global BALANCER
+    with _BALANCER_LOCK:
+        if BALANCER is None:
+            BALANCER = create_balancer(lambda: aimd.AIMDLimiter(settings.WORKERS))
+        return BALANCER
+
+def get_data_from_grobid(command, pdf_file, using_TOR = False, binary = False):
     """ Send post request to grobid and returned data """
-    return utils.get_request("{}{}".format(settings.GROBID_SERVER, command), {'input': pdf_file}, using_TOR)
\ No newline at end of file
+    return utils.get_request(command, {'input': pdf_file}, using_TOR, binary, get_balancer())
+
+def get_server_version(url):
+    """ Return version of grobid service at url, None if it's unknown """
+    try:
+        response = utils.get_session().get("{}{}".format(url, settings.GROBID_VERSION_COMMAND), timeout=settings.DEFAULT_TIMEOUT)
+        if response.status_code == 200:
+            try:
+                return str(json.loads(response.text)["version"])
+            except (ValueError, KeyError, TypeError):
+                return response.text.strip() or None
+        logger.warning("Can't get grobid version of %s: HTTP %d - %s" % (url, response.status_code, response.reason))
+    except requests.exceptions.RequestException as error:
+        logger.warning("Can't get grobid version of %s: %s" % (url, error))
+    return None
+
+def get_grobid_version():
+    """ Return version of grobid servers, used to tell apart TEI from different grobid releases.
+        None if version of a server is unknown or servers run different versions """
+    versions = dict()
+    for server in settings.GROBID_SERVERS:
+        url = balancer.parse_server(server)[0]
+        versions[url] = get_server_version(url)
+    if None in versions.values():
+        return None
+    if len(set(versions.values())) > 1:
+        logger.warning("Grobid servers run different versions: %s" % ", ".join("%s %s" % item for item in versions.items()))
+        return None
+    return versions[url]
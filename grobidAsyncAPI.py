@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import asyncio
+import threading
+import logging
+#
+import aiohttp
+#
+import settings
+import utils
+import grobidAPI
+import pdftrim
+import aimd
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+KEEPALIVE_TIMEOUT = 60
+
+
+async def _on_request_chunk_sent(session, context, params):
+    # Time of the last body chunk is the end of upload
+    if context.trace_request_ctx is not None:
+        context.trace_request_ctx["sent_time"] = time.time()
+
+
+class AsyncGrobidClient(object):
+    """ Sends PDFs to grobid from one asyncio event loop running in a background thread """
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="grobid-event-loop", daemon=True)
+        self._thread.start()
+        self.balancer = None
+        self.session = asyncio.run_coroutine_threadsafe(self._create_session(), self.loop).result()
+
+
+    async def _create_session(self):
+        # Limiters are created in the event loop, every server has own one
+        self.balancer = grobidAPI.create_balancer(lambda: aimd.AsyncAIMDLimiter(self.concurrency))
+        # Pool is sized to the concurrency limit and keeps connections to grobid alive between uploads
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_chunk_sent.append(_on_request_chunk_sent)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=settings.DEFAULT_TIMEOUT), trace_configs=[trace_config])
+
+
+    async def post(self, command, pdf, binary = False, data = None):
+        """ Send post request with PDF (or data instead of its content) to grobid & return data, as bytes if binary """
+        size = len(data) if data is not None else os.path.getsize(pdf)
+        retry = settings.DEFAULT_MAX_RETRIES
+        overload_retry = settings.OVERLOAD_MAX_RETRIES
+        attempt = 0
+        timeouts = 0
+        while retry > 0 and overload_retry > 0:
+            timeout = utils.TIMEOUTS.timeout(size, timeouts)
+            with self.balancer.endpoint() as endpoint:
+                generation = await endpoint.limiter.acquire()
+                start_time = time.time()
+                overloaded = False
+                # Latency of answered request, failed ones are not latency samples
+                latency = None
+                trace = {"sent_time": None}
+                metrics.increment('requests')
+                pdf_file = None
+                try:
+                    # PDF is streamed from its file by aiohttp, every attempt opens it again
+                    if data is None:
+                        pdf_file = open(pdf, 'rb')
+                    form = aiohttp.FormData()
+                    form.add_field('input', data if pdf_file is None else pdf_file, filename=os.path.split(pdf)[1], content_type='application/pdf')
+                    async with self.session.post("{}{}".format(endpoint.url, command), data=form, timeout=aiohttp.ClientTimeout(total=timeout), trace_request_ctx=trace) as response:
+                        self.balancer.report(endpoint, True)
+                        content = await response.read()
+                        latency = time.time() - start_time
+                        if trace["sent_time"] is not None:
+                            metrics.observe('upload', trace["sent_time"] - start_time)
+                            metrics.observe('grobid_wait', time.time() - trace["sent_time"])
+                            metrics.increment('uploaded_bytes', size)
+                        metrics.increment('downloaded_bytes', len(content))
+                        if response.status == 200:
+                            utils.TIMEOUTS.observe(size, time.time() - start_time)
+                            return content if binary else content.decode(response.get_encoding())
+                        if response.status in utils.OVERLOAD_STATUS_CODES:
+                            overloaded = True
+                            metrics.increment('overloads')
+                        else:
+                            raise Exception("HTTP %d - %s" % (response.status, response.reason))
+                        overload_retry = overload_retry - 1
+                        settings.print_message("server is overloaded: 'HTTP %d - %s'" % (response.status, response.reason), 2)
+                        logger.info("server is overloaded: 'HTTP %d - %s'" % (response.status, response.reason))
+                except asyncio.TimeoutError:
+                    overloaded = True
+                    metrics.increment('timeouts')
+                    self.balancer.report(endpoint, False)
+                    retry = retry - 1
+                    timeouts = timeouts + 1
+                    error = "request timeout after %.1f seconds" % timeout
+                    logger.debug("timeout from aiohttp")
+                    settings.print_message("timeout from aiohttp", 2)
+                    settings.print_message("ran into connection error: '%s'" % error, 2)
+                    logger.info("ran into connection error: '%s'" % error)
+                except aiohttp.ClientError as e:
+                    metrics.increment('connection_errors')
+                    self.balancer.report(endpoint, False)
+                    retry = retry - 1
+                    error = "request exception: %s" % e
+                    settings.print_message("ran into connection error: '%s'" % error, 2)
+                    logger.info("ran into connection error: '%s'" % error)
+                finally:
+                    if pdf_file is not None: pdf_file.close()
+                    await endpoint.limiter.release(overloaded, latency, generation, size)
+            if retry > 0 and overload_retry > 0:
+                sleep = aimd.get_backoff(attempt, settings.BACKOFF_BASE, settings.BACKOFF_MAX)
+                attempt = attempt + 1
+                metrics.increment('retries')
+                settings.print_message("retrying in %.1f seconds" % sleep, 2)
+                logger.info("retrying in %.1f seconds" % sleep)
+                await asyncio.sleep(sleep)
+
+
+    async def fetch(self, command, pdf, binary = False, pages = 0):
+        """ Send PDF to grobid, only the first pages if they are enough to find header """
+        trimmed = await self.loop.run_in_executor(None, metrics.timed, 'read', pdftrim.trim_pdf, pdf, pages) if pages else None
+        if trimmed is not None:
+            data = await self.loop.run_in_executor(None, pdftrim.parse_header, await self.post(command, pdf, binary, trimmed))
+            if data is not None:
+                return data
+            logger.debug("No title or authors in first {} pages of '{}', send whole file".format(pages, os.path.split(pdf)[1]))
+        return await self.post(command, pdf, binary)
+
+
+    def submit(self, command, pdf, binary = False, pages = 0):
+        """ Schedule upload of pdf, returns concurrent.futures.Future with grobid data """
+        return asyncio.run_coroutine_threadsafe(self.fetch(command, pdf, binary, pages), self.loop)
+
+
+    def close(self):
+        self.balancer.close()
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+""" Per-stage timings and counters of document processing, exported as Prometheus text and/or JSON file.
+
+    Stages of one document: read (PDF memory mapping and trim), upload, grobid_wait (upload end to the whole response),
+    parse (tei_to_dict), to_rows (dict to output rows) and write (rows to output buffer). With --stream TEI
+    is parsed while rows are written, so parse and to_rows of such documents are part of write.
+    flush is the time of writing buffered rows of several documents in output files,
+    scholar is the time of one Scholar lookup running in background with --scholar. """
+import os
+import json
+import time
+import threading
+import contextlib
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+PREFIX = 'grobidservice'
+STAGES = ('read', 'upload', 'grobid_wait', 'parse', 'to_rows', 'write', 'flush', 'scholar')
+COUNTERS = ('documents', 'failed_documents', 'rejected_files', 'batches', 'cache_hits', 'requests', 'retries', 'timeouts', 'overloads',
+            'connection_errors', 'empty_responses', 'skipped_references', 'reference_errors', 'duplicate_references', 'uploaded_bytes', 'downloaded_bytes',
+            'scholar_requests', 'scholar_cache_hits', 'scholar_errors', 'scholar_overloads')
+# Metrics are served on all interfaces only if asked for
+DEFAULT_HOST = '127.0.0.1'
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+class Metrics(object):
+    """ Thread-safe counters and stage time histograms """
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        # Stage -> [count, sum, max, bucket counts]
+        self.stages = {stage: [0, 0.0, 0.0, [0] * len(BUCKETS)] for stage in STAGES}
+        self._lock = threading.Lock()
+
+
+    def increment(self, name, value = 1):
+        with self._lock:
+            self.counters[name] += value
+
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            stats = self.stages[stage]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats[3][i] += 1
+                    break
+
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start_time)
+
+
+    def take(self):
+        """ (counters, stages) observed since the last call and reset them, for metrics of pool processes """
+        with self._lock:
+            taken = (self.counters, self.stages)
+            self.counters = dict.fromkeys(COUNTERS, 0)
+            self.stages = {stage: [0, 0.0, 0.0, [0] * len(BUCKETS)] for stage in STAGES}
+        return taken
+
+
+    def add(self, taken):
+        """ Add (counters, stages) returned by take() of another process """
+        counters, stages = taken
+        with self._lock:
+            for name, value in counters.items():
+                self.counters[name] += value
+            for stage, (count, total, maximum, buckets) in stages.items():
+                stats = self.stages[stage]
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], maximum)
+                stats[3] = [a + b for a, b in zip(stats[3], buckets)]
+
+
+    def snapshot(self):
+        """ Metrics as JSON-serializable dict """
+        with self._lock:
+            return {
+                "time": time.time(),
+                "uptime": time.time() - self.start_time,
+                "counters": dict(self.counters),
+                "stages": {stage: {"count": count, "sum": total, "max": maximum} for stage, (count, total, maximum, buckets) in self.stages.items()},
+            }
+
+
+    def to_prometheus(self):
+        """ Metrics in Prometheus text exposition format """
+        with self._lock:
+            lines = ["# TYPE {}_stage_seconds histogram".format(PREFIX)]
+            for stage, (count, total, maximum, buckets) in self.stages.items():
+                cumulative = 0
+                for bound, bucket in zip(BUCKETS, buckets):
+                    cumulative += bucket
+                    lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(PREFIX, stage, "+Inf" if bound == float('inf') else bound, cumulative))
+                lines.append('{}_stage_seconds_sum{{stage="{}"}} {}'.format(PREFIX, stage, total))
+                lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(PREFIX, stage, count))
+            for name, value in self.counters.items():
+                lines.append("# TYPE {}_{}_total counter".format(PREFIX, name))
+                lines.append("{}_{}_total {}".format(PREFIX, name, value))
+            lines.append("# TYPE {}_uptime_seconds gauge".format(PREFIX))
+            lines.append("{}_uptime_seconds {}".format(PREFIX, time.time() - self.start_time))
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+increment = METRICS.increment
+observe = METRICS.observe
+timer = METRICS.timer
+
+
+def reset():
+    """ Drop metrics inherited by a forked pool process """
+    METRICS.take()
+
+
+def timed(stage, fn, *args):
+    """ Call fn(*args) and observe its time as stage """
+    with timer(stage):
+        return fn(*args)
+
+
+class MetricsServer(object):
+    """ HTTP server with METRICS as Prometheus text on /metrics, only local clients by default """
+    def __init__(self, port, host = DEFAULT_HOST):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = METRICS.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsFile(object):
+    """ Rewrites JSON file with METRICS every interval seconds and on close """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-file", daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+
+    def write(self):
+        # Readers never see a half-written file
+        tmp_path = "{}.tmp".format(self.path)
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as metrics_file:
+                json.dump(METRICS.snapshot(), metrics_file)
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            logger.warning("Can't write metrics file '{}': {}".format(self.path, error))
+
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+_EXPORTERS = list()
+
+def start_exporters(port = None, path = None, interval = 10, host = DEFAULT_HOST):
+    """ Export METRICS on HTTP host:port and/or in JSON file """
+    if port:
+        _EXPORTERS.append(MetricsServer(port, host))
+    if path:
+        _EXPORTERS.append(MetricsFile(path, interval))
+
+
+def stop_exporters():
+    while _EXPORTERS:
+        _EXPORTERS.pop().close()
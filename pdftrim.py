@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import io
+import logging
+import functools
+import importlib.util
+#
+import tei2dict
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+@functools.lru_cache(maxsize=None)
+def is_available():
+    """ Check that pypdf is installed without importing it, the import is slow and needed only for --header-pages """
+    return importlib.util.find_spec("pypdf") is not None
+
+
+def trim_pdf(path, pages):
+    """ Return PDF bytes with the first pages of path, None if PDF is not longer or can't be trimmed """
+    if not is_available():
+        return None
+    import pypdf
+    try:
+        reader = pypdf.PdfReader(path)
+        if reader.is_encrypted or len(reader.pages) <= pages:
+            return None
+        writer = pypdf.PdfWriter()
+        for page in reader.pages[:pages]:
+            writer.add_page(page)
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
+    except Exception as error:
+        logger.debug("Can't trim '{}': {}".format(path, error))
+        return None
+
+
+def parse_header(data):
+    """ Returns TEI data as tei2dict.ParsedTEI if grobid found title and authors in it, otherwise None.
+        Its record is converted to rows without parsing TEI again """
+    if not data:
+        return None
+    tei = metrics.timed('parse', tei2dict.parse_record, data)
+    return tei if tei.record.title and tei.record.authors else None
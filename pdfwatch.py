@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+""" New PDFs in a dir tree: Linux inotify through libc (ctypes), listing of the tree on other systems """
+import os
+import time
+import errno
+import struct
+import select
+import ctypes
+import logging
+#
+import utils
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# File is reported once it is written and closed or moved in, created dirs are watched too
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+EVENT_HEADER = struct.Struct("iIII")
+EVENTS_BUFFER_SIZE = 64 * 1024
+
+
+def get_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+class InotifyWatcher(object):
+    """ PDFs written or moved in under path, from inotify events """
+    def __init__(self, path):
+        self.path = path
+        libc = ctypes.CDLL(None, use_errno=True)
+        # AttributeError where libc has no inotify
+        self._add_watch = libc.inotify_add_watch
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, "inotify_init1: {}".format(os.strerror(code)))
+        # Watch descriptor -> dir
+        self._dirs = dict()
+        try:
+            self._watch_tree(path)
+        except:
+            os.close(self._fd)
+            raise
+
+
+    def _watch_tree(self, path, found = None):
+        """ Watch path and its subdirs, (path, size) of PDFs already there are added to found """
+        wd = self._add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            # Dir removed before it was watched
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(code, "inotify_add_watch '{}': {}".format(path, os.strerror(code)))
+        self._dirs[wd] = path
+        try:
+            with os.scandir(path) as scan:
+                entries = list(scan)
+        except OSError as error:
+            logger.warning("Can't list '{}': {}".format(path, error))
+            return
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    self._watch_tree(entry.path, found)
+            elif found is not None and entry.name.endswith('.pdf'):
+                found.append((entry.path, get_size(entry.path)))
+
+
+    def read(self, timeout = None):
+        """ Returns (path, size) of PDFs that came since the last call, waits up to timeout seconds (None: forever) for them """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self._fd, EVENTS_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+        found = list()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, the tree is listed again and the journal skips known PDFs
+                logger.warning("inotify queue overflow, list '{}' again".format(self.path))
+                self._watch_tree(self.path, found)
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            parent = self._dirs.get(wd)
+            if parent is None:
+                continue
+            path = os.path.join(parent, name)
+            if mask & IN_ISDIR:
+                # Files may be written in a new dir before it is watched
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path, found)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and name.endswith('.pdf'):
+                found.append((path, get_size(path)))
+        return found
+
+
+    def close(self):
+        os.close(self._fd)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PollingWatcher(object):
+    """ PDFs found by listing path every interval seconds, where inotify is not available.
+        New or changed file is reported when its size is the same in two listings, so it is not being written """
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        # Path -> size of reported and already present PDFs
+        self._known = dict(utils.iterate_pdfs(path))
+        # Path -> size of PDFs seen changing in the last listing
+        self._changing = dict()
+        self._poll_time = time.time() + interval
+
+
+    def read(self, timeout = None):
+        """ Returns (path, size) of PDFs that came since the last call, waits up to timeout seconds (None: forever) for them """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = self._poll_time - time.time()
+            if deadline is not None and deadline < self._poll_time:
+                time.sleep(max(0, deadline - time.time()))
+                return []
+            time.sleep(max(0, wait))
+            self._poll_time = time.time() + self.interval
+            found = self._poll()
+            if found:
+                return found
+
+
+    def _poll(self):
+        found = list()
+        changing = dict()
+        present = set()
+        for path, size in utils.iterate_pdfs(self.path):
+            present.add(path)
+            if self._known.get(path, -1) == size:
+                continue
+            if self._changing.get(path, -1) == size:
+                self._known[path] = size
+                found.append((path, size))
+            else:
+                changing[path] = size
+        self._changing = changing
+        # Removed files are reported again if they come back
+        for path in set(self._known) - present:
+            del self._known[path]
+        return found
+
+
+    def close(self):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_watcher(path, poll_interval):
+    """ InotifyWatcher of path, PollingWatcher if inotify is not available """
+    try:
+        return InotifyWatcher(path)
+    except (OSError, AttributeError, TypeError) as error:
+        logger.warning("inotify is not available ({}), list '{}' every {} seconds".format(error, path, poll_interval))
+        return PollingWatcher(path, poll_interval)
+
+
+def iterate_batches(watcher, delay, max_size):
+    """ Yield lists of (path, size) of new PDFs: a batch starts with the first PDF and takes PDFs that come in the next
+        delay seconds, but stops taking them once it has max_size PDFs """
+    while True:
+        batch = watcher.read()
+        deadline = time.time() + delay
+        while len(batch) < max_size:
+            left = deadline - time.time()
+            if left <= 0:
+                break
+            batch.extend(watcher.read(left))
+        # File written several times in the batch is sent once, with its last size
+        yield list(dict(batch).items())
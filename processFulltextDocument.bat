@@ -0,0 +1 @@
+python GrobidService.py -l logbook.log -i .\PDFs -o out_headers.csv --referencesfilename out_references.csv -a
\ No newline at end of file
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Records of grobid TEI: header of a document and its references.
+
+    Text of an empty element is "", None means that TEI has no such element.
+    to_dict() keeps the format of tei2dict.tei_to_dict, where text of an empty element is None. """
+import sys
+
+# Output columns in to_row() order, followed by authors
+HEADER_COLUMNS = (("file", str), ("title", str), ("pubdate", str), ("doi", str), ("abstract", str))
+REFERENCE_COLUMNS = (("file", str), ("title", str), ("year", str), ("doi", str), ("start_page", str), ("end_page", str), ("scholar_count", int))
+
+
+def intern(text):
+    """ Same names of authors and journals in thousands of references share one string """
+    return sys.intern(text) if text else text
+
+
+def text_to_dict(text):
+    """ Element text in to_dict() """
+    return text if text != "" else None
+
+
+class Author(object):
+    __slots__ = ('name', 'surname')
+
+    def __init__(self, name, surname = None):
+        self.name = intern(name)
+        self.surname = intern(surname)
+
+
+    def __repr__(self):
+        return "Author({!r})".format(self.name)
+
+
+class Pubnote(object):
+    """ Where the cited work is published """
+    __slots__ = ('journal_title', 'doi', 'journal_volume', 'journal_issue', 'year', 'start_page', 'end_page')
+    # Fields with element text, others are parsed from attributes
+    text_fields = ('journal_title', 'doi', 'journal_volume', 'journal_issue')
+
+    def __init__(self, journal_title = None, doi = None, journal_volume = None, journal_issue = None, year = None, start_page = None, end_page = None):
+        self.journal_title = intern(journal_title)
+        self.doi = doi
+        self.journal_volume = journal_volume
+        self.journal_issue = journal_issue
+        self.year = year
+        self.start_page = start_page
+        self.end_page = end_page
+
+
+    def to_dict(self):
+        result = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = text_to_dict(value) if name in self.text_fields else value
+        return result
+
+
+class Reference(object):
+    __slots__ = ('title', 'authors', 'pubnote')
+
+    def __init__(self, title, authors, pubnote):
+        self.title = title
+        self.authors = authors
+        self.pubnote = pubnote
+
+
+    def has_title(self):
+        return bool(self.title) or self.pubnote.journal_title is not None
+
+
+    def to_row(self, pdf_name, scholar_count = 0):
+        """ Row of REFERENCE_COLUMNS followed by unique authors, title is the journal title if reference has no own """
+        pubnote = self.pubnote
+        row = [pdf_name, self.title or pubnote.journal_title or "", pubnote.year or "", pubnote.doi or "",
+               pubnote.start_page or "", pubnote.end_page or "", scholar_count]
+        row.extend(set(author.name for author in self.authors))
+        return row
+
+
+    def to_dict(self):
+        """ Reference in the format of tei2dict.tei_to_dict """
+        return {'ref_title': self.title, 'authors': [author.name for author in self.authors], 'journal_pubnote': self.pubnote.to_dict()}
+
+
+class Header(object):
+    """ Document metadata and its references """
+    __slots__ = ('title', 'pubdate', 'doi', 'publisher', 'start_page', 'end_page', 'abstract', 'authors', 'keywords', 'references')
+
+    def __init__(self):
+        self.title = None
+        self.pubdate = None
+        self.doi = None
+        self.publisher = None
+        self.start_page = None
+        self.end_page = None
+        self.abstract = None
+        self.authors = []
+        self.keywords = None
+        self.references = []
+
+
+    def to_row(self, pdf_name):
+        """ Row of HEADER_COLUMNS followed by unique authors """
+        row = [pdf_name, self.title or "", self.pubdate or "", self.doi or "", (self.abstract or "").strip()]
+        row.extend(set(author.name for author in self.authors))
+        return row
+
+
+    def to_dict(self):
+        """ Header in the format of tei2dict.tei_to_dict """
+        result = {}
+        for key, value in (('pubdate', self.pubdate), ('DOI', self.doi), ('publisher', self.publisher), ('start_page', self.start_page),
+                           ('end_page', self.end_page), ('abstract', self.abstract)):
+            if value is not None:
+                result[key] = text_to_dict(value) if key in ('DOI', 'publisher', 'abstract') else value
+        if self.authors:
+            result['authors'] = [author.name for author in self.authors]
+        if self.keywords is not None:
+            result['keywords'] = [{'value': keyword} for keyword in self.keywords]
+        if self.title is not None:
+            result['title'] = text_to_dict(self.title)
+        if self.references:
+            result['references'] = [reference.to_dict() for reference in self.references]
+        return result
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import re
+import sqlite3
+import unicodedata
+import logging
+#
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+DOI_PREFIX_PATTERN = re.compile(r'^(https?://(dx\.)?doi\.org/|doi:)\s*', re.IGNORECASE)
+NOT_WORD_PATTERN = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def normalize_doi(doi):
+    """ DOI without resolver prefix in lower case, DOIs are case-insensitive """
+    return DOI_PREFIX_PATTERN.sub('', doi.strip()).lower()
+
+
+def normalize_text(text):
+    """ Lower case words without accents and punctuation separated by single spaces """
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return NOT_WORD_PATTERN.sub(' ', text.lower()).strip()
+
+
+def make_key(doi, title, year, first_author):
+    """ Index key of cited work: normalized DOI or normalized title, year and first author surname, None without both """
+    doi = normalize_doi(doi or "")
+    if doi:
+        return "doi:" + doi
+    title = normalize_text(title or "")
+    if not title:
+        return None
+    author = normalize_text(first_author or "").split()
+    return "title:{}|{}|{}".format(title, (year or "").strip(), author[-1] if author else "")
+
+
+class ReferenceIndex(object):
+    """ SQLite file with canonical id of every cited work by its key. Position is the last id """
+    def __init__(self, path, reset = False):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        if reset:
+            self._connection.execute("DROP TABLE IF EXISTS works")
+        # Works without key get an id but are never matched
+        self._connection.execute("CREATE TABLE IF NOT EXISTS works (id INTEGER PRIMARY KEY, key TEXT UNIQUE)")
+        self._connection.commit()
+        # Key -> id of works seen in this run
+        self._ids = dict()
+        # (id, key) of new works not saved yet
+        self._new = list()
+        self._committed = 0
+        self._last_id = self.tell()
+
+
+    def get(self, key):
+        """ Returns (id, True if work is new) """
+        if key is not None:
+            work_id = self._ids.get(key)
+            if work_id is None:
+                found = self._connection.execute("SELECT id FROM works WHERE key = ?", (key,)).fetchone()
+                if found:
+                    work_id = self._ids[key] = found[0]
+            if work_id is not None:
+                return work_id, False
+        self._last_id += 1
+        self._new.append((self._last_id, key))
+        if key is not None:
+            self._ids[key] = self._last_id
+        return self._last_id, True
+
+
+    def rollback(self):
+        """ Forget works first seen in the current document """
+        for work_id, key in self._new[self._committed:]:
+            self._ids.pop(key, None)
+        del self._new[self._committed:]
+        self._last_id = self._new[-1][0] if self._new else self.tell()
+
+
+    def commit(self):
+        self._committed = len(self._new)
+
+
+    def flush(self):
+        """ Save new works of finished documents, returns position for the journal """
+        self.rollback()
+        if self._new:
+            with self._connection:
+                self._connection.executemany("INSERT INTO works (id, key) VALUES (?, ?)", self._new)
+            self._new = list()
+            self._committed = 0
+        return self.tell()
+
+
+    def tell(self):
+        return self._connection.execute("SELECT COALESCE(MAX(id), 0) FROM works").fetchone()[0]
+
+
+    def truncate(self, position):
+        """ Drop works saved after position (resume) """
+        with self._connection:
+            self._connection.execute("DELETE FROM works WHERE id > ?", (position,))
+        self._ids = {key: work_id for key, work_id in self._ids.items() if work_id <= position}
+        self._last_id = self.tell()
+
+
+    def close(self):
+        self.flush()
+        self._connection.close()
+
+
+class DedupSink(object):
+    """ Sink of reference rows with work key after file: every work is written once in works sink as
+        (id, reference columns..., authors), citations sink gets (file, id) for every reference """
+    def __init__(self, index, citations, works):
+        self.index = index
+        self.citations = citations
+        self.works = works
+
+
+    def write(self, row):
+        work_id, new = self.index.get(row[1])
+        if new:
+            self.works.write([work_id] + row[2:])
+        else:
+            metrics.increment('duplicate_references')
+        self.citations.write([row[0], work_id])
+
+
+    def rollback(self):
+        self.index.rollback()
+        self.citations.rollback()
+        self.works.rollback()
+
+
+    def commit(self):
+        self.index.commit()
+        return any([self.citations.commit(), self.works.commit()])
+
+
+    def flush(self):
+        # Works are saved in output before the index knows them
+        return [self.citations.flush(), self.works.flush(), self.index.flush()]
+
+
+    def truncate(self, position):
+        """ Position is [citations, works, index] or 0 if nothing was journaled, then index of previous runs is kept """
+        citations, works, index = position if position else (0, 0, None)
+        self.citations.truncate(citations)
+        self.works.truncate(works)
+        if index is not None:
+            self.index.truncate(index)
+
+
+    def close(self):
+        try:
+            self.citations.close()
+            self.works.close()
+        finally:
+            self.index.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import time
+import sqlite3
+import threading
+import traceback
+import functools
+import collections
+import concurrent.futures
+import logging
+#
+import settings
+import aimd
+import metrics
+import refindex
+import utils
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Count of a title which lookup failed or was dropped is an empty cell, 0 is a title Scholar doesn't know.
+# Failures are only in metrics and the log
+FAILED_COUNT = None
+
+
+class ScholarCache(object):
+    """ SQLite file with Scholar counts by normalized title, counts older than ttl seconds are looked up again """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS counts (title TEXT PRIMARY KEY, count INTEGER NOT NULL, time REAL NOT NULL)")
+        self._connection.commit()
+
+
+    def get(self, title):
+        with self._lock:
+            found = self._connection.execute("SELECT count FROM counts WHERE title = ? AND time > ?", (title, time.time() - self.ttl)).fetchone()
+        return found[0] if found else None
+
+
+    def put(self, title, count):
+        # Lookups are seconds apart, commit every count
+        with self._lock:
+            with self._connection:
+                self._connection.execute("INSERT OR REPLACE INTO counts (title, count, time) VALUES (?, ?, ?)", (title, count, time.time()))
+
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class Enricher(object):
+    """ Scholar counts looked up in background threads at most rate per second, every title is looked up once.
+        Rows are never held for lookups: counts that come after rows of their title were written are collected for drain() """
+    def __init__(self, cache_path, ttl, rate, using_TOR = False):
+        self.using_TOR = using_TOR
+        self._cache = ScholarCache(cache_path, ttl)
+        self._bucket = aimd.TokenBucket(rate, settings.SCHOLAR_BURST)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=settings.SCHOLAR_WORKERS, thread_name_prefix="scholar")
+        # Normalized title -> future of its count while it is looked up, duplicate titles wait for the same lookup.
+        # Failed lookups stay here, so their titles are not looked up again in this run
+        self._futures = dict()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # (title, count) of lookups finished after their rows were written, titles of such rows still waiting for the count
+        self._late = collections.deque()
+        self._late_titles = set()
+        self.stats = dict.fromkeys(('requests', 'cache_hits', 'failed', 'late', 'dropped'), 0)
+
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+
+    def lookup(self, title):
+        """ Returns future of Scholar count of title, FAILED_COUNT if lookup failed. Counts in the cache are done futures """
+        key = refindex.normalize_text(title or "")
+        if not key:
+            # Reference without title has no count
+            future = concurrent.futures.Future()
+            future.set_result(None)
+            return future
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+            future = self._futures[key] = concurrent.futures.Future()
+        count = self._cache.get(key)
+        if count is not None:
+            metrics.increment('scholar_cache_hits')
+            self._count('cache_hits')
+            self._done(key, future, count)
+            return future
+        self._executor.submit(self._get_count, key, title).add_done_callback(functools.partial(self._lookup_done, key, future))
+        return future
+
+
+    def _lookup_done(self, key, future, inner):
+        if inner.cancelled():
+            self._count('dropped')
+            self._done(key, future, FAILED_COUNT)
+        else:
+            self._done(key, future, inner.result())
+
+
+    def _done(self, key, future, count):
+        # Found count is in the cache, which answers next lookups of the title
+        if count is not FAILED_COUNT:
+            with self._lock:
+                self._futures.pop(key, None)
+        future.set_result(count)
+
+
+    def _get_count(self, key, title):
+        if not self._bucket.acquire(self._closed):
+            self._count('dropped')
+            return FAILED_COUNT
+        metrics.increment('scholar_requests')
+        self._count('requests')
+        try:
+            with metrics.timer('scholar'):
+                count = utils.get_count_from_scholar(title, self.using_TOR)
+        except utils.OverloadError as error:
+            # Scholar refused the request, nothing is sent until the pause ends
+            self._bucket.pause(settings.SCHOLAR_PAUSE)
+            metrics.increment('scholar_overloads')
+            self._count('failed')
+            logger.warning("Scholar refused lookup of '{}', pausing lookups for {} seconds: {}".format(title, settings.SCHOLAR_PAUSE, error))
+            return FAILED_COUNT
+        except:
+            metrics.increment('scholar_errors')
+            self._count('failed')
+            logger.warning("Scholar lookup of '{}' failed: {}".format(title, traceback.format_exc()))
+            return FAILED_COUNT
+        self._cache.put(key, count)
+        return count
+
+
+    def enrich(self, rows, title_column, count_column):
+        """ Set count_column of rows to Scholar count of title_column if it is known now, otherwise to None
+            and the count comes later from drain() """
+        late = dict()
+        for row in rows:
+            lookup = self.lookup(row[title_column])
+            if lookup.done():
+                row[count_column] = lookup.result()
+            else:
+                row[count_column] = None
+                late[row[title_column]] = lookup
+        with self._lock:
+            late = {title: lookup for title, lookup in late.items() if title not in self._late_titles}
+            self._late_titles.update(late)
+        for title, lookup in late.items():
+            lookup.add_done_callback(functools.partial(self._late_done, title))
+
+
+    def _late_done(self, title, future):
+        with self._lock:
+            self._late_titles.discard(title)
+            self.stats['late'] += 1
+        self._late.append((title, future.result()))
+
+
+    def drain(self):
+        """ Returns (title, count) of lookups finished since the last call for rows written without count """
+        counts = list()
+        while self._late:
+            counts.append(self._late.popleft())
+        return counts
+
+
+    def stop(self, wait = False):
+        """ Drop lookups that didn't start yet, with wait returns when lookups in progress are done """
+        self._closed.set()
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+    def close(self, wait = True):
+        """ Wait for lookups, only for the ones in progress if wait is False """
+        if not wait:
+            self.stop()
+        self._executor.shutdown(wait=True)
+        self._cache.close()
+        logger.info("Scholar: {requests} requests, {cache_hits} cache hits, {failed} failed, {dropped} dropped, {late} counts came after their rows".format(**self.stats))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *args):
+        # Interrupted run doesn't wait for rate limited lookups
+        self.close(exc_type is None)
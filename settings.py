@@ -2,13 +2,18 @@
 import argparse
 import collections
 import os, logging, re, traceback, sys
+import logging.handlers
+import queue
+import atexit
+import threading
 import json
 import time
 from datetime import datetime
 import re
-from torrequest import TorRequest
+import balancer
+import sinks
 #
-_main_dir = os.path.dirname(__file__)
+_main_dir = os.path.dirname(os.path.abspath(__file__))
 #
 
 MAX_RETRY = 5
@@ -21,7 +26,7 @@ def build_version_string():
     __MINOR_VERSION__ = str()
     # PATCH version when you make backwards-compatible bug fixes
     __PATCH_VERSION__ = str()
-    with open('version.txt', 'r') as version_file:
+    with open(os.path.join(_main_dir, 'version.txt'), 'r') as version_file:
         lines = version_file.readlines()
         for line in lines:
             if line.startswith('__MAJOR_VERSION__'):
@@ -35,27 +40,115 @@ def build_version_string():
     return _header
 
 SCHOLAR_SEARCH = 'https://scholar.google.ru/scholar?q={0}&hl=en'
+DEFAULT_SCHOLAR_CACHE = os.path.join(_main_dir, 'scholar_cache.sqlite')
+DEFAULT_SCHOLAR_TTL = 30 # days
+DEFAULT_SCHOLAR_RATE = 6 # requests per minute
+# Scholar requests sent at once without waiting for the rate limit
+SCHOLAR_BURST = 3
+SCHOLAR_WORKERS = 4
+# Seconds without Scholar requests after Scholar refused one (HTTP 429 or 503)
+SCHOLAR_PAUSE = 300
 GROBID_SERVER = 'http://cloud.science-miner.com/grobid/api/'
 GROBID_PROCESSED_HEADER_COMMAND = 'processHeaderDocument' # processFulltextDocument processReferences
 GROBID_PROCESSED_REFERENCES_COMMAND = 'processReferences' # processFulltextDocument processReferences
+GROBID_PROCESSED_FULLTEXT_COMMAND = 'processFulltextDocument'
+GROBID_VERSION_COMMAND = 'version'
+GROBID_ISALIVE_COMMAND = 'isalive'
+GROBID_SERVERS = [GROBID_SERVER]
+# Grobid server failing this number of requests in a row is out of rotation for BREAKER_OPEN_TIME seconds
+BREAKER_FAILURES = 3
+BREAKER_OPEN_TIME = 60
+HEALTH_CHECK_INTERVAL = 30
 DEFAULT_TIMEOUT = 60
-DEFAULT_SLEEP = 5
+# Timeout of uploads before any of them succeeded is DEFAULT_TIMEOUT plus TIMEOUT_PER_MB seconds for every MB,
+# then it follows latency per MB in the run (aimd.TimeoutEstimator), but stays between MIN_TIMEOUT and MAX_TIMEOUT
+TIMEOUT_PER_MB = 10
+MIN_TIMEOUT = 10
+MAX_TIMEOUT = 900
 DEFAULT_MAX_RETRIES = 3
+# HTTP 429/503 from grobid means that its pool is full, such requests are retried more times
+OVERLOAD_MAX_RETRIES = 10
+# Retries wait random time up to BACKOFF_BASE * 2 ** attempt seconds, but not more than BACKOFF_MAX
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+DEFAULT_WORKERS = 1
+DEFAULT_CACHE_SIZE = 1024 # MB
+# Smaller files can't be a PDF with a page
+MIN_PDF_SIZE = 64
+MAX_PDF_SIZE = 0
+DEFAULT_METRICS_INTERVAL = 10
+DEFAULT_METRICS_HOST = '127.0.0.1'
+# --watch: a batch takes PDFs that come within WATCH_BATCH_DELAY seconds after its first one, at most WATCH_BATCH_SIZE of them
+WATCH_BATCH_DELAY = 2
+WATCH_BATCH_SIZE = 1000
+# Seconds between listings of the input dir where inotify is not available
+WATCH_POLL_INTERVAL = 5
+DEFAULT_WATCH_ROTATE = 60 # minutes
+DEFAULT_PROGRESS_INTERVAL = 1.0
+# Log records kept before the logbook is opened
+IN_MEMORY_LOG_SIZE = 1000
 USING_TOR_BROWSER = False
+TOR_APP = r".\Tor\tor.exe"
+TOR_BASE_PORT = 9050
+TOR_CIRCUITS = None
+TOR_ROTATE_EVERY = 0
+WORKERS = DEFAULT_WORKERS
+CACHE_PATH = None
+CACHE_SIZE = DEFAULT_CACHE_SIZE * 1024 * 1024
+
+PATH_ORDER = 'path'
+LARGEST_FIRST_ORDER = 'largest'
+SMALLEST_FIRST_ORDER = 'smallest'
+ORDER = PATH_ORDER
+
+THREADS_ENGINE = 'threads'
+ASYNC_ENGINE = 'async'
+ENGINE = THREADS_ENGINE
 
 
 PROCESS_HEADER_MODE = 0
 PROCESS_REFERENCES_MODE = 1
+PROCESS_FULLTEXT_MODE = 2
 
-# Program version
-_header = build_version_string()
+# Program version, set by configure()
+_header = None
 
 # system settings
 _LOGBOOK_NAME = None
+PDFS_PATH = None
+MODE = PROCESS_REFERENCES_MODE
 OUTPUT_FILE = None
+REFERENCES_OUTPUT_FILE = None
+# (number, count) of --shard, numbers start from 1
+SHARD = None
+# Number of shards joined by merge command, 0 if PDFs are processed
+MERGE_SHARDS = 0
+JOURNAL_FILE = None
+REJECTED_FILE = None
+RESUME = False
+STREAMING = False
+HEADER_PAGES = 0
+ARCHIVE_FILE = None
+REPARSE_FILE = None
+WATCH = False
+WATCH_ROTATE = DEFAULT_WATCH_ROTATE * 60
+METRICS_PORT = None
+METRICS_HOST = DEFAULT_METRICS_HOST
+METRICS_FILE = None
+METRICS_INTERVAL = DEFAULT_METRICS_INTERVAL
+OUTPUT_FORMAT = sinks.CSV_FORMAT
+DEDUP = False
+REFERENCE_INDEX = None
+SCHOLAR = False
+SCHOLAR_CACHE = DEFAULT_SCHOLAR_CACHE
+SCHOLAR_TTL = DEFAULT_SCHOLAR_TTL * 86400
+SCHOLAR_RATE = DEFAULT_SCHOLAR_RATE / 60.0
+
+PROGRESS_INTERVAL = DEFAULT_PROGRESS_INTERVAL
 
 INFO_FILE = None
 LOG_LEVEL = logging.DEBUG
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
 # encoding
 OS_ENCODING = "utf-8"
 OUTPUT_ENCODING = "utf-8"
@@ -67,6 +160,20 @@ cfromat = "[{0}] {1}{2}"
 def print_message(message, level=0):
     level_indent = " " * level
     print(cfromat.format(datetime.now(), level_indent, message))
+
+# Level -> time of the last progress message
+_last_progress_time = dict()
+_progress_lock = threading.Lock()
+
+def print_progress(message, level=0):
+    """ print_message for per-document messages, prints at most one message of every level in PROGRESS_INTERVAL seconds """
+    if PROGRESS_INTERVAL > 0:
+        now = time.time()
+        with _progress_lock:
+            if now - _last_progress_time.get(level, 0) < PROGRESS_INTERVAL:
+                return
+            _last_progress_time[level] = now
+    print_message(message, level)
 #
 
 # Logging handlers
@@ -80,58 +187,187 @@ _LOG_FORMAT = "[%(asctime)s %(levelname)s %(name)s] %(message)s"
 _LOG_COPY_FORMAT = "%(message)s"
 _LOG_HANDLER.setFormatter(logging.Formatter(_LOG_FORMAT))
 
-IN_MEMORY_LOG = []
+IN_MEMORY_LOG = collections.deque(maxlen=IN_MEMORY_LOG_SIZE)
+_LOG_F_HANDLER = None
+# Records go through the queue to the logbook in a background thread, so slow disk doesn't hold up workers
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_QUEUE_HANDLER = logging.handlers.QueueHandler(_LOG_QUEUE)
+_LOG_LISTENER = None
 
 main_logger = logging.getLogger("")
 
-main_logger.addHandler(_LOG_HANDLER)
-main_logger.setLevel(LOG_LEVEL)
-
 logger = logging.getLogger(__name__)
 
-print_message(_header)
-logger.info(_header)
+MERGE_COMMAND = 'merge'
+
+
+def parse_shard(value):
+    """ --shard value "i/N" -> (i, N) """
+    try:
+        number, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard should be i/N, got '{}'".format(value))
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError("shard number should be from 1 to {}, got {}".format(count, number))
+    return number, count
+
+
+def get_shard_path(path, number, count):
+    """ Output path of shard: out.csv -> out-shard2of4.csv """
+    return "{0}-shard{2}of{3}{1}".format(*os.path.splitext(path), number, count)
+
 
 # Command line parser
-logger.info("Initializing argument parser, version: %s" % argparse.__version__)
-_parser = argparse.ArgumentParser()
+_parser = argparse.ArgumentParser(epilog="Outputs of --shard runs are joined by: {} {} -l LOG -o OUTPUT -f|-s|-a --shards N [--format FORMAT]".format(os.path.basename(sys.argv[0]), MERGE_COMMAND))
 requiredNamed = _parser.add_argument_group('Required arguments')
 requiredNamed.add_argument("-l", "--log", action="store", dest="LOG_FILE_NAME", help="Logbook file", type=str, required=True)
-requiredNamed.add_argument("-i", "--inputdir", action="store", dest="INPUT_DIR", help="Dir with PDF's", type=str, required=True)
+requiredNamed.add_argument("-i", "--inputdir", action="store", dest="INPUT_DIR", help="Dir with PDF's (not used with --reparse)", type=str, required=False)
 requiredNamed.add_argument("-o", "--outputfilename", action="store", dest="OUTPUT_FILE", help="Output file", type=str, required=True)
 requiredNamed.add_argument("-t", "--tor", action="store_true", dest="USING_TOR", help="Using TOR browser", required=False)
+_parser.add_argument("--tor-circuits", action="store", dest="TOR_CIRCUITS", help="Number of TOR circuits, each runs own tor process (default: number of workers)", type=int, default=None, required=False)
+_parser.add_argument("--tor-rotate", action="store", dest="TOR_ROTATE_EVERY", help="Reset TOR identity after this number of requests (0: only on HTTP 429/503)", type=int, default=0, required=False)
+_parser.add_argument("--server", action="append", dest="GROBID_SERVERS", help="Grobid API URL as URL[@weight], repeat for several servers (default: {})".format(GROBID_SERVER), type=str, default=None, required=False)
+_parser.add_argument("-w", "--workers", action="store", dest="WORKERS", help="Number of PDFs sent to grobid at once", type=int, default=DEFAULT_WORKERS, required=False)
+_parser.add_argument("-e", "--engine", action="store", dest="ENGINE", help="Grobid client engine: a thread per upload or one asyncio event loop", choices=[THREADS_ENGINE, ASYNC_ENGINE], default=THREADS_ENGINE, required=False)
+_parser.add_argument("-c", "--cache", action="store", dest="CACHE_PATH", help="Dir of TEI cache, PDFs found in cache are not sent to grobid", type=str, default=None, required=False)
+_parser.add_argument("--cache-size", action="store", dest="CACHE_SIZE", help="Max size of TEI cache in MB", type=int, default=DEFAULT_CACHE_SIZE, required=False)
+_parser.add_argument("-r", "--resume", action="store_true", dest="RESUME", help="Continue previous run: append to output file and skip PDFs saved in its journal", required=False)
+_parser.add_argument("--stream", action="store_true", dest="STREAMING", help="Parse references incrementally and write them as they are parsed, for TEI with thousands of references (-s only)", required=False)
+_parser.add_argument("--order", action="store", dest="ORDER", help="Order of sending PDFs: by path, largest first (shortest total time with several workers) or smallest first (fast partial results). "
+                     "Size orders list the whole dir before the first upload", choices=[PATH_ORDER, LARGEST_FIRST_ORDER, SMALLEST_FIRST_ORDER], default=PATH_ORDER, required=False)
+_parser.add_argument("--max-size", action="store", dest="MAX_PDF_SIZE", help="Skip PDFs larger than this number of MB (default: no limit)", type=float, default=0, required=False)
+_parser.add_argument("--header-pages", action="store", dest="HEADER_PAGES", help="Send only this number of first PDF pages to processHeaderDocument (needs pypdf), whole PDF is sent if grobid finds no title or authors in them", type=int, default=0, required=False)
+_parser.add_argument("--archive", action="store", dest="ARCHIVE_FILE", help="Save TEI returned by grobid in this SQLite archive", type=str, default=None, required=False)
+_parser.add_argument("--reparse", action="store", dest="REPARSE_FILE", help="Build output file from TEI archive without grobid, uses --workers processes (default: all CPUs)", type=str, default=None, required=False)
+_parser.add_argument("--watch", action="store_true", dest="WATCH", help="Keep running: process PDFs of the input dir, then PDFs added to it in small batches within seconds (inotify on Linux, "
+                     "listing every {} seconds elsewhere). Outputs get the time they were opened in their names, PDFs saved in the journal are skipped after restart".format(WATCH_POLL_INTERVAL), required=False)
+_parser.add_argument("--rotate", action="store", dest="WATCH_ROTATE", help="Minutes before --watch opens new output files (0: never)", type=float, default=DEFAULT_WATCH_ROTATE, required=False)
+_parser.add_argument("--shard", action="store", dest="SHARD", help="Process only shard i of N of the input dir, every node of a cluster gets own i and the same dir (PDFs are split by hash "
+                     "of their path in it). Outputs are <output>-shard<i>of<N>", type=parse_shard, default=None, required=False)
+_parser.add_argument("--shards", action="store", dest="MERGE_SHARDS", help="Number of shards joined by {} command".format(MERGE_COMMAND), type=int, default=0, required=False)
+_parser.add_argument("--metrics-port", action="store", dest="METRICS_PORT", help="Serve stage timings and counters in Prometheus text format on this port", type=int, default=None, required=False)
+_parser.add_argument("--metrics-host", action="store", dest="METRICS_HOST", help="Address the metrics port is bound to, 0.0.0.0 for all interfaces", type=str, default=DEFAULT_METRICS_HOST, required=False)
+_parser.add_argument("--metrics-file", action="store", dest="METRICS_FILE", help="Write stage timings and counters in this JSON file", type=str, default=None, required=False)
+_parser.add_argument("--metrics-interval", action="store", dest="METRICS_INTERVAL", help="Seconds between metrics file updates", type=float, default=DEFAULT_METRICS_INTERVAL, required=False)
+_parser.add_argument("--log-level", action="store", dest="LOG_LEVEL", help="Logbook level, DEBUG records every document and reference", choices=LOG_LEVELS, default="DEBUG", required=False)
+_parser.add_argument("--progress-interval", action="store", dest="PROGRESS_INTERVAL", help="Min seconds between per-document console messages (0: print all)", type=float, default=DEFAULT_PROGRESS_INTERVAL, required=False)
 _group = _parser.add_mutually_exclusive_group()
 _group.add_argument("-f", action="store_true", dest="ProcessHeader", help="ProcessHeader")
 _group.add_argument("-s", action="store_false", dest="ProcessReferences", help="ProcessReferences")
+_group.add_argument("-a", action="store_true", dest="ProcessFulltext", help="ProcessHeader and ProcessReferences from one processFulltextDocument call")
+_parser.add_argument("--format", action="store", dest="OUTPUT_FORMAT", help="Format of output files, authors are trailing columns in csv and a list in others (parquet needs pyarrow)", choices=sinks.FORMATS, default=sinks.CSV_FORMAT, required=False)
+_parser.add_argument("--dedup", action="store", dest="DEDUP", nargs="?", const="", metavar="INDEX", help="Write every cited work once in <references output>_works with ref_id, references output gets (file, ref_id) rows. "
+                     "Works are matched by DOI or by title, year and first author; INDEX is SQLite file keeping ref_id of works between runs, known works are not written again (default: this run only)", type=str, default=None, required=False)
+_parser.add_argument("--scholar", action="store_true", dest="SCHOLAR", help="Fill scholar_count of references with count of Google Scholar results for their title, looked up in background", required=False)
+_parser.add_argument("--scholar-cache", action="store", dest="SCHOLAR_CACHE", help="SQLite file with Scholar counts of titles (default: {})".format(DEFAULT_SCHOLAR_CACHE), type=str, default=DEFAULT_SCHOLAR_CACHE, required=False)
+_parser.add_argument("--scholar-ttl", action="store", dest="SCHOLAR_TTL", help="Days before cached Scholar count is looked up again", type=float, default=DEFAULT_SCHOLAR_TTL, required=False)
+_parser.add_argument("--scholar-rate", action="store", dest="SCHOLAR_RATE", help="Max Scholar requests per minute", type=float, default=DEFAULT_SCHOLAR_RATE, required=False)
+_parser.add_argument("--referencesfilename", action="store", dest="REFERENCES_OUTPUT_FILE", help="References output file for -a (default: <output file>_references)", type=str, default=None, required=False)
+
+
+def configure(args = None):
+    """ Parse command line args (default: sys.argv) in settings and start logbook, has to be called once before processing """
+    global _header, _LOGBOOK_NAME, PDFS_PATH, OUTPUT_FILE, SHARD, MERGE_SHARDS, JOURNAL_FILE, REJECTED_FILE, MAX_PDF_SIZE, ORDER, RESUME, STREAMING, HEADER_PAGES, ARCHIVE_FILE, REPARSE_FILE, WATCH, WATCH_ROTATE, \
+        METRICS_PORT, METRICS_HOST, METRICS_FILE, METRICS_INTERVAL, MODE, REFERENCES_OUTPUT_FILE, WORKERS, ENGINE, GROBID_SERVERS, GROBID_SERVER, \
+        TOR_CIRCUITS, TOR_ROTATE_EVERY, CACHE_PATH, CACHE_SIZE, USING_TOR_BROWSER, PROGRESS_INTERVAL, OUTPUT_FORMAT, DEDUP, REFERENCE_INDEX, SCHOLAR, SCHOLAR_CACHE, SCHOLAR_TTL, SCHOLAR_RATE, LOG_LEVEL, _LOG_F_HANDLER, _LOG_LISTENER
+    main_logger.addHandler(_LOG_HANDLER)
+    main_logger.setLevel(LOG_LEVEL)
+
+    _header = build_version_string()
+    print_message(_header)
+    logger.info(_header)
+
+    logger.info("Initializing argument parser, version: %s" % argparse.__version__)
+    logger.debug("Parse arguments.")
+    args = sys.argv[1:] if args is None else list(args)
+    merge = bool(args) and args[0] == MERGE_COMMAND
+    try:
+        _command_args = _parser.parse_args(args[1:] if merge else args)
+        if merge and _command_args.MERGE_SHARDS < 1:
+            _parser.error("the following arguments are required for {}: --shards".format(MERGE_COMMAND))
+        if not merge and not _command_args.INPUT_DIR and not _command_args.REPARSE_FILE:
+            _parser.error("the following arguments are required: -i/--inputdir")
+    except:
+        print_message("Check promt arguments, exit.")
+        sys.exit()
+    _LOGBOOK_NAME = _command_args.LOG_FILE_NAME
+    PDFS_PATH = _command_args.INPUT_DIR
+    OUTPUT_FILE = _command_args.OUTPUT_FILE
+    SHARD = _command_args.SHARD if not merge else None
+    MERGE_SHARDS = _command_args.MERGE_SHARDS if merge else 0
+    if SHARD:
+        OUTPUT_FILE = get_shard_path(OUTPUT_FILE, *SHARD)
+    JOURNAL_FILE = "{}.journal".format(OUTPUT_FILE)
+    REJECTED_FILE = "{}.rejected".format(OUTPUT_FILE)
+    ORDER = _command_args.ORDER
+    MAX_PDF_SIZE = int(max(0, _command_args.MAX_PDF_SIZE) * 1024 * 1024)
+    RESUME = _command_args.RESUME
+    STREAMING = _command_args.STREAMING
+    HEADER_PAGES = max(0, _command_args.HEADER_PAGES)
+    ARCHIVE_FILE = _command_args.ARCHIVE_FILE
+    REPARSE_FILE = _command_args.REPARSE_FILE
+    WATCH = _command_args.WATCH
+    WATCH_ROTATE = max(0, _command_args.WATCH_ROTATE) * 60
+    if WATCH and REPARSE_FILE:
+        print_message("--watch can't be used with --reparse, exit.")
+        sys.exit()
+    METRICS_PORT = _command_args.METRICS_PORT
+    METRICS_HOST = _command_args.METRICS_HOST
+    METRICS_FILE = _command_args.METRICS_FILE
+    METRICS_INTERVAL = max(1, _command_args.METRICS_INTERVAL)
+    PROGRESS_INTERVAL = max(0, _command_args.PROGRESS_INTERVAL)
+    LOG_LEVEL = getattr(logging, _command_args.LOG_LEVEL)
+    MODE = PROCESS_HEADER_MODE if _command_args.ProcessHeader else PROCESS_FULLTEXT_MODE if _command_args.ProcessFulltext else PROCESS_REFERENCES_MODE
+    OUTPUT_FORMAT = _command_args.OUTPUT_FORMAT
+    if RESUME and OUTPUT_FORMAT == sinks.PARQUET_FORMAT:
+        print_message("Resume is not supported for parquet output, exit.")
+        sys.exit()
+    DEDUP = _command_args.DEDUP is not None
+    REFERENCE_INDEX = _command_args.DEDUP or None
+    SCHOLAR = _command_args.SCHOLAR
+    SCHOLAR_CACHE = _command_args.SCHOLAR_CACHE
+    SCHOLAR_TTL = max(0, _command_args.SCHOLAR_TTL) * 86400
+    SCHOLAR_RATE = max(0.1, _command_args.SCHOLAR_RATE) / 60.0
+    REFERENCES_OUTPUT_FILE = _command_args.REFERENCES_OUTPUT_FILE or "{0}_references{1}".format(*os.path.splitext(_command_args.OUTPUT_FILE))
+    if SHARD:
+        REFERENCES_OUTPUT_FILE = get_shard_path(REFERENCES_OUTPUT_FILE, *SHARD)
+    WORKERS = max(1, _command_args.WORKERS)
+    ENGINE = _command_args.ENGINE
+    if _command_args.GROBID_SERVERS:
+        GROBID_SERVERS = _command_args.GROBID_SERVERS
+        GROBID_SERVER = balancer.parse_server(GROBID_SERVERS[0])[0]
+    TOR_CIRCUITS = max(1, _command_args.TOR_CIRCUITS or WORKERS)
+    TOR_ROTATE_EVERY = _command_args.TOR_ROTATE_EVERY
+    CACHE_PATH = _command_args.CACHE_PATH
+    CACHE_SIZE = _command_args.CACHE_SIZE * 1024 * 1024
+    if _command_args.USING_TOR: 
+        USING_TOR_BROWSER = True
+    if USING_TOR_BROWSER and ENGINE == ASYNC_ENGINE:
+        print_message("TOR is not supported by the async engine, exit.")
+        sys.exit()
+    #    TOR = TorRequest(tor_app=r".\Tor\tor.exe")
+
+    logger.info("Initializing logbook.")
+
+    # Add file handler
+    _LOG_F_HANDLER = logging.FileHandler(_LOGBOOK_NAME, encoding = OUTPUT_ENCODING)
+    _LOG_F_HANDLER.setLevel(LOG_LEVEL)
+    _LOG_F_FORMATTER = logging.Formatter(_LOG_COPY_FORMAT)
+    _LOG_F_HANDLER.setFormatter(_LOG_F_FORMATTER)
+
+    logger.debug("Copy startlog in logbook.")
+    main_logger.removeHandler(_LOG_HANDLER)
+    main_logger.addHandler(_LOG_F_HANDLER)
+    for record in IN_MEMORY_LOG:
+        logger.info(record)
 
-logger.debug("Parse arguments.")
-try:
-    _command_args = _parser.parse_args()
-except:
-    print_message("Check promt arguments, exit.")
-    sys.exit()
-_LOGBOOK_NAME = _command_args.LOG_FILE_NAME
-PDFS_PATH = _command_args.INPUT_DIR
-OUTPUT_FILE = _command_args.OUTPUT_FILE
-MODE = PROCESS_HEADER_MODE if _command_args.ProcessHeader else PROCESS_REFERENCES_MODE
-if _command_args.USING_TOR: 
-    USING_TOR_BROWSER = True
-#    TOR = TorRequest(tor_app=r".\Tor\tor.exe")
-
-logger.info("Initializing logbook.")
-
-# Add file handler
-_LOG_F_HANDLER = logging.FileHandler(_LOGBOOK_NAME, encoding = OUTPUT_ENCODING)
-_LOG_F_HANDLER.setLevel(LOG_LEVEL)
-_LOG_F_FORMATTER = logging.Formatter(_LOG_COPY_FORMAT)
-_LOG_F_HANDLER.setFormatter(_LOG_F_FORMATTER)
-
-logger.debug("Copy startlog in logbook.")
-main_logger.removeHandler(_LOG_HANDLER)
-main_logger.addHandler(_LOG_F_HANDLER)
-for record in IN_MEMORY_LOG:
-    logger.info(record)
-
-_LOG_F_FORMATTER = logging.Formatter(_LOG_FORMAT)
-_LOG_F_HANDLER.setFormatter(_LOG_F_FORMATTER)
+    _LOG_F_FORMATTER = logging.Formatter(_LOG_FORMAT)
+    _LOG_F_HANDLER.setFormatter(_LOG_F_FORMATTER)
 
+    main_logger.removeHandler(_LOG_F_HANDLER)
+    main_logger.addHandler(_LOG_QUEUE_HANDLER)
+    _LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _LOG_F_HANDLER, respect_handler_level=True)
+    _LOG_LISTENER.start()
+    atexit.register(_LOG_LISTENER.stop)
+    # Modules log on DEBUG level, records below LOG_LEVEL are not even created
+    logging.disable(LOG_LEVEL - 1 if LOG_LEVEL > logging.DEBUG else logging.NOTSET)
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import csv
+import json
+import time
+import sqlite3
+import importlib.util
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+CSV_FORMAT = 'csv'
+JSONL_FORMAT = 'jsonl'
+PARQUET_FORMAT = 'parquet'
+SQLITE_FORMAT = 'sqlite'
+FORMATS = [CSV_FORMAT, JSONL_FORMAT, PARQUET_FORMAT, SQLITE_FORMAT]
+
+# Output rows are the columns in order followed by any number of authors
+AUTHORS_COLUMN = 'authors'
+
+
+class Sink(object):
+    """ Batched output of rows with named columns ((name, str or int), ...) followed by authors.
+        Rows of a document are buffered until commit(), buffered rows of finished documents are written
+        when there are batch_size of them or flush_interval seconds passed since the last write """
+    batch_size = 1000
+    flush_interval = 5
+
+    def __init__(self, path, name, columns):
+        self.path = path
+        self.name = name
+        self.columns = columns
+        self._rows = list()
+        # Buffered rows of finished documents
+        self._committed = 0
+        self._flush_time = time.time()
+
+
+    def to_record(self, row):
+        record = {name: value for (name, kind), value in zip(self.columns, row)}
+        record[AUTHORS_COLUMN] = list(row[len(self.columns):])
+        return record
+
+
+    @staticmethod
+    def to_row(columns, record):
+        """ Row of record read back from output """
+        return [record.get(name) for name, kind in columns] + list(record.get(AUTHORS_COLUMN) or [])
+
+
+    def write(self, row):
+        self._rows.append(row)
+
+
+    def rollback(self):
+        """ Drop rows of the current document """
+        del self._rows[self._committed:]
+
+
+    def commit(self):
+        """ End of document, returns True if buffered rows should be flushed """
+        self._committed = len(self._rows)
+        return self._committed >= self.batch_size or (self.flush_interval is not None and time.time() - self._flush_time >= self.flush_interval)
+
+
+    def flush(self):
+        """ Write buffered rows of finished documents, returns position of output end for the journal """
+        self.rollback()
+        if self._rows:
+            self._write_batch(self._rows)
+            self._rows = list()
+            self._committed = 0
+        self._flush_time = time.time()
+        return self.tell()
+
+
+    def close(self):
+        self.flush()
+        self._close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FileSink(Sink):
+    """ Text file output. Position is file size """
+    def __init__(self, path, name, columns, resume = False):
+        super(FileSink, self).__init__(path, name, columns)
+        self._file = open(path, 'a' if resume else 'w', encoding='UTF-8', newline='')
+
+
+    def tell(self):
+        return self._file.tell()
+
+
+    def truncate(self, position):
+        """ Drop output written after position (resume) """
+        if self._file.tell() > position:
+            self._file.truncate(position)
+            self._file.seek(position)
+
+
+    def _close(self):
+        self._file.close()
+
+
+class CSVSink(FileSink):
+    """ CSV with all values quoted, authors in trailing columns """
+    def __init__(self, path, name, columns, resume = False):
+        super(CSVSink, self).__init__(path, name, columns, resume)
+        self._writer = csv.writer(self._file, quoting=csv.QUOTE_ALL)
+
+
+    def _write_batch(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+
+
+    @classmethod
+    def read_rows(cls, path, name, columns):
+        """ Yield rows of output file one by one, values are strings """
+        with open(path, 'r', encoding='UTF-8', newline='') as output_file:
+            yield from csv.reader(output_file)
+
+
+class JSONLSink(FileSink):
+    """ One JSON object per row, authors as a list """
+    def _write_batch(self, rows):
+        self._file.write("".join(json.dumps(self.to_record(row), ensure_ascii=False) + "\n" for row in rows))
+        self._file.flush()
+
+
+    @classmethod
+    def read_rows(cls, path, name, columns):
+        """ Yield rows of output file one by one """
+        with open(path, 'r', encoding='UTF-8') as output_file:
+            for line in output_file:
+                yield cls.to_row(columns, json.loads(line))
+
+
+class SQLiteSink(Sink):
+    """ Table name of SQLite database, authors as JSON list. Position is the last rowid """
+    def __init__(self, path, name, columns, resume = False):
+        super(SQLiteSink, self).__init__(path, name, columns)
+        self._connection = sqlite3.connect(path)
+        if not resume:
+            self._connection.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+        definitions = ['"{}" {}'.format(column, "INTEGER" if kind is int else "TEXT") for column, kind in columns]
+        self._connection.execute('CREATE TABLE IF NOT EXISTS "{}" ({}, "{}" TEXT)'.format(name, ", ".join(definitions), AUTHORS_COLUMN))
+        self._connection.commit()
+        self._insert = 'INSERT INTO "{}" VALUES ({})'.format(name, ", ".join("?" * (len(columns) + 1)))
+
+
+    def _write_batch(self, rows):
+        n = len(self.columns)
+        with self._connection:
+            self._connection.executemany(self._insert, (list(row[:n]) + [json.dumps(list(row[n:]), ensure_ascii=False)] for row in rows))
+
+
+    def tell(self):
+        return self._connection.execute('SELECT COALESCE(MAX(rowid), 0) FROM "{}"'.format(self.name)).fetchone()[0]
+
+
+    @classmethod
+    def read_rows(cls, path, name, columns):
+        """ Yield rows of table name in the order they were written, the cursor fetches them in batches """
+        connection = sqlite3.connect(path)
+        try:
+            for values in connection.execute('SELECT * FROM "{}" ORDER BY rowid'.format(name)):
+                yield list(values[:-1]) + json.loads(values[-1])
+        finally:
+            connection.close()
+
+
+    def truncate(self, position):
+        with self._connection:
+            self._connection.execute('DELETE FROM "{}" WHERE rowid > ?'.format(self.name), (position,))
+
+
+    def _close(self):
+        self._connection.close()
+
+
+class ParquetSink(Sink):
+    """ Parquet file, every flush is a row group. Position is the number of rows, written files can't be resumed """
+    batch_size = 50000
+    flush_interval = None
+
+    def __init__(self, path, name, columns, resume = False):
+        super(ParquetSink, self).__init__(path, name, columns)
+        # pyarrow is only needed for parquet output
+        import pyarrow
+        import pyarrow.parquet
+        self._pyarrow = pyarrow
+        fields = [(column, pyarrow.int64() if kind is int else pyarrow.string()) for column, kind in columns]
+        self._schema = pyarrow.schema(fields + [(AUTHORS_COLUMN, pyarrow.list_(pyarrow.string()))])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._count = 0
+
+
+    def _write_batch(self, rows):
+        n = len(self.columns)
+        data = {column: [row[i] for row in rows] for i, (column, kind) in enumerate(self.columns)}
+        data[AUTHORS_COLUMN] = [list(row[n:]) for row in rows]
+        self._writer.write_table(self._pyarrow.Table.from_pydict(data, schema=self._schema))
+        self._count += len(rows)
+
+
+    def tell(self):
+        return self._count
+
+
+    @classmethod
+    def read_rows(cls, path, name, columns):
+        """ Yield rows of parquet file, one row group at a time is in memory """
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            for record in batch.to_pylist():
+                yield cls.to_row(columns, record)
+
+
+    def truncate(self, position):
+        if position != self._count:
+            raise Exception("Parquet output can't be truncated")
+
+
+    def _close(self):
+        self._writer.close()
+
+
+SINKS = {CSV_FORMAT: CSVSink, JSONL_FORMAT: JSONLSink, PARQUET_FORMAT: ParquetSink, SQLITE_FORMAT: SQLiteSink}
+
+
+def is_available(output_format):
+    """ Check that libraries needed by output_format are installed """
+    return output_format != PARQUET_FORMAT or importlib.util.find_spec("pyarrow") is not None
+
+
+def open_sink(output_format, path, name, columns, resume = False):
+    return SINKS[output_format](path, name, columns, resume)
+
+
+def read_rows(output_format, path, name, columns):
+    """ Yield rows of sink output as they were written, without reading the whole output """
+    return SINKS[output_format].read_rows(path, name, columns)
@@ -22,203 +22,255 @@
 # waive the privileges and immunities granted to it by virtue of its status
 # as an Intergovernmental Organization or submit itself to any jurisdiction.
 
-"""Mapping from Grobid's TEI to the internal dict representation."""
+"""Mapping from Grobid's TEI to the records of records module (and to the internal dict representation)."""
 
 from lxml import etree
 from six import text_type
+import io
 import time
 import re
+#
+import records
 
 YEAR_RE = "19[0-9]{2}|20[0-9]{2}"
 
 NS = {'tei': 'http://www.tei-c.org/ns/1.0'}
 
-
-def tei_to_dict(tei):
+YEAR_PATTERN = re.compile(YEAR_RE)
+
+BIBL_STRUCT_TAG = '{%s}biblStruct' % NS['tei']
+LIST_BIBL_TAG = '{%s}listBibl' % NS['tei']
+TEXT_TAG = '{%s}text' % NS['tei']
+
+# XPath expressions are compiled once at import instead of on every call
+TITLE_XPATH = etree.XPath('//tei:titleStmt/tei:title', namespaces=NS)
+YEAR_XPATH = etree.XPath('//tei:publicationStmt/tei:date[@type="published"]/@when', namespaces=NS)
+DOI_XPATH = etree.XPath('//tei:sourceDesc/tei:biblStruct/tei:idno[@type="DOI"]', namespaces=NS)
+PUBLISHER_XPATH = etree.XPath('//tei:sourceDesc/tei:biblStruct/tei:monogr/tei:imprint/tei:publisher', namespaces=NS)
+PAGE_FROM_XPATH = etree.XPath('//tei:sourceDesc/tei:biblStruct/tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@from', namespaces=NS)
+PAGE_TO_XPATH = etree.XPath('//tei:sourceDesc/tei:biblStruct/tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@to', namespaces=NS)
+ABSTRACT_XPATH = etree.XPath('//tei:profileDesc/tei:abstract/tei:p', namespaces=NS)
+AUTHORS_XPATH = etree.XPath('//tei:fileDesc//tei:author', namespaces=NS)
+KEYWORDS_XPATH = etree.XPath('//tei:profileDesc/tei:textClass/tei:keywords', namespaces=NS)
+REFERENCES_XPATH = etree.XPath('//tei:text//tei:listBibl/tei:biblStruct', namespaces=NS)
+
+AUTHOR_FIRST_XPATH = etree.XPath('.//tei:persName/tei:forename[@type="first"]', namespaces=NS)
+AUTHOR_MIDDLE_XPATH = etree.XPath('.//tei:persName/tei:forename[@type="middle"]', namespaces=NS)
+AUTHOR_SURNAME_XPATH = etree.XPath('.//tei:persName/tei:surname', namespaces=NS)
+KEYWORD_TERM_XPATH = etree.XPath('.//tei:term', namespaces=NS)
+
+REFERENCE_AUTHORS_XPATH = etree.XPath('.//tei:author', namespaces=NS)
+REFERENCE_TITLE_XPATH = etree.XPath('.//tei:analytic/tei:title[@level="a" and @type="main"]', namespaces=NS)
+REFERENCE_JOURNAL_TITLE_XPATH = etree.XPath('./tei:monogr/tei:title', namespaces=NS)
+REFERENCE_DOI_XPATH = etree.XPath('./tei:analytic/tei:idno[@type="doi"]', namespaces=NS)
+REFERENCE_VOLUME_XPATH = etree.XPath('./tei:monogr/tei:imprint/tei:biblScope[@unit="volume"]', namespaces=NS)
+REFERENCE_ISSUE_XPATH = etree.XPath('./tei:monogr/tei:imprint/tei:biblScope[@unit="issue"]', namespaces=NS)
+REFERENCE_YEAR_XPATH = etree.XPath('./tei:monogr/tei:imprint/tei:date[@type="published"]/@when', namespaces=NS)
+REFERENCE_PAGE_FROM_XPATH = etree.XPath('./tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@from', namespaces=NS)
+REFERENCE_PAGE_TO_XPATH = etree.XPath('./tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@to', namespaces=NS)
+
+
+def parse(tei):
     parser = etree.XMLParser(encoding='UTF-8', recover=True)
     tei = tei if not isinstance(tei, text_type) else tei.encode('utf-8')
-    root = etree.fromstring(tei, parser)
+    return etree.fromstring(tei, parser)
+
+
+class ParsedTEI(bytes):
+    """ TEI bytes with records.Header parsed from them in record """
+    record = None
+
+
+def parse_record(tei):
+    """ Return ParsedTEI of TEI """
+    parsed = ParsedTEI(tei if not isinstance(tei, text_type) else tei.encode('utf-8'))
+    parsed.record = tei_to_record(parsed)
+    return parsed
 
-    result = {}
+
+def tei_to_dict(tei):
+    """ Compatibility adapter of tei_to_record, dicts take much more memory than records """
+    return tei_to_record(tei).to_dict()
+
+
+def tei_to_record(tei):
+    """ Return records.Header with references of TEI """
+    root = parse(tei)
+
+    result = records.Header()
 
     year = get_year(root)
     if year and len(year) >= 1:
-        tmp = re.findall(YEAR_RE, str(year[0]))
-        if tmp: result['pubdate'] = tmp[0]
+        tmp = YEAR_PATTERN.findall(str(year[0]))
+        if tmp: result.pubdate = tmp[0]
 
     doi = get_doi(root)
     if doi and len(doi) >= 1:
-        result['DOI'] = doi[0].text
+        result.doi = get_text(doi[0])
 
     publisher = get_publisher(root)
     if publisher and len(publisher) >= 1:
-        result['publisher'] = publisher[0].text
+        result.publisher = records.intern(get_text(publisher[0]))
 
     page_from = get_page_from(root)
     if page_from and len(page_from) == 1:
-        result['start_page'] = str(page_from[0]).replace("-", "").strip()
+        result.start_page = str(page_from[0]).replace("-", "").strip()
 
     page_to = get_page_to(root)
     if page_to and len(page_to) == 1:
-        result['end_page'] = str(page_to[0]).replace("-", "").strip()
+        result.end_page = str(page_to[0]).replace("-", "").strip()
 
     abstract = get_abstract(root)
     if abstract and len(abstract) == 1:
-        result['abstract'] = abstract[0].text
+        result.abstract = get_text(abstract[0])
 
     authors = get_authors(root)
     if authors:
-        result['authors'] = list(map(element_to_author, authors))
+        result.authors = list(map(element_to_author, authors))
 
     keywords = get_keywords(root)
     if keywords and len(keywords) == 1:
-        result['keywords'] = extract_keywords(keywords[0])
+        result.keywords = extract_keywords(keywords[0])
 
     title = get_title(root)
     if title and len(title) == 1:
-        result['title'] = title[0].text
+        result.title = get_text(title[0])
 
     references = get_references(root)
     if references:
-        result['references'] = list(map(element_to_reference, references))
+        result.references = list(map(element_to_reference, references))
 
     return result
 
 
-def element_to_author(el):
-    result = {}
+def iter_references(tei):
+    """ Compatibility adapter of iter_reference_records, yields reference dicts """
+    for reference in iter_reference_records(tei):
+        yield reference.to_dict()
 
-    name = []
 
-    first = el.xpath('.//tei:persName/tei:forename[@type="first"]',
-                     namespaces=NS)
-    if first and len(first) == 1:
-        name.append(first[0].text)
+def iter_reference_records(tei):
+    """ Parse TEI incrementally and yield records.Reference one by one, without building the whole tree """
+    tei = tei if not isinstance(tei, text_type) else tei.encode('utf-8')
+    context = etree.iterparse(io.BytesIO(tei), events=('end',), tag=BIBL_STRUCT_TAG, encoding='UTF-8', recover=True)
+    for event, el in context:
+        parent = el.getparent()
+        # Same elements as get_references: biblStruct in listBibl somewhere under text
+        if parent is None or parent.tag != LIST_BIBL_TAG or next(el.iterancestors(TEXT_TAG), None) is None:
+            continue
+        yield element_to_reference(el)
+        # Processed references are dropped, so memory doesn't grow with the number of references
+        el.clear()
+        while el.getprevious() is not None:
+            del parent[0]
 
-    middle = el.xpath('.//tei:persName/tei:forename[@type="middle"]',
-                      namespaces=NS)
-    if middle and len(middle) == 1:
-        name.append(middle[0].text + '.')
 
-    surname = el.xpath('.//tei:persName/tei:surname', namespaces=NS)
-    if surname and len(surname) == 1:
-        name.append(surname[0].text)
+def get_text(el):
+    """ Text of element, "" if it is empty """
+    return el.text if el.text is not None else ""
 
-    result = ' '.join(name)#['name'] = ' '.join(name)
 
-    return result
+def element_to_author(el):
+    name = []
 
+    first = AUTHOR_FIRST_XPATH(el)
+    if first and len(first) == 1 and first[0].text:
+        name.append(first[0].text)
 
-def extract_keywords(el):
-    return [{'value': e.text} for e in el.xpath('.//tei:term', namespaces=NS)]
+    middle = AUTHOR_MIDDLE_XPATH(el)
+    if middle and len(middle) == 1 and middle[0].text:
+        name.append(middle[0].text + '.')
 
+    surname = AUTHOR_SURNAME_XPATH(el)
+    surname = surname[0].text if surname and len(surname) == 1 else None
+    if surname:
+        name.append(surname)
 
-def element_to_reference(el):
-    result = {}
+    return records.Author(' '.join(name), surname)
 
-    result['ref_title'] = extract_reference_title(el)
 
-    result['authors'] = [
-        element_to_author(e) for e in el.xpath('.//tei:author', namespaces=NS)
-    ]
+def extract_keywords(el):
+    return [e.text for e in KEYWORD_TERM_XPATH(el)]
 
-    result['journal_pubnote'] = extract_reference_pubnote(el)
 
-    return result
+def element_to_reference(el):
+    return records.Reference(
+        extract_reference_title(el),
+        [element_to_author(e) for e in REFERENCE_AUTHORS_XPATH(el)],
+        extract_reference_pubnote(el))
 
 
 def extract_reference_title(el):
-    title = el.xpath(
-        './/tei:analytic/tei:title[@level="a" and @type="main"]',
-        namespaces=NS
-    )
+    title = REFERENCE_TITLE_XPATH(el)
     if title and len(title) == 1:
         return title[0].text
 
 
 def extract_reference_pubnote(el):
-    result = {}
+    result = records.Pubnote()
 
-    journal_title = el.xpath('./tei:monogr/tei:title', namespaces=NS)
+    journal_title = REFERENCE_JOURNAL_TITLE_XPATH(el)
     if journal_title and len(journal_title) == 1:
-        result['journal_title'] = journal_title[0].text
+        result.journal_title = records.intern(get_text(journal_title[0]))
 
-    journal_doi = el.xpath('./tei:analytic/tei:idno[@type="doi"]', namespaces=NS)
+    journal_doi = REFERENCE_DOI_XPATH(el)
     if journal_doi and len(journal_doi) == 1:
-        result['doi'] = journal_doi[0].text.replace("doi:", "")
+        result.doi = get_text(journal_doi[0]).replace("doi:", "")
 
-    journal_volume = el.xpath(
-        './tei:monogr/tei:imprint/tei:biblScope[@unit="volume"]',
-        namespaces=NS
-    )
+    journal_volume = REFERENCE_VOLUME_XPATH(el)
     if journal_volume and len(journal_volume) == 1:
-        result['journal_volume'] = journal_volume[0].text
+        result.journal_volume = get_text(journal_volume[0])
 
-    journal_issue = el.xpath(
-        './tei:monogr/tei:imprint/tei:biblScope[@unit="issue"]',
-        namespaces=NS
-    )
+    journal_issue = REFERENCE_ISSUE_XPATH(el)
     if journal_issue and len(journal_issue) == 1:
-        result['journal_issue'] = journal_issue[0].text
+        result.journal_issue = get_text(journal_issue[0])
 
-    year = el.xpath(
-        './tei:monogr/tei:imprint/tei:date[@type="published"]/@when',
-        namespaces=NS
-    )
+    year = REFERENCE_YEAR_XPATH(el)
     if year and len(year) == 1:
-        tmp = re.findall(YEAR_RE, str(year[0]))
-        if tmp: result['year'] = tmp[0]
-
-    pages = []
+        tmp = YEAR_PATTERN.findall(str(year[0]))
+        if tmp: result.year = tmp[0]
 
-    page_from = el.xpath(
-        './tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@from',
-        namespaces=NS
-    )
+    page_from = REFERENCE_PAGE_FROM_XPATH(el)
     if page_from and len(page_from) == 1:
-        result['start_page'] = str(page_from[0]).replace("-", "").strip()
+        result.start_page = str(page_from[0]).replace("-", "").strip()
 
-    page_to = el.xpath(
-        './tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@to',
-        namespaces=NS
-    )
+    page_to = REFERENCE_PAGE_TO_XPATH(el)
     if page_to and len(page_to) == 1:
-        result['end_page'] = str(page_to[0]).replace("-", "").strip()
+        result.end_page = str(page_to[0]).replace("-", "").strip()
 
     return result
 
 
 def get_abstract(root):
-    return root.xpath('//tei:profileDesc/tei:abstract/tei:p', namespaces=NS)
+    return ABSTRACT_XPATH(root)
 
 
 def get_authors(root):
-    return root.xpath('//tei:fileDesc//tei:author', namespaces=NS)
+    return AUTHORS_XPATH(root)
 
 
 def get_keywords(root):
-    return root.xpath('//tei:profileDesc/tei:textClass/tei:keywords',
-                      namespaces=NS)
+    return KEYWORDS_XPATH(root)
 
 
 def get_references(root):
-    return root.xpath('//tei:text//tei:listBibl/tei:biblStruct', namespaces=NS)
+    return REFERENCES_XPATH(root)
 
 
 def get_title(root):
-    return root.xpath('//tei:titleStmt/tei:title', namespaces=NS)
+    return TITLE_XPATH(root)
 
 def get_year(root):
-    return root.xpath('//tei:publicationStmt/tei:date[@type="published"]/@when', namespaces=NS)
+    return YEAR_XPATH(root)
 
 def get_doi(root):
-    return root.xpath('//tei:sourceDesc/tei:biblStruct/tei:idno[@type="DOI"]', namespaces=NS)
+    return DOI_XPATH(root)
 
 def get_publisher(root):
-    return root.xpath('//tei:sourceDesc/tei:biblStruct/tei:monogr/tei:imprint/tei:publisher', namespaces=NS)
+    return PUBLISHER_XPATH(root)
 
 def get_page_from(root):
-    return root.xpath('//tei:sourceDesc/tei:biblStruct/tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@from', namespaces=NS)
+    return PAGE_FROM_XPATH(root)
 
 def get_page_to(root):
-    return root.xpath('//tei:sourceDesc/tei:biblStruct/tei:monogr/tei:imprint/tei:biblScope[@unit="page"]/@to', namespaces=NS)
\ No newline at end of file
+    return PAGE_TO_XPATH(root)
\ No newline at end of file
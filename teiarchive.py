@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import zlib
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+def decompress(blob):
+    """ Return TEI bytes of archive record """
+    return zlib.decompress(blob)
+
+
+class TEIArchive(object):
+    """ SQLite file with zlib-compressed raw TEI of every processed PDF, added TEI is saved by commit() """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS tei (path TEXT NOT NULL, command TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (path, command))")
+        self._connection.commit()
+
+
+    def add(self, pdf, command, data):
+        """ Save TEI (str or bytes) returned by grobid for pdf """
+        blob = zlib.compress(data.encode('utf-8') if isinstance(data, str) else data)
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO tei (path, command, data) VALUES (?, ?, ?)", (pdf, command, blob))
+
+
+    def commit(self):
+        """ Save TEI added so far, called before the documents are journaled """
+        with self._lock:
+            self._connection.commit()
+
+
+    def count(self, command):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM tei WHERE command = ?", (command,)).fetchone()[0]
+
+
+    def iterate(self, command):
+        """ Yield (pdf, compressed TEI) saved for command, ordered by pdf path """
+        # Separate connection, so records are read lazily while the archive is used elsewhere
+        connection = sqlite3.connect(self.path)
+        try:
+            for pdf, blob in connection.execute("SELECT path, data FROM tei WHERE command = ? ORDER BY path", (command,)):
+                yield pdf, blob
+        finally:
+            connection.close()
+
+
+    def close(self):
+        with self._lock:
+            self._connection.commit()
+            self._connection.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import collections
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+CACHE_FILE_EXT = '.tei'
+
+
+def make_key(digest, command, version, pages = 0):
+    """ Build cache key from PDF sha256, grobid command, grobid version and number of first pages sent (0: whole PDF) """
+    key = "{}.{}.{}".format(digest, command, re.sub(r'[^\w.-]', '_', version))
+    return "{}.p{}".format(key, pages) if pages else key
+
+
+class TEICache(object):
+    """ Persistent on-disk cache of raw TEI returned by grobid with LRU eviction """
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        # Key -> file size, least recently used first
+        self._entries = collections.OrderedDict()
+        os.makedirs(self.path, exist_ok=True)
+        files = list()
+        for root, dirnames, filenames in os.walk(self.path):
+            for filename in filenames:
+                if filename.endswith(CACHE_FILE_EXT):
+                    stat = os.stat(os.path.join(root, filename))
+                    files.append((stat.st_mtime, filename[:-len(CACHE_FILE_EXT)], stat.st_size))
+        for mtime, key, size in sorted(files):
+            self._entries[key] = size
+            self.size += size
+        logger.debug("TEI cache '{}': {} entries, {} bytes".format(self.path, len(self._entries), self.size))
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _get_path(self, key):
+        return os.path.join(self.path, key[:2], key + CACHE_FILE_EXT)
+
+
+    def get(self, key, binary = False):
+        """ Return cached TEI as str (bytes if binary) or None """
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self._get_path(key)
+        try:
+            with open(path, 'rb') as tei_file:
+                data = tei_file.read()
+            # mtime keeps LRU order between runs
+            os.utime(path)
+        except OSError:
+            logger.warning("TEI cache entry '{}' is not readable".format(key))
+            with self._lock:
+                if key in self._entries:
+                    self.size -= self._entries.pop(key)
+            return None
+        return data if binary else data.decode('utf-8')
+
+
+    def put(self, key, data):
+        """ Save TEI (str or bytes) in cache and evict least recently used entries over max_size """
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as tei_file:
+            tei_file.write(data)
+        os.replace(tmp_path, path)
+        evicted = list()
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)
+            self._entries[key] = len(data)
+            self.size += len(data)
+            while self.size > self.max_size and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            logger.debug("Evict '{}' from TEI cache".format(old_key))
+            try:
+                os.remove(self._get_path(old_key))
+            except OSError:
+                pass
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+#
+import pytest
+
+# Modules are in the repository root, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class StubServer(object):
+    """ HTTP/1.1 server with keep-alive on a free local port, respond(method, path, body) returns (status, body bytes).
+        Counts TCP connections and requests """
+    def __init__(self, respond):
+        self.respond = respond
+        self.connections = 0
+        self.requests = 0
+        stub = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super(Handler, self).setup()
+                stub.connections += 1
+
+            def do_GET(self):
+                self.answer(b"")
+
+            def do_POST(self):
+                self.answer(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+            def answer(self, body):
+                stub.requests += 1
+                status, data = stub.respond(self.command, self.path, body)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_address[1])
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    """ stub_server(respond) starts StubServer, servers are stopped after the test """
+    servers = list()
+    def start(respond):
+        servers.append(StubServer(respond))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import aimd
+
+
+def test_limit_grows_by_one_per_limit_successes():
+    limiter = aimd.AIMDLimiter(8)
+    limiter.limit = 2.0
+    for i in range(2):
+        limiter.release(False, 1.0, limiter.acquire())
+    assert abs(limiter.limit - 2.9) < 1e-9
+
+
+def test_limit_is_not_above_max():
+    limiter = aimd.AIMDLimiter(4)
+    for i in range(20):
+        limiter.release(False, 1.0, limiter.acquire())
+    assert limiter.limit == 4
+
+
+def test_overloads_of_one_generation_decrease_once():
+    limiter = aimd.AIMDLimiter(8)
+    generations = [limiter.acquire() for i in range(8)]
+    for generation in generations:
+        limiter.release(True, None, generation)
+    assert limiter.limit == 4
+    # Requests sent at the smaller limit decrease it again
+    generations = [limiter.acquire() for i in range(4)]
+    for generation in generations:
+        limiter.release(True, None, generation)
+    assert limiter.limit == 2
+
+
+def test_limit_is_not_below_min():
+    limiter = aimd.AIMDLimiter(2)
+    for i in range(5):
+        limiter.release(True, None, limiter.acquire())
+    assert limiter.limit == 1
+
+
+def test_overloads_without_generation_decrease_once_per_interval():
+    limiter = aimd.AIMDLimiter(8)
+    for i in range(8):
+        limiter.acquire()
+    for i in range(8):
+        limiter.release(True)
+    assert limiter.limit == 4
+
+
+def test_latency_above_tolerance_is_overload():
+    limiter = aimd.AIMDLimiter(8)
+    limiter.release(False, 1.0, limiter.acquire())
+    for i in range(30):
+        limiter.release(False, 10.0, limiter.acquire())
+        if limiter.limit < 8:
+            break
+    assert limiter.limit == 4
+
+
+def test_large_documents_are_not_overload():
+    limiter = aimd.AIMDLimiter(8)
+    # Server takes 2 seconds per MB with a fixed cost of one MB
+    for i in range(100):
+        size = 18 * aimd.MB if i % 5 == 4 else aimd.MB // 3
+        latency = 2.0 * (aimd.REQUEST_OVERHEAD_MB + size / aimd.MB)
+        limiter.release(False, latency, limiter.acquire(), size)
+    assert limiter.limit == 8
+    assert limiter.generation == 0
+
+
+def test_failed_requests_are_not_latency_samples():
+    limiter = aimd.AIMDLimiter(8)
+    limiter.limit = 4.0
+    limiter.release(False, 1.0, limiter.acquire())
+    for i in range(20):
+        limiter.release(False, None, limiter.acquire())
+    assert limiter.limit == 4.25
+    assert limiter.latency == 1.0
+    assert limiter.baseline_latency == 1.0
+
+
+def test_timeout_before_first_observation():
+    estimator = aimd.TimeoutEstimator(30, 10, 5, 600)
+    assert estimator.timeout(0) == 30
+    assert estimator.timeout(3 * aimd.MB) == 60
+    # Every timeout of the request doubles the next one
+    assert estimator.timeout(3 * aimd.MB, 2) == 240
+
+
+def test_timeout_grows_with_size():
+    estimator = aimd.TimeoutEstimator(30, 10, 1, 600)
+    estimator.observe(aimd.MB, 4.0)
+    # 2 seconds per MB with deviation of 1 second per MB taken 4 times
+    assert estimator.seconds_per_mb == 2.0
+    assert estimator.timeout(0) == 6.0
+    assert estimator.timeout(9 * aimd.MB) == 60.0
+    estimator.observe(aimd.MB, 4.0)
+    assert estimator.seconds_per_mb == 2.0
+    assert estimator.deviation == 0.75
+
+
+def test_timeout_is_within_bounds():
+    estimator = aimd.TimeoutEstimator(30, 10, 20, 100)
+    assert estimator.timeout(100 * aimd.MB) == 100
+    assert estimator.timeout(0, 5) == 100
+    estimator.observe(aimd.MB, 0.2)
+    assert estimator.timeout(0) == 20
+    assert estimator.timeout(1000 * aimd.MB) == 100
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import contextlib
+import concurrent.futures
+#
+import settings
+import utils
+import balancer
+
+
+def test_parse_server():
+    assert balancer.parse_server("http://a:8070/api") == ("http://a:8070/api/", 1.0)
+    assert balancer.parse_server("http://a:8070/api/@2.5") == ("http://a:8070/api/", 2.5)
+
+
+def test_requests_go_to_least_outstanding_per_weight():
+    servers = balancer.Balancer(["http://a/", "http://b/@2"], lambda: None, 3, 10)
+    a, b = servers.endpoints
+    with contextlib.ExitStack() as stack:
+        chosen = [stack.enter_context(servers.endpoint()).url for i in range(6)]
+        # b takes twice as many requests
+        assert chosen.count(b.url) == 4
+        assert (a.outstanding, b.outstanding) == (2, 4)
+    assert (a.outstanding, b.outstanding) == (0, 0)
+    with servers.endpoint() as first:
+        with servers.endpoint() as second:
+            assert (first, second) == (b, a)
+
+
+def test_breaker_opens_after_failures_and_closes_on_success():
+    servers = balancer.Balancer(["http://a/", "http://b/"], lambda: None, 2, 10)
+    a, b = servers.endpoints
+    servers.report(a, False)
+    assert a.is_available(time.time())
+    servers.report(a, False)
+    assert not a.is_available(time.time())
+    assert a.is_available(time.time() + 10)
+    for i in range(3):
+        with servers.endpoint() as endpoint:
+            assert endpoint is b
+    servers.report(a, True)
+    assert a.is_available(time.time()) and a.failures == 0
+
+
+def test_endpoint_coming_back_first_is_tried_when_all_are_down():
+    servers = balancer.Balancer(["http://a/", "http://b/"], lambda: None, 1, 10)
+    a, b = servers.endpoints
+    servers.report(b, False)
+    servers.report(a, False)
+    with servers.endpoint() as endpoint:
+        assert endpoint is b
+
+
+def test_probes_take_dead_servers_out_and_bring_them_back(stub_server):
+    alive = {"up": True}
+    up = stub_server(lambda method, path, body: (200, b"true"))
+    down = stub_server(lambda method, path, body: (200, b"true") if alive["up"] else (503, b""))
+    alive["up"] = False
+    servers = balancer.Balancer([up.url, down.url, "http://127.0.0.1:1/"], lambda: None, 3, 10)
+    servers.probe("isalive", 2)
+    now = time.time()
+    assert [endpoint.is_available(now) for endpoint in servers.endpoints] == [True, False, False]
+    assert (up.requests, down.requests) == (1, 1)
+    # Endpoint failing probes needs one more failure to go out again after it comes back
+    assert servers.endpoints[1].failures == 3
+    alive["up"] = True
+    servers.probe("isalive", 2)
+    assert servers.endpoints[1].is_available(time.time())
+    assert servers.endpoints[1].failures == 0
+
+
+def test_requests_are_spread_over_fake_endpoints(stub_server, monkeypatch):
+    release = threading.Event()
+    def respond(method, path, body):
+        # Requests are answered when all of them were routed
+        release.wait(5)
+        return 200, b"<TEI/>"
+    stubs = [stub_server(respond) for i in range(2)]
+    monkeypatch.setattr(settings, 'GROBID_SERVERS', [stubs[0].url, stubs[1].url + "@3"])
+    monkeypatch.setattr(utils, 'SESSION', None)
+    servers = balancer.Balancer(settings.GROBID_SERVERS, lambda: None, 3, 10)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        results = [executor.submit(utils.get_request, "processHeaderDocument", {'input': ("a.pdf", b"%PDF-1.4")}, binary=True, balancer=servers) for i in range(8)]
+        deadline = time.time() + 5
+        while sum(stub.requests for stub in stubs) < 8 and time.time() < deadline:
+            time.sleep(0.01)
+        assert [endpoint.outstanding for endpoint in servers.endpoints] == [2, 6]
+        release.set()
+        assert [result.result() for result in results] == [b"<TEI/>"] * 8
+    assert [stub.requests for stub in stubs] == [2, 6]
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+#
+import utils
+import checkpoint
+
+
+def write_pdf(path, data = b"%PDF-1.4 test"):
+    with open(path, 'wb') as pdf_file:
+        pdf_file.write(data)
+    return str(path)
+
+
+def test_resume_round_trip(tmp_path):
+    pdf = write_pdf(tmp_path / "a.pdf")
+    failed = write_pdf(tmp_path / "b.pdf")
+    path = str(tmp_path / "out.csv.journal")
+    with checkpoint.Journal(path) as journal:
+        journal.record(pdf, checkpoint.DONE, [10, 20], checkpoint.get_fingerprint(pdf))
+        journal.record(failed, checkpoint.FAILED, [15, 30])
+    with checkpoint.Journal(path, resume=True) as journal:
+        assert journal.output_sizes == [15, 30]
+        assert journal.is_done(pdf)
+        assert not journal.is_done(failed)
+        assert journal.entries[pdf]["sha256"] == utils.get_sha256(pdf)
+
+
+def test_broken_last_line_is_skipped(tmp_path):
+    pdf = write_pdf(tmp_path / "a.pdf")
+    path = str(tmp_path / "out.csv.journal")
+    with checkpoint.Journal(path) as journal:
+        journal.record(pdf, checkpoint.DONE, [10])
+    with open(path, 'a', encoding='utf-8') as journal_file:
+        journal_file.write('{"path": "cut')
+    with checkpoint.Journal(path, resume=True) as journal:
+        assert journal.output_sizes == [10]
+        assert journal.is_done(pdf)
+
+
+def test_changed_and_touched_files(tmp_path, monkeypatch):
+    pdf = write_pdf(tmp_path / "a.pdf")
+    with checkpoint.Journal(str(tmp_path / "j")) as journal:
+        journal.record(pdf, checkpoint.DONE, [0])
+        hashed = list()
+        get_sha256 = utils.get_sha256
+        monkeypatch.setattr(utils, 'get_sha256', lambda path: hashed.append(path) or get_sha256(path))
+        # Same size and mtime: no hashing
+        assert journal.is_done(pdf)
+        assert not hashed
+        # Touched, content is the same
+        os.utime(pdf, (0, 0))
+        assert journal.is_done(pdf)
+        assert hashed == [pdf]
+        # Same size, other content
+        write_pdf(pdf, b"%PDF-1.4 TEST")
+        assert not journal.is_done(pdf)
+        # Other size is not hashed
+        del hashed[:]
+        write_pdf(pdf, b"%PDF-1.5 longer")
+        assert not journal.is_done(pdf)
+        assert not hashed
+
+
+def test_removed_file(tmp_path):
+    pdf = write_pdf(tmp_path / "a.pdf")
+    fingerprint = checkpoint.get_fingerprint(pdf)
+    os.remove(pdf)
+    with checkpoint.Journal(str(tmp_path / "j")) as journal:
+        # Fingerprint taken when the PDF was sent
+        journal.record(pdf, checkpoint.DONE, [0], fingerprint)
+        assert journal.entries[pdf]["size"] == len(b"%PDF-1.4 test")
+        assert not journal.is_done(pdf)
+        # Removed before it was sent
+        journal.record(pdf, checkpoint.FAILED, [0])
+        assert journal.entries[pdf]["sha256"] is None
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import settings
+import utils
+import grobidAPI
+
+
+def start_servers(stub_server, monkeypatch, *versions):
+    """ Grobid stubs answering version requests with versions, None answers HTTP 500 """
+    servers = [stub_server(lambda method, path, body, version = version: (200, version.encode()) if version else (500, b"")) for version in versions]
+    monkeypatch.setattr(settings, 'GROBID_SERVERS', [server.url + "@2" for server in servers])
+    monkeypatch.setattr(utils, 'SESSION', None)
+    return servers
+
+
+def test_version_of_all_servers(stub_server, monkeypatch):
+    servers = start_servers(stub_server, monkeypatch, "0.7.3", '{"version": "0.7.3", "revision": "1"}')
+    assert grobidAPI.get_grobid_version() == "0.7.3"
+    assert [server.requests for server in servers] == [1, 1]
+
+
+def test_no_version_if_servers_differ(stub_server, monkeypatch):
+    start_servers(stub_server, monkeypatch, "0.7.3", "0.8.0")
+    assert grobidAPI.get_grobid_version() is None
+
+
+def test_no_version_if_unknown(stub_server, monkeypatch):
+    start_servers(stub_server, monkeypatch, "0.7.3", None)
+    assert grobidAPI.get_grobid_version() is None
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import metrics
+
+
+def test_take_resets_and_add_merges():
+    child = metrics.Metrics()
+    child.increment('documents', 2)
+    child.observe('parse', 0.002)
+    child.observe('parse', 0.2)
+    taken = child.take()
+    assert child.counters['documents'] == 0
+    assert child.stages['parse'][0] == 0
+    parent = metrics.Metrics()
+    parent.observe('parse', 0.003)
+    parent.add(taken)
+    assert parent.counters['documents'] == 2
+    count, total, maximum, buckets = parent.stages['parse']
+    assert count == 3
+    assert abs(total - 0.205) < 1e-9
+    assert maximum == 0.2
+    assert sum(buckets) == 3
+
+
+def test_server_binds_localhost_by_default():
+    server = metrics.MetricsServer(0)
+    try:
+        assert server.server.server_address[0] == '127.0.0.1'
+    finally:
+        server.close()
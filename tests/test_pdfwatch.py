@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import itertools
+#
+import pytest
+#
+import pdfwatch
+
+
+class FakeWatcher(object):
+    """ Watcher giving events [(seconds after start, [(path, size), ...]), ...] when their time comes """
+    def __init__(self, events):
+        self.events = list(events)
+        self.start = time.time()
+
+
+    def read(self, timeout = None):
+        # Nothing comes after the last event
+        at, found = self.events[0] if self.events else (float('inf'), [])
+        wait = self.start + at - time.time()
+        if timeout is not None and wait > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0, wait))
+        self.events.pop(0)
+        return list(found)
+
+
+def take_batches(watcher, delay, max_size, count):
+    return list(itertools.islice(pdfwatch.iterate_batches(watcher, delay, max_size), count))
+
+
+def test_batch_takes_pdfs_coming_within_delay():
+    watcher = FakeWatcher([(0, [("a.pdf", 1)]), (0.05, [("b.pdf", 2)]), (0.1, [("a.pdf", 3)]), (0.8, [("c.pdf", 4)])])
+    # a.pdf written again in the batch is sent once with its last size
+    assert take_batches(watcher, 0.4, 10, 2) == [[("a.pdf", 3), ("b.pdf", 2)], [("c.pdf", 4)]]
+
+
+def test_batch_stops_at_max_size():
+    watcher = FakeWatcher([(0, [("a.pdf", 1), ("b.pdf", 2)]), (0.05, [("c.pdf", 3)]), (0.1, [("d.pdf", 4)])])
+    started = time.time()
+    batches = take_batches(watcher, 5, 2, 2)
+    assert batches == [[("a.pdf", 1), ("b.pdf", 2)], [("c.pdf", 3), ("d.pdf", 4)]]
+    # Full batches don't wait for the delay
+    assert time.time() - started < 2
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as pdf_file:
+        pdf_file.write(data)
+
+
+def test_polling_watcher_reports_new_and_rewritten_files(tmp_path):
+    root = str(tmp_path)
+    write_file(os.path.join(root, "a.pdf"), b"a" * 10)
+    watcher = pdfwatch.PollingWatcher(root, 0.05)
+    # PDFs already there are not new
+    assert watcher.read(0.3) == []
+    write_file(os.path.join(root, "sub", "b.pdf"), b"b" * 20)
+    write_file(os.path.join(root, "b.txt"), b"b")
+    assert watcher.read(1) == [(os.path.join(root, "sub", "b.pdf"), 20)]
+    write_file(os.path.join(root, "a.pdf"), b"a" * 30)
+    assert watcher.read(1) == [(os.path.join(root, "a.pdf"), 30)]
+    assert watcher.read(0.3) == []
+    # Removed file is new when it comes back
+    os.remove(os.path.join(root, "a.pdf"))
+    assert watcher.read(0.3) == []
+    write_file(os.path.join(root, "a.pdf"), b"a" * 30)
+    assert watcher.read(1) == [(os.path.join(root, "a.pdf"), 30)]
+
+
+def test_polling_watcher_waits_until_file_is_written(tmp_path, monkeypatch):
+    root = str(tmp_path)
+    watcher = pdfwatch.PollingWatcher(root, 0.05)
+    path = os.path.join(root, "a.pdf")
+    sizes = iter([10, 20, 30, 30])
+    # Size of the file grows in the first listings
+    monkeypatch.setattr(pdfwatch.utils, 'iterate_pdfs', lambda path: [(os.path.join(path, "a.pdf"), next(sizes))])
+    assert watcher.read(1) == [(path, 30)]
+
+
+def test_inotify_watcher_reports_written_and_moved_files(tmp_path):
+    root = str(tmp_path / "pdfs")
+    os.makedirs(root)
+    try:
+        watcher = pdfwatch.InotifyWatcher(root)
+    except (OSError, AttributeError, TypeError):
+        pytest.skip("inotify is not available")
+    with watcher:
+        write_file(os.path.join(root, "a.pdf"), b"a" * 10)
+        write_file(str(tmp_path / "b.pdf"), b"b" * 20)
+        os.rename(str(tmp_path / "b.pdf"), os.path.join(root, "b.pdf"))
+        found = list()
+        deadline = time.time() + 2
+        while len(found) < 2 and time.time() < deadline:
+            found.extend(watcher.read(0.1))
+    assert sorted(found) == [(os.path.join(root, "a.pdf"), 10), (os.path.join(root, "b.pdf"), 20)]
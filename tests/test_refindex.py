@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import refindex
+import records
+import GrobidService
+
+
+class ListSink(object):
+    """ Sink keeping committed rows in a list """
+    def __init__(self):
+        self.rows = list()
+        self._pending = list()
+
+
+    def write(self, row):
+        self._pending.append(row)
+
+
+    def commit(self):
+        self.rows.extend(self._pending)
+        self._pending = list()
+        return False
+
+
+    def rollback(self):
+        self._pending = list()
+
+
+    def flush(self):
+        return len(self.rows)
+
+
+    def truncate(self, position):
+        del self.rows[position:]
+
+
+    def close(self):
+        pass
+
+
+def get_key(title, doi = None, journal_title = None, year = "2001", author = "Ann Lee"):
+    reference = records.Reference(title, [records.Author(author, author.split()[-1])], records.Pubnote(journal_title=journal_title, doi=doi, year=year))
+    rows = list(GrobidService.iterate_references_rows("a.pdf", [reference], 1, with_keys=True))
+    return rows[0][1]
+
+
+def test_make_key():
+    assert refindex.make_key(" https://doi.org/10.1000/ABC ", "Title", "2001", "Lee") == "doi:10.1000/abc"
+    assert refindex.make_key(None, "  Élan, vital! ", " 2001", "Ann Lee") == "title:elan vital|2001|lee"
+    assert refindex.make_key("", "", "2001", "Lee") is None
+
+
+def test_work_key_uses_own_title():
+    assert get_key("A study", journal_title="Nature") == get_key("A study")
+    assert get_key("A study", doi="10.1/x", journal_title="Nature") == "doi:10.1/x"
+    # References with only a journal title are never merged
+    assert get_key(None, journal_title="Nature") is None
+    assert get_key(None, doi="10.1/y", journal_title="Nature") == "doi:10.1/y"
+
+
+def test_dedup_sink_writes_every_work_once(tmp_path):
+    path = str(tmp_path / "works.index")
+    citations, works = ListSink(), ListSink()
+    with refindex.DedupSink(refindex.ReferenceIndex(path), citations, works) as sink:
+        sink.write(["a.pdf", "doi:10.1/x", "X", "2001"])
+        sink.write(["a.pdf", None, "Nature", "2002"])
+        sink.commit()
+        sink.write(["b.pdf", "doi:10.1/x", "X again", "2001"])
+        sink.write(["b.pdf", None, "Nature", "2003"])
+        sink.commit()
+        # Works of a rolled back document are forgotten
+        sink.write(["c.pdf", "title:lost|2004|", "Lost", "2004"])
+        sink.rollback()
+        sink.write(["d.pdf", "title:lost|2004|", "Lost", "2004"])
+        sink.commit()
+        sink.flush()
+    assert citations.rows == [["a.pdf", 1], ["a.pdf", 2], ["b.pdf", 1], ["b.pdf", 3], ["d.pdf", 4]]
+    assert works.rows == [[1, "X", "2001"], [2, "Nature", "2002"], [3, "Nature", "2003"], [4, "Lost", "2004"]]
+    # Keys of previous runs are matched by the index file
+    citations, works = ListSink(), ListSink()
+    with refindex.DedupSink(refindex.ReferenceIndex(path), citations, works) as sink:
+        sink.write(["e.pdf", "doi:10.1/x", "X", "2001"])
+        sink.write(["e.pdf", "title:new|2005|", "New", "2005"])
+        sink.commit()
+    assert citations.rows == [["e.pdf", 1], ["e.pdf", 5]]
+    assert works.rows == [[5, "New", "2005"]]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+#
+import settings
+import utils
+import refindex
+import scholar
+
+
+def test_rows_dont_wait_for_lookups(tmp_path, monkeypatch):
+    release = threading.Event()
+    def get_count(title, using_TOR = False):
+        release.wait(5)
+        if title == "Broken":
+            raise ValueError(title)
+        return len(title)
+    monkeypatch.setattr(utils, 'get_count_from_scholar', get_count)
+    with scholar.Enricher(str(tmp_path / "scholar.db"), 3600, 100) as enricher:
+        rows = [["a.pdf", "Some title", 0], ["a.pdf", "Broken", 0], ["a.pdf", "Some title", 0], ["a.pdf", "", 0]]
+        enricher.enrich(rows, 1, 2)
+        assert [row[2] for row in rows] == [None, None, None, None]
+        release.set()
+    # Counts came after the rows, once per title, failed lookup has no count
+    assert sorted(enricher.drain()) == [("Broken", None), ("Some title", len("Some title"))]
+    assert enricher.stats["failed"] == 1
+    # Found count is in the cache, failed lookup is kept so it isn't repeated
+    assert list(enricher._futures) == [refindex.normalize_text("Broken")]
+
+
+def test_cached_counts_are_set_in_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils, 'get_count_from_scholar', lambda title, using_TOR = False: 7)
+    path = str(tmp_path / "scholar.db")
+    with scholar.Enricher(path, 3600, 100) as enricher:
+        enricher.lookup("Some title").result()
+    with scholar.Enricher(path, 3600, 100) as enricher:
+        rows = [["a.pdf", "Some title", 0]]
+        enricher.enrich(rows, 1, 2)
+        assert rows[0][2] == 7
+        assert enricher.stats["cache_hits"] == 1
+        assert not enricher._futures
+        assert enricher.drain() == []
+
+
+def test_refused_lookup_pauses_lookups(tmp_path, stub_server, monkeypatch):
+    server = stub_server(lambda method, path, body: (429, b"Too Many Requests"))
+    monkeypatch.setattr(settings, 'SCHOLAR_SEARCH', server.url + "scholar?q={0}")
+    monkeypatch.setattr(settings, 'SCHOLAR_BURST', 1)
+    monkeypatch.setattr(settings, 'SCHOLAR_PAUSE', 60)
+    monkeypatch.setattr(utils, 'SESSION', None)
+    monkeypatch.setattr(utils, '_COOKIES_LOADED', True)
+    enricher = scholar.Enricher(str(tmp_path / "scholar.db"), 3600, 100)
+    try:
+        # Refused request is not retried
+        assert enricher.lookup("Some title").result(5) == scholar.FAILED_COUNT
+        assert server.requests == 1
+        assert enricher.stats["failed"] == 1
+        # Next lookup waits for the pause instead of sending at the rate limit
+        lookup = enricher.lookup("Other title")
+        time.sleep(0.5)
+        assert not lookup.done()
+        assert server.requests == 1
+    finally:
+        enricher.close(wait=False)
+    assert lookup.result(5) == scholar.FAILED_COUNT
+    assert enricher.stats["dropped"] == 1
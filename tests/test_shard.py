@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import os
+import argparse
+#
+import pytest
+#
+import settings
+import sinks
+import GrobidService
+
+
+def test_parse_shard():
+    assert settings.parse_shard("2/4") == (2, 4)
+    for value in ("2", "a/4", "0/4", "5/4"):
+        with pytest.raises(argparse.ArgumentTypeError):
+            settings.parse_shard(value)
+    assert settings.get_shard_path("out.csv", 2, 4) == "out-shard2of4.csv"
+
+
+@pytest.mark.parametrize("order", [settings.PATH_ORDER, settings.LARGEST_FIRST_ORDER, settings.SMALLEST_FIRST_ORDER])
+def test_merged_shards_are_in_order_of_one_run(tmp_path, monkeypatch, order):
+    pdfs_path = str(tmp_path / "pdfs")
+    monkeypatch.setattr(settings, 'PDFS_PATH', pdfs_path)
+    monkeypatch.setattr(settings, 'ORDER', order)
+    monkeypatch.setattr(settings, 'OUTPUT_FORMAT', sinks.CSV_FORMAT)
+    monkeypatch.setattr(settings, 'MERGE_SHARDS', 3)
+    # Same names in nested dirs, sizes not in path order
+    sized = [(os.path.join(pdfs_path, *name.split('/')), size) for name, size in
+             [("a.pdf", 30), ("a/a.pdf", 10), ("a/b/a.pdf", 20), ("b.pdf", 10), ("b/a.pdf", 500), ("c.pdf", 9)]]
+    one_run = sorted(sized, key=lambda pdf: GrobidService.get_order_key(*pdf))
+    columns = (("file", str), ("title", str))
+    path = str(tmp_path / "out.csv")
+    for number in range(1, 4):
+        with sinks.open_sink(sinks.CSV_FORMAT, settings.get_shard_path(path, number, 3), "references", (GrobidService.ORDER_COLUMN,) + columns) as sink:
+            for pdf, size in one_run[number - 1::3]:
+                for i in range(2):
+                    sink.write([GrobidService.get_order_key(pdf, size), os.path.basename(pdf), "{} {}".format(pdf, i)])
+                sink.commit()
+    GrobidService.merge_shards(path, "references", columns)
+    merged = list(sinks.read_rows(sinks.CSV_FORMAT, path, "references", columns))
+    assert merged == [[os.path.basename(pdf), "{} {}".format(pdf, i)] for pdf, size in one_run for i in range(2)]
+    if order == settings.LARGEST_FIRST_ORDER:
+        assert [size for pdf, size in one_run] == [500, 30, 20, 10, 10, 9]
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import pytest
+#
+import sinks
+
+COLUMNS = (("file", str), ("title", str), ("count", int))
+FILE_FORMATS = [sinks.CSV_FORMAT, sinks.JSONL_FORMAT, sinks.SQLITE_FORMAT]
+
+
+def read(output_format, path):
+    # CSV values are read back as strings
+    return [[str(value) for value in row] for row in sinks.read_rows(output_format, path, "references", COLUMNS)]
+
+
+def expected(*rows):
+    return [[str(value) for value in row] for row in rows]
+
+
+@pytest.mark.parametrize("output_format", FILE_FORMATS + [sinks.PARQUET_FORMAT])
+def test_rolled_back_document_is_not_written(tmp_path, output_format):
+    if not sinks.is_available(output_format):
+        pytest.skip("pyarrow is not installed")
+    path = str(tmp_path / "out")
+    with sinks.open_sink(output_format, path, "references", COLUMNS) as sink:
+        sink.write(["a.pdf", "First", 1, "Ann Lee"])
+        sink.commit()
+        sink.write(["b.pdf", "Broken", 2])
+        sink.rollback()
+        sink.write(["c.pdf", "Third", 3, "Bob", "Eve"])
+        sink.commit()
+        # Rows of a document not committed yet are not flushed
+        sink.write(["d.pdf", "Cut", 4])
+        sink.flush()
+    assert read(output_format, path) == expected(["a.pdf", "First", 1, "Ann Lee"], ["c.pdf", "Third", 3, "Bob", "Eve"])
+
+
+@pytest.mark.parametrize("output_format", FILE_FORMATS)
+def test_resume_truncates_to_journaled_position(tmp_path, output_format):
+    path = str(tmp_path / "out")
+    with sinks.open_sink(output_format, path, "references", COLUMNS) as sink:
+        sink.write(["a.pdf", "First", 1])
+        sink.commit()
+        position = sink.flush()
+        sink.write(["b.pdf", "Not journaled", 2])
+        sink.commit()
+    with sinks.open_sink(output_format, path, "references", COLUMNS, resume=True) as sink:
+        sink.truncate(position)
+        sink.write(["b.pdf", "Again", 2])
+        sink.commit()
+    assert read(output_format, path) == expected(["a.pdf", "First", 1], ["b.pdf", "Again", 2])
+
+
+def test_commit_asks_for_flush_after_batch_size(tmp_path):
+    with sinks.open_sink(sinks.CSV_FORMAT, str(tmp_path / "out.csv"), "references", COLUMNS) as sink:
+        sink.batch_size = 2
+        sink.flush_interval = None
+        sink.write(["a.pdf", "First", 1])
+        assert not sink.commit()
+        sink.write(["b.pdf", "Second", 2])
+        assert sink.commit()
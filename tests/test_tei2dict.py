@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import tei2dict
+
+TEI = b'''<?xml version="1.0" encoding="UTF-8"?>
+<TEI xmlns="http://www.tei-c.org/ns/1.0">
+<teiHeader xml:lang="en"><fileDesc><titleStmt><title level="a" type="main">A Study of Things</title></titleStmt>
+<publicationStmt><publisher>ACME</publisher><date type="published" when="2015-03-01">2015</date></publicationStmt>
+<sourceDesc><biblStruct><analytic>
+<author><persName><forename type="first">John</forename><forename type="middle">Q</forename><surname>Smith</surname></persName></author>
+<author><persName><forename type="first">Ann</forename><surname>Lee</surname></persName></author>
+</analytic><monogr><imprint><publisher/><biblScope unit="page" from="10-" to="20"/></imprint></monogr>
+<idno type="DOI">10.1000/xyz</idno></biblStruct></sourceDesc></fileDesc>
+<profileDesc><textClass><keywords><term>alpha</term><term>beta</term></keywords></textClass>
+<abstract><p/></abstract></profileDesc></teiHeader>
+<text><back><div><listBibl>
+<biblStruct xml:id="b0"><analytic><title level="a" type="main">First reference</title>
+<author><persName><forename type="first">Bob</forename><surname>Ref</surname></persName></author>
+<idno type="doi">doi:10.1/0</idno></analytic>
+<monogr><title level="j">Journal</title><imprint><biblScope unit="volume">7</biblScope><biblScope unit="issue">2</biblScope>
+<biblScope unit="page" from="11" to="21"/><date type="published" when="1999"/></imprint></monogr></biblStruct>
+<biblStruct xml:id="b1"><analytic><title level="a" type="main"/></analytic>
+<monogr><title level="j"/><imprint><biblScope unit="volume"/><biblScope unit="issue"/>
+<biblScope unit="page" from="-" to="5"/><date type="published" when="n.d."/></imprint></monogr></biblStruct>
+<biblStruct><monogr><imprint><date type="published" when="2001"/></imprint></monogr></biblStruct>
+</listBibl></div></back></text></TEI>'''
+
+# tei2dict.tei_to_dict of TEI before records were added
+EXPECTED = {
+    'pubdate': '2015',
+    'DOI': '10.1000/xyz',
+    'publisher': None,
+    'start_page': '10',
+    'end_page': '20',
+    'abstract': None,
+    'authors': ['John Q. Smith', 'Ann Lee'],
+    'keywords': [{'value': 'alpha'}, {'value': 'beta'}],
+    'title': 'A Study of Things',
+    'references': [
+        {'ref_title': 'First reference', 'authors': ['Bob Ref'],
+         'journal_pubnote': {'journal_title': 'Journal', 'doi': '10.1/0', 'journal_volume': '7', 'journal_issue': '2', 'year': '1999', 'start_page': '11', 'end_page': '21'}},
+        {'ref_title': None, 'authors': [],
+         'journal_pubnote': {'journal_title': None, 'journal_volume': None, 'journal_issue': None, 'start_page': '', 'end_page': '5'}},
+        {'ref_title': None, 'authors': [], 'journal_pubnote': {'year': '2001'}},
+    ],
+}
+
+
+def test_tei_to_dict_is_the_same_as_before_records():
+    assert tei2dict.tei_to_dict(TEI) == EXPECTED
+    assert tei2dict.tei_to_dict(TEI.decode('utf-8')) == EXPECTED
+
+
+def test_streamed_references_are_the_same():
+    assert list(tei2dict.iter_references(TEI)) == EXPECTED['references']
+
+
+def test_empty_elements_are_empty_in_rows():
+    header = tei2dict.tei_to_record(TEI)
+    assert header.to_row("a.pdf")[:5] == ["a.pdf", "A Study of Things", "2015", "10.1000/xyz", ""]
+    rows = [reference.to_row("a.pdf") for reference in header.references]
+    assert rows[1][:7] == ["a.pdf", "", "", "", "", "5", 0]
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+import teiarchive
+
+
+def test_added_tei_is_saved_by_commit(tmp_path):
+    path = str(tmp_path / "archive.db")
+    with teiarchive.TEIArchive(path) as archive:
+        archive.add("b.pdf", "header", "<TEI>b</TEI>")
+        archive.add("a.pdf", "header", b"<TEI>a</TEI>")
+        # Readers see only committed TEI
+        assert archive.count("header") == 2
+        assert list(archive.iterate("header")) == []
+        archive.commit()
+        assert [(pdf, teiarchive.decompress(blob)) for pdf, blob in archive.iterate("header")] == [("a.pdf", b"<TEI>a</TEI>"), ("b.pdf", b"<TEI>b</TEI>")]
+        assert list(archive.iterate("references")) == []
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import os
+#
+import teicache
+
+
+def test_key_has_trimmed_pages():
+    whole = teicache.make_key("ab12", "processHeaderDocument", "0.5.1")
+    assert whole == "ab12.processHeaderDocument.0.5.1"
+    assert teicache.make_key("ab12", "processHeaderDocument", "0.5.1", 2) == whole + ".p2"
+    assert teicache.make_key("ab12", "processHeaderDocument", "0.5.1", 3) != whole + ".p2"
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    path = str(tmp_path / "cache")
+    cache = teicache.TEICache(path, 25)
+    cache.put("aa1", b"0123456789")
+    cache.put("bb2", "0123456789")
+    # Used entry is not the oldest anymore
+    assert cache.get("aa1") == "0123456789"
+    cache.put("cc3", b"0123456789")
+    assert cache.get("bb2") is None
+    assert cache.get("aa1", True) == b"0123456789"
+    assert len(cache) == 2
+    assert cache.size == 20
+    assert not os.path.exists(os.path.join(path, "bb", "bb2" + teicache.CACHE_FILE_EXT))
+    # Entries of the last run are found again
+    assert len(teicache.TEICache(path, 25)) == 2
+
+
+def test_entry_over_max_size_is_kept_alone(tmp_path):
+    cache = teicache.TEICache(str(tmp_path), 5)
+    cache.put("aa1", b"0123456789")
+    cache.put("bb2", b"0123456789")
+    assert cache.get("aa1") is None
+    assert cache.get("bb2") == "0123456789"
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import os
+import csv
+import concurrent.futures
+#
+import pytest
+import urllib3.filepost
+#
+import settings
+import utils
+import balancer
+import GrobidService
+
+PDF = b"%PDF-1.4\n" + b"1 0 obj << /Type /Catalog >> endobj\n" * 4 + b"trailer << /Root 1 0 R >>\n%%EOF\n"
+
+
+def write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as pdf_file:
+        pdf_file.write(data)
+    return path
+
+
+def test_connections_are_reused_with_several_servers(stub_server, monkeypatch):
+    servers = [stub_server(lambda method, path, body: (200, b"<TEI/>")) for i in range(2)]
+    monkeypatch.setattr(settings, 'WORKERS', 4)
+    monkeypatch.setattr(settings, 'GROBID_SERVERS', [server.url for server in servers])
+    monkeypatch.setattr(utils, 'SESSION', None)
+    servers_balancer = balancer.Balancer(settings.GROBID_SERVERS, lambda: None, 3, 10)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(executor.map(lambda i: utils.get_request("processHeaderDocument", {'input': ("a.pdf", b"%PDF-1.4")}, binary=True, balancer=servers_balancer), range(200)))
+    assert results == [b"<TEI/>"] * 200
+    assert sum(server.requests for server in servers) == 200
+    # Every server keeps its pooled connections while requests switch between servers
+    for server in servers:
+        assert 0 < server.connections <= settings.WORKERS
+
+
+@pytest.mark.parametrize("data, reason", [
+    (PDF, None),
+    (PDF[:40], "too small"),
+    (b"<html>" + PDF, None),
+    (b" " * utils.HEADER_BYTES + PDF, "not a PDF"),
+    (PDF[:-7], "truncated"),
+    (PDF.replace(b"/Root 1 0 R", b"/Root 1 0 R /Encrypt 2 0 R"), "encrypted"),
+    (b"%PDF-1.4\n/Encrypt 2 0 R\n" + b" " * utils.PREFLIGHT_BYTES + PDF, "encrypted"),
+])
+def test_check_pdf(tmp_path, data, reason):
+    path = write_file(str(tmp_path / "a.pdf"), data)
+    found = utils.check_pdf(path, len(data))
+    assert found == reason if reason is None else found.startswith(reason)
+
+
+def test_check_pdf_size_limits(tmp_path, monkeypatch):
+    path = write_file(str(tmp_path / "a.pdf"), PDF)
+    assert utils.check_pdf(path, None) == "can't read file"
+    monkeypatch.setattr(settings, 'MAX_PDF_SIZE', len(PDF) - 1)
+    assert utils.check_pdf(path, len(PDF)).startswith("too large")
+
+
+def test_iterate_pdfs_in_path_order(tmp_path):
+    root = str(tmp_path)
+    for name in ["b.pdf", "a/b.pdf", "a.pdf", "a/a/c.pdf", "a-b.pdf", "notes.txt"]:
+        write_file(os.path.join(root, *name.split('/')), PDF)
+    found = [os.path.relpath(path, root).replace(os.sep, '/') for path, size in utils.iterate_pdfs(root)]
+    assert found == sorted(found) == ["a-b.pdf", "a.pdf", "a/a/c.pdf", "a/b.pdf", "b.pdf"]
+    assert list(utils.iterate_pdfs(os.path.join(root, "missing"))) == []
+
+
+@pytest.mark.parametrize("order, names", [
+    (settings.PATH_ORDER, ["a.pdf", "b/c.pdf", "d.pdf"]),
+    (settings.LARGEST_FIRST_ORDER, ["b/c.pdf", "d.pdf", "a.pdf"]),
+    (settings.SMALLEST_FIRST_ORDER, ["a.pdf", "d.pdf", "b/c.pdf"]),
+])
+def test_discovered_pdfs_are_checked_and_ordered(tmp_path, monkeypatch, order, names):
+    root = str(tmp_path / "pdfs")
+    monkeypatch.setattr(settings, 'PDFS_PATH', root)
+    monkeypatch.setattr(settings, 'ORDER', order)
+    monkeypatch.setattr(settings, 'SHARD', None)
+    monkeypatch.setattr(settings, 'REJECTED_FILE', str(tmp_path / "rejected.csv"))
+    write_file(os.path.join(root, "a.pdf"), PDF)
+    write_file(os.path.join(root, "b", "c.pdf"), PDF.replace(b"endobj", b"endobj " * 20))
+    write_file(os.path.join(root, "d.pdf"), PDF.replace(b"endobj", b"endobj " * 5))
+    write_file(os.path.join(root, "e.pdf"), b"not a PDF" * 20)
+    found = [os.path.relpath(path, root).replace(os.sep, '/') for path in GrobidService.discover_pdfs()]
+    assert found == names
+    with open(settings.REJECTED_FILE, newline='') as rejected_file:
+        assert list(csv.reader(rejected_file)) == [[os.path.join(root, "e.pdf"), "not a PDF"]]
+
+
+def record_maps(monkeypatch):
+    """ Returns list of files mapped by utils.map_file from now on """
+    maps = list()
+    map_file = utils.map_file
+    def record(path):
+        maps.append(map_file(path))
+        return maps[-1]
+    monkeypatch.setattr(utils, 'map_file', record)
+    return maps
+
+
+def test_upload_body_is_multipart_of_urllib3(tmp_path, monkeypatch):
+    path = write_file(str(tmp_path / "a.pdf"), PDF)
+    monkeypatch.setattr(urllib3.filepost, 'choose_boundary', lambda: "0123456789abcdef")
+    maps = record_maps(monkeypatch)
+    body, content_type = utils.encode_files({'input': ("a.pdf", path), 'other': ("b.pdf", b"%PDF-1.4 b")})
+    expected, expected_type = urllib3.encode_multipart_formdata({'input': ("a.pdf", PDF), 'other': ("b.pdf", b"%PDF-1.4 b")}, boundary="0123456789abcdef")
+    assert content_type == expected_type
+    assert len(body) == len(expected)
+    # Read in chunks crossing the parts, then again after seek like a retry
+    assert b"".join(iter(lambda: body.read(7), b"")) == expected
+    assert body.sent_time is not None
+    body.seek(0)
+    assert body.read() == expected
+    body.close()
+    assert len(maps) == 1 and maps[0].closed
+
+
+def test_mapped_files_are_closed_on_errors(tmp_path, monkeypatch):
+    path = write_file(str(tmp_path / "a.pdf"), PDF)
+    maps = record_maps(monkeypatch)
+    with pytest.raises(OSError):
+        utils.encode_files({'input': ("a.pdf", path), 'other': ("b.pdf", str(tmp_path / "missing.pdf"))})
+    assert len(maps) == 1 and maps[0].closed
+    def fail(*args):
+        raise ValueError("request failed")
+    monkeypatch.setattr(utils, '_send_request', fail)
+    with pytest.raises(ValueError):
+        utils.get_request("processHeaderDocument", {'input': ("a.pdf", path)})
+    assert len(maps) == 2 and maps[1].closed
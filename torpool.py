@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+import os
+import queue
+import tempfile
+import threading
+import contextlib
+import logging
+#
+from torrequest import TorRequest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+# Grobid and scholar answer these when a client sends too much, a new identity helps
+ROTATE_STATUS_CODES = (429, 503)
+
+
+class TorCircuit(object):
+    """ Long-lived TorRequest with identity rotation policy """
+    def __init__(self, tor_request, rotate_every):
+        self.tor_request = tor_request
+        self.rotate_every = rotate_every
+        self.requests_count = 0
+
+
+    def rotate(self):
+        logger.debug("Reset TOR identity on port {}".format(self.tor_request.proxy_port))
+        self.tor_request.reset_identity()
+        self.requests_count = 0
+
+
+    def post(self, *args, **kwargs):
+        response = self.tor_request.post(*args, **kwargs)
+        self.requests_count += 1
+        if response.status_code in ROTATE_STATUS_CODES or (self.rotate_every and self.requests_count >= self.rotate_every):
+            self.rotate()
+        return response
+
+
+class TorPool(object):
+    """ Pool of TOR circuits, each on its own SocksPort/ControlPort pair, reused across requests """
+    def __init__(self, size, tor_app, rotate_every = 0, base_port = 9050):
+        self.size = size
+        self.tor_app = tor_app
+        self.rotate_every = rotate_every
+        self.base_port = base_port
+        self._idle = queue.Queue()
+        self._circuits = list()
+        # Numbers of circuits not started yet, circuit #n uses ports base_port + 2n and base_port + 2n + 1
+        self._free_numbers = list(range(size))
+        self._lock = threading.Lock()
+
+
+    def _create_circuit(self, number):
+        proxy_port = self.base_port + 2 * number
+        logger.debug("Start TOR circuit #{} on ports {}/{}".format(number, proxy_port, proxy_port + 1))
+        tor_request = TorRequest(proxy_port=proxy_port, ctrl_port=proxy_port + 1, tor_app=self.tor_app,
+                                 data_dir=os.path.join(tempfile.gettempdir(), "grobid-tor-{}".format(proxy_port)))
+        return TorCircuit(tor_request, self.rotate_every)
+
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        # Circuits are started on demand, a short run doesn't wait for the whole pool
+        with self._lock:
+            number = self._free_numbers.pop(0) if self._free_numbers else None
+        if number is None:
+            return self._idle.get()
+        try:
+            circuit = self._create_circuit(number)
+        except:
+            with self._lock:
+                self._free_numbers.append(number)
+            raise
+        with self._lock:
+            self._circuits.append(circuit)
+        return circuit
+
+
+    @contextlib.contextmanager
+    def circuit(self):
+        """ Take circuit from pool for one request """
+        circuit = self._acquire()
+        try:
+            yield circuit
+        finally:
+            self._idle.put(circuit)
+
+
+    def close(self):
+        with self._lock:
+            circuits, self._circuits = self._circuits, list()
+        for circuit in circuits:
+            circuit.tor_request.close()
@@ -9,11 +9,12 @@ from stem.process import launch_tor_with_config
 
 class TorRequest(object):
     """ Provides a connection to the TOP network """
-    def __init__(self, proxy_port=9050, ctrl_port=9051, password=None, tor_app = None):
+    def __init__(self, proxy_port=9050, ctrl_port=9051, password=None, tor_app = None, data_dir = None):
         self.proxy_port = proxy_port
         self.ctrl_port = ctrl_port
         self._tor_proc = None
         self.tor_cmd = tor_app
+        self.data_dir = data_dir
         if not self._tor_process_exists():
             self._tor_proc = self._launch_tor()
         self.ctrl = Controller.from_port(port=self.ctrl_port)
@@ -35,11 +36,15 @@ class TorRequest(object):
 
 
     def _launch_tor(self):
-        return launch_tor_with_config(
-            config={
+        config = {
             'SocksPort': str(self.proxy_port),
             'ControlPort': str(self.ctrl_port)
-            },
+            }
+        # Several tor processes can't share one data directory
+        if self.data_dir:
+            config['DataDirectory'] = self.data_dir
+        return launch_tor_with_config(
+            config=config,
             tor_cmd=self.tor_cmd,
             take_ownership=True)
 
@@ -1,86 +1,344 @@
 # -*- coding: utf-8 -*-
 import os, logging, re, traceback, sys
+import io
 import requests
+import urllib3
+import urllib3.fields, urllib3.filepost
+import mmap
 import time
-#
-import browsercookie
+import hashlib
+import threading
+import contextlib
 #
 import settings
-from bs4 import BeautifulSoup
-from torrequest import TorRequest
+import aimd
+import metrics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-SESSION = requests.Session()
-SESSION.cookies = browsercookie.chrome()
+SESSION = None
+_SESSION_LOCK = threading.Lock()
+# Chrome cookies are needed only by Google Scholar requests
+_COOKIES_LOADED = False
+_COOKIES_LOCK = threading.Lock()
+
+def get_session():
+    """ Return HTTP session shared by all requests, created on first use """
+    global SESSION
+    with _SESSION_LOCK:
+        if SESSION is None:
+            SESSION = requests.Session()
+            # A pool per grobid server and one for Scholar, with a pooled connection per worker in each,
+            # otherwise parallel uploads and switches between servers drop and reopen connections
+            pools = len(settings.GROBID_SERVERS) + 1
+            SESSION.mount('http://', requests.adapters.HTTPAdapter(pool_connections=pools, pool_maxsize=settings.WORKERS))
+            SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=pools, pool_maxsize=settings.WORKERS))
+        return SESSION
+
+TOR_POOL = None
+_TOR_POOL_LOCK = threading.Lock()
+
+def get_tor_pool():
+    """ Return TOR pool shared by all requests, started on first use """
+    global TOR_POOL
+    with _TOR_POOL_LOCK:
+        if TOR_POOL is None:
+            # stem is only needed with TOR
+            import torpool
+            TOR_POOL = torpool.TorPool(settings.TOR_CIRCUITS, settings.TOR_APP, settings.TOR_ROTATE_EVERY, settings.TOR_BASE_PORT)
+        return TOR_POOL
+
+def close_tor_pool():
+    global TOR_POOL
+    with _TOR_POOL_LOCK:
+        if TOR_POOL is not None:
+            TOR_POOL.close()
+            TOR_POOL = None
 
 def _update_cookies():
     """ Load cookies from Chrome """
-    global SESSION
-    SESSION.cookies = browsercookie.chrome()
+    global _COOKIES_LOADED
+    # Decrypting Chrome cookie store is slow, it's done once by the first Scholar request
+    with _COOKIES_LOCK:
+        if _COOKIES_LOADED:
+            return
+        import browsercookie
+        get_session().cookies = browsercookie.chrome()
+        _COOKIES_LOADED = True
 
 
-def get_path_of_pdfs():
-    return sorted(
-        [os.path.join(root, filename) for root, dirnames, filenames in os.walk(settings.PDFS_PATH) for filename in
-            filenames if filename.endswith('.pdf') and os.path.getsize(os.path.join(root, filename)) > 0])
+HASH_CHUNK_SIZE = 1024 * 1024
+PDF_HEADER = b"%PDF-"
+PDF_TRAILER = b"%%EOF"
+PDF_ENCRYPT = b"/Encrypt"
+# Header has to be in the first 1024 bytes, check_pdf reads this number of bytes from both ends of file
+HEADER_BYTES = 1024
+PREFLIGHT_BYTES = 4096
+
+
+def iterate_pdfs(path):
+    """ Yield (path, size) of *.pdf files under path in the order of sorted paths, while the tree is still walked """
+    try:
+        with os.scandir(path) as scan:
+            # Dir "a" sorts after file "a.pdf" like its files "a/..." do in sorted paths
+            entries = sorted(scan, key=lambda entry: entry.name + os.sep if entry.is_dir() else entry.name)
+    except OSError as error:
+        logger.warning("Can't list '{}': {}".format(path, error))
+        return
+    for entry in entries:
+        if entry.is_dir():
+            # Like os.walk, links to dirs are not followed
+            if not entry.is_symlink():
+                yield from iterate_pdfs(entry.path)
+        elif entry.name.endswith('.pdf'):
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                size = None
+            yield entry.path, size
+
+
+def check_pdf(path, size):
+    """ Cheap check that grobid can read the file, returns the reason to reject it or None """
+    if size is None:
+        return "can't read file"
+    if size < settings.MIN_PDF_SIZE:
+        return "too small ({} bytes)".format(size)
+    if settings.MAX_PDF_SIZE and size > settings.MAX_PDF_SIZE:
+        return "too large ({} MB)".format(size // (1024 * 1024))
+    try:
+        with open(path, 'rb') as pdf_file:
+            head = pdf_file.read(PREFLIGHT_BYTES)
+            pdf_file.seek(max(0, size - PREFLIGHT_BYTES))
+            tail = pdf_file.read(PREFLIGHT_BYTES)
+    except OSError as error:
+        return "can't read file: {}".format(error)
+    if PDF_HEADER not in head[:HEADER_BYTES]:
+        return "not a PDF"
+    if PDF_TRAILER not in tail:
+        return "truncated, no %%EOF"
+    # Encryption dictionary is referenced from the trailer, at the start of linearized files
+    if PDF_ENCRYPT in tail or PDF_ENCRYPT in head:
+        return "encrypted"
+    return None
+
+def get_sha256(path):
+    """ Return hex sha256 of file content """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as pdf_file:
+        for chunk in iter(lambda: pdf_file.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
 
 # Region for work with good cookies
 DONT_TOUCH_KEYS_IN_COOKIES = ['SSID', 'SID', 'HSID']
 def del_gs_cookies():
     """ Function del google scholar cookies """
     logger.debug("Start delete cookies for google.com and google scholar")
-    if SESSION.cookies._cookies.get('.scholar.google.com'):
-        del SESSION.cookies._cookies['.scholar.google.com']
+    session = get_session()
+    if session.cookies._cookies.get('.scholar.google.com'):
+        del session.cookies._cookies['.scholar.google.com']
         logger.debug("Delete cookies for google scholar")
-    if SESSION.cookies._cookies.get('.google.com'):
-        google_cookies_keys = list(SESSION.cookies._cookies['.google.com']['/'].keys())
+    if session.cookies._cookies.get('.google.com'):
+        google_cookies_keys = list(session.cookies._cookies['.google.com']['/'].keys())
         for key in google_cookies_keys:
             if key not in DONT_TOUCH_KEYS_IN_COOKIES:
-                del SESSION.cookies._cookies['.google.com']['/'][key]
+                del session.cookies._cookies['.google.com']['/'][key]
         logger.debug("Delete cookies for google.com")
-    return SESSION.cookies
+    return session.cookies
+
+class OverloadError(Exception): pass
 
-def get_request(url, att_file = None, using_TOR = False):
-    """Send get request & return data"""
+# Upload timeouts grow with file size and adapt to latency of grobid in this run
+TIMEOUTS = aimd.TimeoutEstimator(settings.DEFAULT_TIMEOUT, settings.TIMEOUT_PER_MB, settings.MIN_TIMEOUT, settings.MAX_TIMEOUT)
+
+# Server is busy, request can be repeated later
+OVERLOAD_STATUS_CODES = (429, 503)
+
+class UploadBody(object):
+    """ Request body read from parts (bytes or memory-mapped PDF) one after another, without joining them.
+        Remembers when it was read to the end, that is when its upload finished """
+    def __init__(self, parts):
+        self.parts = parts
+        self.size = sum(len(part) for part in parts)
+        self.sent_time = None
+        self._position = 0
+
+    def __len__(self):
+        return self.size
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence = io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self.size
+        self._position = max(0, min(position, self.size))
+        return self._position
+
+    def read(self, size = -1):
+        size = self.size - self._position if size is None or size < 0 else size
+        chunks = []
+        offset = self._position
+        for part in self.parts:
+            if size <= 0:
+                break
+            if offset >= len(part):
+                offset -= len(part)
+                continue
+            chunk = part[offset:offset + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+            offset = 0
+        data = b"".join(chunks)
+        self._position += len(data)
+        if not data:
+            self.sent_time = time.time()
+        return data
+
+    def close(self):
+        for part in self.parts:
+            if isinstance(part, mmap.mmap): part.close()
+
+def map_file(path):
+    """ Read-only memory map of file, its descriptor is closed right away. Content of files that can't be mapped (empty) is read """
+    with open(path, 'rb') as mapped_file:
+        try:
+            return mmap.mmap(mapped_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return mapped_file.read()
+
+def encode_files(att_file):
+    """ Encode {field: file or (filename, file, bytes or path)} as multipart/form-data, returns (UploadBody, content type).
+        Files given by path are memory-mapped instead of read, same body as urllib3.encode_multipart_formdata """
+    boundary = urllib3.filepost.choose_boundary()
+    parts = []
+    try:
+        for field, f in att_file.items():
+            filename, f = f if isinstance(f, tuple) else (os.path.split(getattr(f, 'name', field))[1], f)
+            if hasattr(f, 'read'):
+                f = f.read()
+            elif isinstance(f, str):
+                f = metrics.timed('read', map_file, f)
+            headers = urllib3.fields.RequestField.from_tuples(field, (filename, b"")).render_headers()
+            parts.append("--{}\r\n".format(boundary).encode('latin-1') + headers.encode('utf-8'))
+            parts.append(f)
+            parts.append(b"\r\n")
+        parts.append("--{}--\r\n".format(boundary).encode('latin-1'))
+    except:
+        UploadBody(parts).close()
+        raise
+    return UploadBody(parts), "multipart/form-data; boundary={}".format(boundary)
+
+def get_request(url, att_file = None, using_TOR = False, binary = False, balancer = None, retry = True):
+    """Send get request & return data, as bytes if binary.
+       With balancer (balancer.Balancer) url is relative to the endpoint chosen for every attempt.
+       Without retry the request is sent once and its error (OverloadError, ConnectionError) is raised"""
+    # Body is encoded once and sent again by every attempt, mapped files are closed when the request is done
+    body, content_type = encode_files(att_file) if att_file else (None, None)
+    try:
+        return _send_request(url, body, content_type, using_TOR, binary, balancer, retry)
+    finally:
+        if body is not None: body.close()
+
+def _send_request(url, body, content_type, using_TOR, binary, balancer, retry_errors = True):
     retry = settings.DEFAULT_MAX_RETRIES
-    while retry > 0:
+    overload_retry = settings.OVERLOAD_MAX_RETRIES
+    attempt = 0
+    headers = {'Content-Type': content_type} if body is not None else None
+    session = get_session()
+    timeouts = 0
+    while retry > 0 and overload_retry > 0:
+        timeout = settings.DEFAULT_TIMEOUT
+        if body is not None:
+            body.seek(0)
+            body.sent_time = None
+            timeout = TIMEOUTS.timeout(body.size, timeouts)
         try:
-            try:
-                if using_TOR:
-                    with TorRequest(tor_app=r".\Tor\tor.exe") as tr:
-                        response = tr.post(url=url, files = att_file, cookies = SESSION.cookies, timeout=settings.DEFAULT_TIMEOUT)
-                        SESSION.cookies = response.cookies
-                else:
-                    response = SESSION.post(url=url, files = att_file, timeout=settings.DEFAULT_TIMEOUT)
-            except requests.exceptions.Timeout:
-                logging.debug("timeout from requests")
-                settings.print_message("timeout from requests", 2)
-                raise ConnectionError("request timeout after %d seconds" % settings.DEFAULT_TIMEOUT)
-            except requests.exceptions.RequestException as e:
-                raise ConnectionError("request exception: %s" % e)
+            with balancer.endpoint() if balancer is not None else contextlib.nullcontext() as endpoint:
+                request_url = url if endpoint is None else "{}{}".format(endpoint.url, url)
+                limiter = None if endpoint is None else endpoint.limiter
+                generation = limiter.acquire() if limiter is not None else None
+                start_time = time.time()
+                overloaded = False
+                # Latency of answered request, failed ones are not latency samples
+                latency = None
+                metrics.increment('requests')
+                try:
+                    try:
+                        if using_TOR:
+                            with get_tor_pool().circuit() as circuit:
+                                response = circuit.post(url=request_url, data = body, headers = headers, cookies = session.cookies, timeout=timeout)
+                                session.cookies = response.cookies
+                        else:
+                            response = session.post(url=request_url, data = body, headers = headers, timeout=timeout)
+                    except requests.exceptions.Timeout:
+                        overloaded = True
+                        timeouts += 1
+                        metrics.increment('timeouts')
+                        if balancer is not None: balancer.report(endpoint, False)
+                        logging.debug("timeout from requests")
+                        settings.print_message("timeout from requests", 2)
+                        raise ConnectionError("request timeout after %.1f seconds" % timeout)
+                    except requests.exceptions.RequestException as e:
+                        metrics.increment('connection_errors')
+                        if balancer is not None: balancer.report(endpoint, False)
+                        raise ConnectionError("request exception: %s" % e)
+                    latency = time.time() - start_time
+                    if body is not None and body.sent_time is not None:
+                        metrics.observe('upload', body.sent_time - start_time)
+                        metrics.observe('grobid_wait', time.time() - body.sent_time)
+                        metrics.increment('uploaded_bytes', body.size)
+                    metrics.increment('downloaded_bytes', len(response.content))
+                    if balancer is not None: balancer.report(endpoint, True)
+                    if response.status_code in OVERLOAD_STATUS_CODES:
+                        # With TOR the circuit already has a new identity
+                        overloaded = True
+                        metrics.increment('overloads')
+                        raise OverloadError("HTTP %d - %s" % (response.status_code, response.reason))
+                finally:
+                    if limiter is not None: limiter.release(overloaded, latency, generation, body.size if body is not None else None)
             if response.status_code == 200:
-                return response.text
+                if body is not None: TIMEOUTS.observe(body.size, time.time() - start_time)
+                return response.content if binary else response.text
             else:
                 raise Exception("HTTP %d - %s" % (response.status_code, response.reason))
+        except OverloadError as error:
+            if not retry_errors:
+                del_gs_cookies()
+                raise
+            overload_retry = overload_retry - 1
+            settings.print_message("server is overloaded: '%s'" % error, 2)
+            logging.info("server is overloaded: '%s'" % error)
         except ConnectionError as error:
+            if not retry_errors:
+                del_gs_cookies()
+                raise
             retry = retry - 1
             settings.print_message("ran into connection error: '%s'" % error, 2)
             logging.info("ran into connection error: '%s'" % error)
-            if retry > 0:
-                settings.print_message("retrying in %d seconds" % settings.DEFAULT_SLEEP, 2)
-                logging.info("retrying in %d seconds" % settings.DEFAULT_SLEEP)
-                time.sleep(settings.DEFAULT_SLEEP)
         else:
             retry = 0
+        if retry > 0 and overload_retry > 0:
+            sleep = aimd.get_backoff(attempt, settings.BACKOFF_BASE, settings.BACKOFF_MAX)
+            attempt = attempt + 1
+            metrics.increment('retries')
+            settings.print_message("retrying in %.1f seconds" % sleep, 2)
+            logging.info("retrying in %.1f seconds" % sleep)
+            time.sleep(sleep)
     del_gs_cookies()
 
 
-def get_soup(url, using_TOR = False):
+def get_soup(url, using_TOR = False, retry = True):
     """Return the BeautifulSoup for a page"""
+    from bs4 import BeautifulSoup
+    if not _COOKIES_LOADED:
+        _update_cookies()
     try:
-        request = get_request(url, using_TOR = using_TOR)
+        request = get_request(url, using_TOR = using_TOR, retry = retry)
         if request == None:
             logger.debug("Request is empty, don't create soup.")
             return None
@@ -113,6 +371,7 @@ def get_about_count_results(soup):
 
 
 def get_count_from_scholar(title, using_TOR = False):
-    """ Search publication on Google.scholar and return count of searched papers """
+    """ Search publication on Google.scholar and return count of searched papers.
+        Request is sent once, the caller's rate limit decides about another one """
     url = settings.SCHOLAR_SEARCH.format("\"{}\"".format(title))
-    return get_about_count_results(get_soup(url, using_TOR = using_TOR))
\ No newline at end of file
+    return get_about_count_results(get_soup(url, using_TOR = using_TOR, retry = False))
\ No newline at end of file